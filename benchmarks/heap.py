@@ -0,0 +1,48 @@
+"""
+Forward batches as padded S arrays vs. as heaps (offsets + bytes), for IDs of skewed lengths.
+
+    python benchmarks/heap.py [--count 1000000] [--batch 100000]
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+from npids import Lookup
+
+
+def datasets(count, rng):
+    return {
+        'intstored': [f'D{i}' for i in np.sort(rng.choice(10**12, count, replace=False))],
+        'varbytes': [f'doc-{i:x}' + 'x' * (200 if i % 100 == 0 else i % 10) for i in range(count)],
+    }
+
+
+def timeit(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=100000)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tdir:
+        for name, docnos in datasets(args.count, rng).items():
+            lookup = Lookup.build(docnos, f'{tdir}/{name}')
+            idxs = rng.integers(0, len(docnos), args.batch)
+            padded = timeit(lambda: lookup.fwd.lookup(idxs, as_bytes=True))
+            heap = timeit(lambda: lookup.fwd.lookup(idxs, as_heap=True))
+            padded_bytes = lookup.fwd.lookup(idxs, as_bytes=True).nbytes
+            heap_bytes = sum(a.nbytes for a in vars(lookup.fwd.lookup(idxs, as_heap=True)).values())
+            codecs = ','.join(sorted({c.fmt.NAME for c in lookup.fwd.codecs}))
+            print(f'{codecs:12} padded={padded*1000:7.1f}ms ({padded_bytes/2**20:6.1f}MB) heap={heap*1000:7.1f}ms ({heap_bytes/2**20:6.1f}MB)')
+
+
+if __name__ == '__main__':
+    main()
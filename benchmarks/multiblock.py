@@ -0,0 +1,61 @@
+"""
+Random forward and inverse lookups against lookups fragmented into many blocks.
+
+    python benchmarks/multiblock.py [--blocks 10000] [--batch 10000]
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+from npids import Lookup
+
+
+def fragmented(kind, blocks, rng):
+    if kind == 'intsequence':
+        # runs of 20 that are too far apart to be merged into a block
+        return [f'D{i}' for start in range(0, blocks * 1000, 1000) for i in range(start, start + 20)]
+    if kind == 'intstored':
+        # blocks of increasing values that alternate between two prefixes
+        values = np.sort(rng.choice(10**6, (blocks, 20), replace=False), axis=1) + np.arange(blocks)[:, None] // 2 * 10**6
+        return [f'{"AB"[b % 2]}{i}' for b in range(blocks) for i in values[b]]
+    if kind == 'frontcoded':
+        # sorted URLs of a site per block, written explicitly (front coding does not end blocks by itself)
+        return [sorted({f'http://site{b}.com/{"/".join(rng.choice(["news", "sport", "about", "archive"], rng.integers(2, 8)))}' for _ in range(60)}) for b in range(blocks)]
+    raise ValueError(kind)
+
+
+def timeit(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=10000)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tdir:
+        for kind in ['intsequence', 'intstored', 'frontcoded']:
+            docnos = fragmented(kind, args.blocks, rng)
+            if kind == 'frontcoded':
+                with Lookup.builder(f'{tdir}/{kind}') as builder:
+                    for block in docnos:
+                        builder.add_block(block)
+                docnos = [docno for block in docnos for docno in block]
+                lookup = Lookup(f'{tdir}/{kind}')
+            else:
+                lookup = Lookup.build(docnos, f'{tdir}/{kind}', min_block=16)
+            idxs = rng.integers(0, len(docnos), args.batch)
+            keys = np.array([docnos[i] for i in idxs])
+            fwd = timeit(lambda: lookup.fwd[idxs])
+            inv = timeit(lambda: lookup.inv[keys])
+            print(f'{kind:12} blocks={len(lookup.fwd.codecs):6} inv={lookup.inv.codec.NAME:17} fwd={fwd*1000:8.1f}ms inv={inv*1000:8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
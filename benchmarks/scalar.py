@@ -0,0 +1,52 @@
+"""
+Per-call latency of single-ID forward and inverse lookups, compared to one-element batches (which go
+through the vectorized codecs).
+
+    python benchmarks/scalar.py [--count 100000] [--calls 2000]
+"""
+import argparse
+import tempfile
+import time
+import uuid
+import numpy as np
+from npids import Lookup
+
+
+def datasets(count, rng):
+    return {
+        'intsequence': [f'D{i}' for i in range(count)],
+        'intstored': [f'D{i}' for i in np.sort(rng.choice(10**8, count, replace=False))],
+        'template': [f'clueweb09-en{i // 10**7:04d}-{i // 10**5 % 100:02d}-{i % 10**5:05d}' for i in np.sort(rng.choice(10**8, count, replace=False))],
+        'uuid': [str(uuid.UUID(int=int(i))) for i in rng.integers(0, 2**63, count)],
+        'varbytes': [f'doc-{i*7919 % 10007:x}' + 'x' * (i % 50) for i in range(count)],
+    }
+
+
+def per_call(fn, keys):
+    start = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tdir:
+        for name, docnos in datasets(args.count, rng).items():
+            lookup = Lookup.build(docnos, f'{tdir}/{name}')
+            idxs = rng.integers(0, len(docnos), args.calls).tolist()
+            keys = [docnos[i] for i in idxs]
+            fwd = per_call(lambda i: lookup.fwd[i], idxs)
+            fwd_batch = per_call(lambda i: lookup.fwd[[i]], idxs)
+            inv = per_call(lambda k: lookup.inv[k], keys)
+            inv_batch = per_call(lambda k: lookup.inv[[k]], keys)
+            codecs = ','.join(sorted({c.fmt.NAME for c in lookup.fwd.codecs}))
+            print(f'{codecs:12} inv={lookup.inv.codec.NAME:10} fwd={fwd*1e6:6.1f}us (batch of 1: {fwd_batch*1e6:6.1f}us) inv={inv*1e6:6.1f}us (batch of 1: {inv_batch*1e6:6.1f}us)')
+
+
+if __name__ == '__main__':
+    main()
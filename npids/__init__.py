@@ -1,4 +1,5 @@
 __version__ = '0.1.2'
 
 from .lookup import Lookup
+from .utils import StringHeap
 from . import codecs
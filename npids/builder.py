@@ -1,9 +1,52 @@
+from itertools import islice
 from pathlib import Path
+import numpy as np
 import npids
 from .utils import FileManager
 from . import codecs
 
 
+ADD_MANY_CHUNK_SIZE = 2**16
+ADD_MANY_MIN_WINDOW = 2**8
+BLOCK_COST = 256 # bytes charged per block when planning blocks (header, config, and dispatching lookups over more blocks)
+PLAN_UNIT_SIZE = 2**9 # blocks are re-split at most this finely when planning
+PLAN_MAX_MERGE = 2**16 # blocks with more IDs than this are kept as they are
+
+
+def _byte_chunks(ids, size):
+    if hasattr(ids, 'to_pylist'): # Arrow arrays
+        ids = ids.to_pylist()
+    elif hasattr(ids, 'to_numpy') and not hasattr(ids, 'dtype'):
+        ids = ids.to_numpy()
+    if not isinstance(ids, (list, tuple, np.ndarray)):
+        it = iter(ids)
+        while True:
+            chunk = list(islice(it, size))
+            if not chunk:
+                break
+            yield from _byte_chunks(chunk, size)
+        return
+    for start in range(0, len(ids), size):
+        chunk = ids[start:start+size]
+        if not isinstance(chunk, np.ndarray):
+            chunk = np.array([i.encode() if isinstance(i, str) else i for i in chunk], dtype='S')
+        if chunk.dtype.kind == 'O':
+            chunk = np.array([i.encode() if isinstance(i, str) else i for i in chunk.tolist()], dtype='S')
+        if chunk.dtype.kind == 'U':
+            chunk = _encode_unicode(chunk)
+        if chunk.dtype.kind != 'S':
+            raise ValueError(f'Unsupported ids for add_many (expected strings, got dtype {chunk.dtype})')
+        yield chunk
+
+
+def _encode_unicode(arr):
+    codepoints = np.ascontiguousarray(arr).view(np.uint32).reshape(len(arr), -1)
+    if codepoints.shape[1] > 0 and len(arr) > 0 and codepoints.max() < 128:
+        # ASCII fast path: utf8 encoding is just a narrowing of the code points
+        return codepoints.astype(np.uint8).view(f'S{codepoints.shape[1]}').reshape(len(arr))
+    return np.char.encode(arr, encoding='utf8')
+
+
 class FwdLookupBuilder:
     def __init__(self, path, min_block=None):
         self.path = Path(path)
@@ -18,8 +61,19 @@ class FwdLookupBuilder:
     def add(self, id):
         if self.format is not None:
             enc_id = self.format.encode(id)
+            if enc_id is None and hasattr(self.format, 'upgrade'):
+                # some codecs can continue the block in a more general format (e.g., intsequence with gaps)
+                upgraded = self.format.upgrade()
+                enc_id = upgraded.encode(id) if upgraded is not None else None
+                if enc_id is not None:
+                    config = {'format': upgraded.NAME}
+                    config.update(upgraded.config())
+                    self.fout.rewrite_last_config(config)
+                    self.format = upgraded
             if enc_id is None:
-                self.format.reset()
+                self._finish_block()
+                for f in self.formats.values():
+                    f.reset()
                 self.format = None
                 self.seeded_formats = self.formats.copy()
                 self.seeds = []
@@ -36,10 +90,86 @@ class FwdLookupBuilder:
             if len(self.seeds) >= self.min_block:
                 self._commit()
 
+    def add_many(self, ids):
+        # Equivalent to calling add() for each id, but whole runs of ids are checked and encoded by the
+        # current codec at once. Accepts lists, numpy S/U arrays, Arrow-like columns, or any iterable.
+        for chunk in _byte_chunks(ids, ADD_MANY_CHUNK_SIZE):
+            i = 0
+            window = ADD_MANY_MIN_WINDOW
+            while i < len(chunk):
+                if self.format is not None and hasattr(self.format, 'encode_many'):
+                    # the window grows while the codec keeps accepting everything, so that blocks that end
+                    # early do not pay for checking the rest of the chunk
+                    data, count = self.format.encode_many(chunk[i:i+window])
+                    if count > 0:
+                        self.fout.write(data)
+                        self.count += count
+                        i += count
+                        window = window * 2 if count == window else ADD_MANY_MIN_WINDOW
+                        continue
+                if self.format is None:
+                    # seeding: the remaining formats check the ids up to min_block at once
+                    seeds = chunk[i:i + self.min_block - len(self.seeds)]
+                    for f in list(self.seeded_formats):
+                        if not _seed_many(self.seeded_formats[f], seeds):
+                            self.seeded_formats[f].reset()
+                            del self.seeded_formats[f]
+                    self.seeds.extend(id.decode() for id in seeds)
+                    i += len(seeds)
+                    if len(self.seeds) >= self.min_block:
+                        self._commit()
+                    continue
+                # the id did not fit the current codec
+                self.add(chunk[i].decode())
+                i += 1
+
+    def add_block(self, ids):
+        # writes ids as a block of their own, using the smallest codec that accepts all of them
+        self._end_block()
+        formats = _seed_formats(ids)
+        self.format = min(formats, key=lambda f: f.size())
+        config = {'format': self.format.NAME}
+        config.update(self.format.config())
+        self.fout.write_header(0, len(ids), config)
+        for chunk in _byte_chunks(ids, ADD_MANY_CHUNK_SIZE):
+            if hasattr(self.format, 'encode_many'):
+                data, count = self.format.encode_many(chunk)
+                assert count == len(chunk)
+                self.fout.write(data)
+            else:
+                for id in chunk:
+                    self.fout.write(self.format.encode(id.decode()))
+        self._finish_block()
+        self.format = None
+
+    def copy_block(self, config, count, data):
+        # writes an already-encoded block (e.g., from another lookup) as it is
+        self._end_block()
+        self.fout.write_header(0, count, config)
+        self.fout.write(data)
+
     def close(self):
         self._commit()
+        self._finish_block()
         self.fout.close()
 
+    def _end_block(self):
+        # completes the current block (if any), so that the next id starts a new one
+        self._commit()
+        self._finish_block()
+        for f in self.formats.values():
+            f.reset()
+        self.format = None
+        self.seeded_formats = self.formats.copy()
+        self.seeds = []
+        self.count = 0
+
+    def _finish_block(self):
+        # codecs that only know their layout once the block is complete (e.g., varbytes offsets) write
+        # it after the encoded ids
+        if self.format is not None and hasattr(self.format, 'finish'):
+            self.fout.write(self.format.finish())
+
     def _commit(self):
         if self.count != 0:
             self.fout.write_doc_count(self.count)
@@ -58,18 +188,138 @@ class FwdLookupBuilder:
         self.fout.flush()
 
 
+def _seed_many(fmt, ids):
+    # seeds fmt with an S array of ids; whether it accepts all of them
+    if hasattr(fmt, 'seed_many'):
+        return fmt.seed_many(ids)
+    return all(fmt.seed(id.decode()) for id in ids)
+
+
+def _seed_formats(ids, formats=None):
+    # seeds every format (new instances by default) with ids, returning the ones that accept all of them
+    formats = [f() for f in codecs.fwd.values()] if formats is None else formats
+    for chunk in _byte_chunks(ids, ADD_MANY_CHUNK_SIZE):
+        formats = [f for f in formats if _seed_many(f, chunk)]
+    return formats
+
+
+def plan_blocks(blocks, block_cost=BLOCK_COST, unit_size=PLAN_UNIT_SIZE, max_merge=PLAN_MAX_MERGE):
+    """
+    Plans how to split a sequence of IDs into blocks. blocks is a list of (ids, nbytes) for the existing
+    blocks (ids being an S array); blocks with more than max_merge IDs are kept as they are, and the
+    others are cut into units of up to unit_size IDs. Each unit is seeded once on its own, which gives its estimated size as a block of
+    its own (the size() of the best codec that accepts every ID of the unit, plus block_cost). The units
+    are then merged from left to right: a unit joins the current block when the estimated size of the
+    merged block (continuing the seeding of the codecs of the current block) is lower than that of the
+    two blocks apart. Returns a list of (kind, value), where kind is 'keep' (value is the index of an
+    existing block) or 'ids' (value is an S array of IDs).
+    """
+    def cost(formats, count):
+        return min(f.size() for f in formats) * count + block_cost
+    result = []
+    current = None # [units, count, formats, cost] of the block being merged into
+    for i, (ids, nbytes) in enumerate(blocks):
+        if len(ids) > max_merge:
+            if current is not None:
+                result.append(('ids', np.concatenate(current[0])))
+                current = None
+            result.append(('keep', i))
+            continue
+        for start in range(0, len(ids), unit_size):
+            unit = ids[start:start+unit_size]
+            formats = _seed_formats(unit)
+            unit_cost = cost(formats, len(unit))
+            if current is not None and current[1] + len(unit) <= max_merge:
+                merged = _seed_formats(unit, current[2])
+                merged_cost = cost(merged, current[1] + len(unit))
+                if merged_cost < current[3] + unit_cost:
+                    current[0].append(unit)
+                    current[1:] = current[1] + len(unit), merged, merged_cost
+                    continue
+            if current is not None:
+                result.append(('ids', np.concatenate(current[0])))
+            current = [[unit], len(unit), formats, unit_cost]
+    if current is not None:
+        result.append(('ids', np.concatenate(current[0])))
+    return result
+
+
+def optimize(src, dst, block_cost=BLOCK_COST, build_inv=True, inv_format=None, inv_options=None, workers=None):
+    # rewrites the forward blocks of src into dst (which must not exist yet) following plan_blocks, then
+    # builds a new inverse. Returns the size of the files and of their forward blocks, and the number of
+    # blocks, before and after.
+    if Path(dst).exists():
+        raise FileExistsError(f'{dst} already exists')
+    with npids.Lookup(src, load_inv=False) as lookup, FileManager(src, 'r') as f:
+        raw = [] # (config, count, data) of each existing block
+        with open(src, 'rb') as fin:
+            for type_id, _, start, end, doc_count, config in list(f.blocks()):
+                if type_id == 0:
+                    fin.seek(start)
+                    raw.append((config, doc_count, fin.read(-1 if end is None else end - start)))
+        blocks = []
+        for (config, count, data), codec in zip(raw, lookup.fwd.codecs):
+            ids = range(count) # (only the length of the blocks that are kept is used)
+            if count <= PLAN_MAX_MERGE:
+                ids = codec._lookup(np.arange(count, dtype=np.int64))
+            blocks.append((ids, len(data)))
+        plan = plan_blocks(blocks, block_cost=block_cost)
+        builder = FwdLookupBuilder(dst)
+        for kind, value in plan:
+            if kind == 'keep':
+                builder.copy_block(*raw[value])
+            else:
+                builder.add_block(value)
+        builder.close()
+    if build_inv:
+        InvLookupBuilder.build(dst, inv_format=inv_format, inv_options=inv_options, workers=workers)
+    return {
+        'blocks_before': len(blocks),
+        'blocks_after': len(plan),
+        'bytes_before': Path(src).stat().st_size,
+        'bytes_after': Path(dst).stat().st_size,
+        'fwd_bytes_before': _fwd_bytes(src),
+        'fwd_bytes_after': _fwd_bytes(dst),
+    }
+
+
+def _fwd_bytes(path):
+    # bytes taken by the forward blocks of the lookup at path (with their headers)
+    size = Path(path).stat().st_size
+    with FileManager(path, 'r') as f:
+        return sum((size if end is None else end) - ptr for type_id, ptr, _, end, _, _ in f.blocks() if type_id == 0)
+
+
 class InvLookupBuilder:
     @staticmethod
-    def build(path):
-        with npids.Lookup(path) as lookup, FileManager(path, 'a') as writer:
-            if len(lookup.fwd.codecs) == 1 and isinstance(lookup.fwd.codecs[0].fmt, codecs.fwd['intsequence']):
+    def build(path, inv_format=None, inv_options=None, workers=None):
+        if inv_options and inv_format is None:
+            raise ValueError('inv_options requires inv_format to be specified')
+        # only the hash-based codecs have enough build work to be worth distributing
+        parallel_options = {'workers': workers} if workers is not None else {}
+        with npids.Lookup(path, load_inv=False) as lookup, FileManager(path, 'a') as writer:
+            if inv_format is not None:
+                Inv = codecs.inv[inv_format]
+                if hasattr(Inv, 'condition') and not Inv.condition(lookup.fwd):
+                    raise ValueError(f'inverse format {inv_format!r} is not supported by the forward codecs of {path}')
+                options = dict(inv_options or {})
+                if inv_format in ('hash', 'mph'):
+                    options.update(parallel_options)
+                Inv.build(lookup.fwd, writer, **options)
+            elif codecs.inv['intsequence'].condition(lookup.fwd):
                 codecs.inv['intsequence'].build(lookup.fwd, writer)
             elif codecs.inv['intstored'].condition(lookup.fwd):
                 codecs.inv['intstored'].build(lookup.fwd, writer)
             elif codecs.inv['intsequencemulti'].condition(lookup.fwd):
                 codecs.inv['intsequencemulti'].build(lookup.fwd, writer)
+            elif codecs.inv['template'].condition(lookup.fwd):
+                codecs.inv['template'].build(lookup.fwd, writer)
+            elif codecs.inv['prefixdict'].condition(lookup.fwd):
+                codecs.inv['prefixdict'].build(lookup.fwd, writer)
+            elif codecs.inv['sorted'].condition(lookup.fwd) and codecs.inv['sorted'].estimate_size(lookup.fwd) < codecs.inv['hash'].estimate_size(lookup.fwd):
+                codecs.inv['sorted'].build(lookup.fwd, writer)
             else:
-                codecs.inv['hash'].build(lookup.fwd, writer)
+                codecs.inv['hash'].build(lookup.fwd, writer, **parallel_options)
 
     @staticmethod
     def _matches_intstored_case(lookup):
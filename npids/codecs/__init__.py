@@ -1,13 +1,59 @@
-from .fwd_fixedbytes import FwdFixedBytes
-from .fwd_hexdigest import FwdHexDigest
-from .fwd_intsequence import FwdIntSequence
-from .fwd_intsequencepad import FwdIntSequencePad
-from .fwd_intstored import FwdIntStored
-from .fwd_uuid import FwdUuid
-from .inv_hash import InvHash
-from .inv_intsequence import InvIntSequence
-from .inv_intsequencemulti import InvIntSequenceMulti
-from .inv_intstored import InvIntStored
-
-fwd = {c.NAME: c for c in [FwdFixedBytes, FwdHexDigest, FwdIntSequence, FwdIntSequencePad, FwdIntStored, FwdUuid]}
-inv = {c.NAME: c for c in [InvHash, InvIntSequence, InvIntSequenceMulti, InvIntStored]}
+from collections.abc import Mapping
+from importlib import import_module
+
+
+class CodecRegistry(Mapping):
+    """
+    Codec classes by NAME. The module of each codec is only imported when the codec is first used, so
+    that opening a lookup only pays for the codecs that it contains.
+    """
+    def __init__(self, classes):
+        self._classes = classes # NAME -> (module, class name), in order of preference
+        self._loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self._loaded:
+            module, cls = self._classes[name]
+            self._loaded[name] = getattr(import_module(f'{__name__}.{module}'), cls)
+        return self._loaded[name]
+
+    def __iter__(self):
+        return iter(self._classes)
+
+    def __len__(self):
+        return len(self._classes)
+
+
+fwd = CodecRegistry({
+    'fixedbytes': ('fwd_fixedbytes', 'FwdFixedBytes'),
+    'frontcoded': ('fwd_frontcoded', 'FwdFrontCoded'),
+    'hexdigest': ('fwd_hexdigest', 'FwdHexDigest'),
+    'intsequence': ('fwd_intsequence', 'FwdIntSequence'),
+    'intsequencepad': ('fwd_intsequencepad', 'FwdIntSequencePad'),
+    'intsequencegaps': ('fwd_intsequencegaps', 'FwdIntSequenceGaps'),
+    'intstored': ('fwd_intstored', 'FwdIntStored'),
+    'intpacked': ('fwd_intpacked', 'FwdIntPacked'),
+    'prefixdict': ('fwd_prefixdict', 'FwdPrefixDict'),
+    'template': ('fwd_template', 'FwdTemplate'),
+    'uuid': ('fwd_uuid', 'FwdUuid'),
+    'varbytes': ('fwd_varbytes', 'FwdVarBytes'),
+})
+inv = CodecRegistry({
+    'hash': ('inv_hash', 'InvHash'),
+    'intsequence': ('inv_intsequence', 'InvIntSequence'),
+    'intsequencemulti': ('inv_intsequencemulti', 'InvIntSequenceMulti'),
+    'intstored': ('inv_intstored', 'InvIntStored'),
+    'mph': ('inv_mph', 'InvMph'),
+    'prefixdict': ('inv_prefixdict', 'InvPrefixDict'),
+    'sorted': ('inv_sorted', 'InvSorted'),
+    'template': ('inv_template', 'InvTemplate'),
+})
+
+
+def __getattr__(name):
+    # codec classes by class name (e.g., codecs.FwdFixedBytes)
+    for registry in (fwd, inv):
+        for codec, (_, cls) in registry._classes.items():
+            if cls == name:
+                return registry[codec]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,5 +1,5 @@
 import numpy as np
-from npids.utils import wrap_mmap
+from npids.utils import wrap_mmap, byte_matrix, row_lengths, common_prefix, startswith, leading_count, slice_vectorized
 
 
 class FwdFixedBytes:
@@ -20,6 +20,15 @@ class FwdFixedBytes:
             self.length = len(id)
         return True
 
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted
+        if len(ids) == 0:
+            return True
+        self.prefix = common_prefix(ids, self.prefix)
+        length = int(row_lengths(byte_matrix(ids)).max())
+        self.length = length if self.length is None else max(self.length, length)
+        return True
+
     def reset(self):
         self.prefix = None
         self.length = None
@@ -41,7 +50,19 @@ class FwdFixedBytes:
             id = id + bytes(self.length - len(self.prefix) - len(id))
         return id
 
+    def encode_many(self, ids: np.array):
+        # vectorized encode of an S array; returns the encoding of the leading ids that fit and their count
+        valid = startswith(ids, self.prefix) & (row_lengths(byte_matrix(ids)) <= self.length)
+        count = leading_count(valid)
+        width = self.length - len(self.prefix)
+        if width == 0:
+            return b'', count
+        return slice_vectorized(ids[:count], len(self.prefix)).astype(f'S{width}').tobytes(), count
+
     def build_context(self, mmp, count):
+        if self.length == len(self.prefix):
+            # every id is the prefix itself; nothing is stored
+            return np.zeros(count, dtype='S1')
         return wrap_mmap(mmp, f'S{self.length-len(self.prefix)}')
 
     def lookup(self, idxs: np.array, ctxt) -> np.array:
@@ -51,6 +72,10 @@ class FwdFixedBytes:
             docnos = np.char.add(self.prefix, docnos)
         return docnos.astype('S')
 
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        docno = bytes(ctxt[idx])
+        return self.prefix + docno if self.prefix else docno
+
     def iterator(self, ctxt):
         mmp = ctxt
         for i in range(mmp.shape[0]):
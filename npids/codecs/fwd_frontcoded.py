@@ -0,0 +1,237 @@
+from array import array
+import numpy as np
+from npids.utils import byte_matrix, row_lengths, common_prefix, startswith, leading_count, slice_vectorized, prefixed
+
+
+BUCKET_SIZE = 16
+MAX_LENGTH = 255
+OFFSET_BYTES = 4
+MIN_SHARED = 4 # minimum mean bytes shared with the previous ID (beyond what all seeded IDs share) to use front coding
+KEY_STRIDE = 512 # > MAX_LENGTH + 1, so that the lcps of consecutive rows sort after each other
+SCALAR_BATCH = 12 # batches up to this size are decoded one ID at a time (cheaper than the fixed cost of the vectorized path)
+
+
+def _lcp(a: bytes, b: bytes):
+    # the first differing byte is the highest one set in the XOR of the (big-endian) common lengths
+    n = min(len(a), len(b))
+    diff = int.from_bytes(a[:n], 'big') ^ int.from_bytes(b[:n], 'big')
+    return n - (diff.bit_length() + 7) // 8
+
+
+def _row_lcps(b, lengths, prev: bytes):
+    # vectorized _lcp of each row of a uint8 matrix (with the given lengths) with the previous row (prev for the first)
+    count, width = b.shape
+    if width == 0:
+        return np.zeros(count, dtype=np.intp)
+    prev_rows = np.zeros((count, width), dtype=np.uint8)
+    prev_first = np.frombuffer(prev[:width], dtype=np.uint8)
+    prev_rows[0, :len(prev_first)] = prev_first
+    prev_rows[1:] = b[:-1]
+    prev_lengths = np.concatenate([[len(prev)], lengths[:-1]])
+    same = b == prev_rows
+    lcp = np.where(same.all(axis=1), width, same.argmin(axis=1))
+    return np.minimum(lcp, np.minimum(lengths, prev_lengths))
+
+
+class FrontCodedEntries:
+    """
+    The entries of a block, as bytes (for scalar lookups) and as an array (for batches), along with the
+    position of every entry, which is decoded on the first batch lookup by following the entries of all
+    buckets at once.
+    """
+    def __init__(self, data, offsets, count, max_len):
+        self.data = data
+        self.heap = np.frombuffer(data, dtype=np.uint8)
+        self.offsets = offsets
+        self.count = count
+        self.max_len = max_len
+        self._starts = None
+
+    @property
+    def starts(self):
+        if self._starts is None:
+            starts = np.empty((len(self.offsets), BUCKET_SIZE), dtype=np.int64)
+            ptrs = self.offsets.astype(np.int64)
+            last = max(len(self.heap) - 1, 0)
+            for step in range(BUCKET_SIZE):
+                starts[:, step] = ptrs
+                # (the last bucket can be partial; its missing entries are never used)
+                ptrs = ptrs + 2 + self.heap[np.minimum(ptrs + 1, last)]
+            self._starts = starts.reshape(-1)[:self.count]
+        return self._starts
+
+
+class FwdFrontCoded:
+    """
+    Front coding of IDs that share a prefix with their neighbours (e.g., sorted URLs or docnos). IDs are grouped
+    into buckets of BUCKET_SIZE; each is stored as ``[lcp u8][suffix length u8][suffix]``, where lcp is
+    the length of the prefix shared with the previous ID in the bucket (0 for the first one, which is
+    stored in full). After the entries come the offset of each bucket, the maximum ID length, and the
+    width of the offsets. A lookup decodes at most BUCKET_SIZE entries from the start of its bucket.
+    Since the shared prefixes are already stored once per bucket, the IDs of a block do not need a
+    common prefix (blocks written with one, as ``prefix``, are still read).
+    """
+    NAME = 'frontcoded'
+    def __init__(self, prefix=''):
+        self.reset()
+        self.prefix = prefix.encode()
+
+    def seed(self, id):
+        id = id.encode()
+        if len(id) > MAX_LENGTH:
+            return False
+        self.seed_prefix = id if self.seed_count == 0 else self.seed_prefix[:_lcp(self.seed_prefix, id)]
+        if self.seed_count % BUCKET_SIZE == 0:
+            self.seed_bucket_starts += 1
+            self.seed_bytes += 2 + len(id)
+        else:
+            lcp = _lcp(self.seed_prev, id)
+            self.seed_bytes += 2 + len(id) - lcp
+            self.seed_shared += lcp
+        self.seed_prev = id
+        self.seed_count += 1
+        return True
+
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted
+        if len(ids) == 0:
+            return True
+        b = byte_matrix(ids)
+        lengths = row_lengths(b)
+        if lengths.max() > MAX_LENGTH:
+            return False
+        self.seed_prefix = common_prefix(ids, self.seed_prefix if self.seed_count > 0 else None)
+        lcp = _row_lcps(b, lengths, self.seed_prev)
+        bucket_starts = (self.seed_count + np.arange(len(ids))) % BUCKET_SIZE == 0
+        lcp[bucket_starts] = 0
+        self.seed_bucket_starts += int(bucket_starts.sum())
+        self.seed_bytes += int((2 + lengths - lcp).sum())
+        self.seed_shared += int(lcp.sum())
+        self.seed_prev = b[-1, :lengths[-1]].tobytes()
+        self.seed_count += len(ids)
+        return True
+
+    def reset(self):
+        self.prefix = b''
+        self.seed_prefix = b''
+        self.seed_prev = b''
+        self.seed_count = 0
+        self.seed_bucket_starts = 0
+        self.seed_bytes = 0
+        self.seed_shared = 0
+        self.prev = b''
+        self.count = 0
+        self.written = 0
+        self.max_len = 0
+        self.bucket_offsets = array('Q')
+
+    def size(self):
+        # lookups need to decode up to a full bucket, so only use front coding when neighbours share
+        # more than the prefix common to all the IDs (which other codecs store once per block)
+        coded = self.seed_count - self.seed_bucket_starts
+        if coded == 0 or self.seed_shared / coded - len(self.seed_prefix) < MIN_SHARED:
+            return float('inf')
+        return self.seed_bytes / max(self.seed_count, 1) + OFFSET_BYTES / BUCKET_SIZE
+
+    def config(self):
+        return {'prefix': self.prefix.decode()} if self.prefix else {}
+
+    def encode(self, id):
+        id = id.encode()
+        if not id.startswith(self.prefix) or len(id) > MAX_LENGTH:
+            return None
+        suffix = id[len(self.prefix):]
+        if self.count % BUCKET_SIZE == 0:
+            self.bucket_offsets.append(self.written)
+            lcp = 0
+        else:
+            lcp = _lcp(self.prev, suffix)
+        result = bytes([lcp, len(suffix) - lcp]) + suffix[lcp:]
+        self.prev = suffix
+        self.count += 1
+        self.written += len(result)
+        self.max_len = max(self.max_len, len(suffix))
+        return result
+
+    def encode_many(self, ids: np.array):
+        # vectorized encode of an S array; returns the encoding of the leading ids that fit and their count
+        count = leading_count(startswith(ids, self.prefix) & (row_lengths(byte_matrix(ids)) <= MAX_LENGTH))
+        if count == 0:
+            return b'', 0
+        b = byte_matrix(slice_vectorized(ids[:count], len(self.prefix)))
+        lengths = row_lengths(b)
+        width = b.shape[1]
+        lcp = _row_lcps(b, lengths, self.prev)
+        bucket_starts = (self.count + np.arange(count)) % BUCKET_SIZE == 0
+        lcp[bucket_starts] = 0
+        suffix_lengths = lengths - lcp
+        entry_lengths = 2 + suffix_lengths
+        entry_offsets = self.written + np.cumsum(entry_lengths) - entry_lengths
+        self.bucket_offsets.frombytes(entry_offsets[bucket_starts].astype(np.uint64).tobytes())
+        entries = np.zeros((count, 2 + width), dtype=np.uint8)
+        entries[:, 0] = lcp
+        entries[:, 1] = suffix_lengths
+        if width > 0:
+            src = np.minimum(lcp[:, None] + np.arange(width), width - 1)
+            entries[:, 2:] = np.take_along_axis(b, src, axis=1)
+        self.prev = b[-1, :lengths[-1]].tobytes()
+        self.count += count
+        self.written += int(entry_lengths.sum())
+        self.max_len = max(self.max_len, int(lengths.max()))
+        return entries[np.arange(2 + width) < entry_lengths[:, None]].tobytes(), count
+
+    def finish(self):
+        offsets = np.frombuffer(self.bucket_offsets, dtype=np.uint64)
+        width = OFFSET_BYTES if self.written <= np.iinfo(f'<u{OFFSET_BYTES}').max else 8
+        return offsets.astype(f'<u{width}').tobytes() + bytes([self.max_len, width])
+
+    def build_context(self, mmp, count):
+        width, max_len = mmp[len(mmp) - 1], mmp[len(mmp) - 2]
+        offsets_start = len(mmp) - 2 - -(-count // BUCKET_SIZE) * width
+        offsets = np.frombuffer(mmp[offsets_start:len(mmp)-2], dtype=f'<u{width}')
+        return FrontCodedEntries(bytes(mmp[:offsets_start]), offsets, count, max_len)
+
+    def lookup(self, idxs: np.array, ctxt) -> np.array:
+        # Decodes the entries of each ID's bucket (up to the ID) at once. Column c of an ID comes from the
+        # last of these entries whose lcp is <= c, i.e., the last one whose running minimum of the lcps
+        # (taken from the ID backwards) is <= c. These minimums are sorted, so with an offset per row,
+        # a single searchsorted finds the source entry of every column of every ID.
+        heap, max_len = ctxt.heap, ctxt.max_len
+        idxs = np.asarray(idxs, dtype=np.int64)
+        n = len(idxs)
+        if n <= SCALAR_BATCH:
+            return np.array([self.lookup_one(int(idx), ctxt) for idx in idxs], dtype=f'S{max(len(self.prefix) + max_len, 1)}')
+        steps = idxs % BUCKET_SIZE
+        in_bucket = np.arange(BUCKET_SIZE) <= steps[:, None]
+        entries = np.where(in_bucket, (idxs - steps)[:, None] + np.arange(BUCKET_SIZE), idxs[:, None])
+        starts = ctxt.starts[entries]
+        lcps = np.where(in_bucket, heap[starts], KEY_STRIDE - 1)
+        min_lcps = np.minimum.accumulate(lcps[:, ::-1], axis=1)[:, ::-1]
+        row_keys = np.arange(n, dtype=np.int64)[:, None] * KEY_STRIDE
+        cols = np.arange(max_len)
+        src = np.searchsorted((min_lcps + row_keys).reshape(-1), row_keys + cols, 'right') - 1
+        lengths = heap[starts[np.arange(n), steps]] + heap[starts[np.arange(n), steps] + 1].astype(np.int64)
+        active = cols < lengths[:, None]
+        pos = np.where(active, starts.reshape(-1)[src] + 2 + cols - lcps.reshape(-1)[src], 0)
+        return prefixed(self.prefix, np.where(active, heap[pos], 0).astype(np.uint8))
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        data = ctxt.data
+        ptr, prev = int(ctxt.offsets[idx // BUCKET_SIZE]), b''
+        for _ in range(idx % BUCKET_SIZE + 1):
+            lcp, suffix_len = data[ptr], data[ptr+1]
+            prev = prev[:lcp] + data[ptr+2:ptr+2+suffix_len]
+            ptr += 2 + suffix_len
+        return self.prefix + prev if self.prefix else prev
+
+    def iterator(self, ctxt):
+        data = ctxt.data
+        ptr, prev = 0, b''
+        while ptr < len(data):
+            lcp, suffix_len = data[ptr], data[ptr+1]
+            prev = prev[:lcp] + data[ptr+2:ptr+2+suffix_len]
+            ptr += 2 + suffix_len
+            yield (self.prefix + prev).decode()
+
+    def __repr__(self):
+        return f'{self.NAME} [prefix={self.prefix.decode()}]'
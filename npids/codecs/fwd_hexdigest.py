@@ -1,11 +1,6 @@
 import re
 import numpy as np
-from npids.utils import wrap_mmap
-
-def _coerce_bytes(b):
-    if hasattr(b, 'tobytes'):
-        return b.tobytes()
-    return b
+from npids.utils import wrap_mmap, byte_matrix, hexlify, prefixed, unhexlify, row_lengths, startswith, leading_count
 
 class FwdHexDigest:
     NAME = 'hexdigest'
@@ -15,11 +10,12 @@ class FwdHexDigest:
         self.prefix = prefix
         self.lc_re = re.compile(r'([0-9a-f][0-9a-f])+$')
         self.uc_re = re.compile(r'([0-9A-F][0-9A-F])+$')
-        self.vdigest = np.vectorize(lambda x: _coerce_bytes(x).hex().encode())
 
     def seed(self, id):
         if self.upper is None:
-            self.upper = bool(self.uc_re.search(id))
+            # trailing digits match both patterns, so pick the case that covers more of the id
+            lc_match, uc_match = self.lc_re.search(id), self.uc_re.search(id)
+            self.upper = bool(uc_match) and (not lc_match or uc_match.start() < lc_match.start())
         r = self.uc_re if self.upper else self.lc_re
         match = r.search(id)
         if not match:
@@ -32,6 +28,15 @@ class FwdHexDigest:
             return False
         return self.encode(id) is not None
 
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted (once the first id has set
+        # the layout, seed accepts exactly the ids that encode does)
+        if len(ids) > 0 and self.prefix is None:
+            if not self.seed(ids[0].decode()):
+                return False
+            ids = ids[1:]
+        return len(ids) == 0 or self.encode_many(ids)[1] == len(ids)
+
     def reset(self):
         self.upper = None
         self.prefix = None
@@ -44,34 +49,43 @@ class FwdHexDigest:
         return {'upper': self.upper, 'length': self.length, 'prefix': self.prefix}
 
     def encode(self, id):
-        if id[:-self.length] != self.prefix:
+        if len(id) != len(self.prefix) + self.length or id[:-self.length] != self.prefix:
             return None
         r = self.uc_re if self.upper else self.lc_re
         if not r.match(id[-self.length:]):
             return None
         return bytes.fromhex(id[-self.length:])
 
+    def encode_many(self, ids: np.array):
+        prefix = self.prefix.encode()
+        if ids.dtype.itemsize < len(prefix) + self.length:
+            return b'', 0
+        b = byte_matrix(ids)
+        data, valid = unhexlify(b[:, len(prefix):len(prefix)+self.length], self.upper)
+        valid &= startswith(ids, prefix) & (row_lengths(b) == len(prefix) + self.length)
+        count = leading_count(valid)
+        return data[:count].tobytes(), count
+
     def build_context(self, mmp, count):
         return wrap_mmap(mmp, f'V{self.length//2}')
 
     def lookup(self, idxs: np.array, ctxt) -> np.array:
         mmp = ctxt
-        docnos = self.vdigest(mmp[idxs])
+        prefix = self.prefix.encode() if self.prefix else b''
+        return prefixed(prefix, hexlify(byte_matrix(mmp[idxs]), self.upper))
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        docno = ctxt[idx].tobytes().hex()
         if self.upper:
-            docnos = np.char.upper(docnos)
-        if self.prefix:
-            docnos = np.char.add(self.prefix.encode(), docnos)
-        return docnos.astype('S')
+            docno = docno.upper()
+        return ((self.prefix or '') + docno).encode()
 
     def iterator(self, ctxt):
         mmp = ctxt
-        for i in range(mmp.shape[0]):
-            docno = mmp[i].tobytes().hex()
-            if self.upper:
-                docno = docno.upper()
-            if self.prefix:
-                docno = self.prefix.encode() + docno
-            yield docno
+        for start in range(0, mmp.shape[0], 4096):
+            batch = self.lookup(np.arange(start, min(start+4096, mmp.shape[0])), ctxt)
+            for docno in batch.tolist():
+                yield docno.decode()
 
     def __repr__(self):
         return f'{self.NAME} [prefix={self.prefix} length={self.length} upper={self.upper}]'
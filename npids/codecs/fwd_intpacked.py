@@ -0,0 +1,203 @@
+import re
+import struct
+from array import array
+import numpy as np
+from npids.utils import wrap_mmap, split_ids, format_ints, format_ints_heap, parse_ints, startswith, leading_count, slice_vectorized, pack_bits, unpack_bits, unpack_bits_one
+
+
+FOOTER_FORMAT = '<QBB' # base, bits, sorted
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+FENCE_STEP = 64
+PACK_SLACK_BITS = 4 # bits by which the values can widen the seeded range before the block ends
+
+
+def _bits(value_range):
+    bits = int(value_range).bit_length()
+    return 64 if bits > 57 else bits
+
+
+class PackedInts:
+    def __init__(self, data, count, base, bits, is_sorted):
+        self.data = data
+        self.count = count
+        self.base = base
+        self.bits = bits
+        self.sorted = is_sorted
+        self._fence = None
+        self._view = None
+
+    def __getitem__(self, idxs):
+        return unpack_bits(self.data, idxs, self.bits) + np.uint64(self.base)
+
+    def get(self, idx: int) -> int:
+        if self._view is None:
+            self._view = memoryview(self.data)
+        return unpack_bits_one(self._view, idx, self.bits) + self.base
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def fence(self):
+        # every FENCE_STEP-th value, kept in memory to narrow down binary searches
+        if self._fence is None:
+            self._fence = self[np.arange(0, self.count, FENCE_STEP)]
+        return self._fence
+
+    def searchsorted(self, values):
+        # np.searchsorted(self[:], values) for sorted values; binary searches a window of the fence
+        if self.count <= FENCE_STEP:
+            # a single window; decoding it in full is cheaper than the rounds of the binary search
+            return np.searchsorted(self[np.arange(self.count)], values)
+        lo = np.maximum(np.searchsorted(self.fence, values, 'left') - 1, 0) * FENCE_STEP
+        hi = np.minimum(lo + FENCE_STEP, self.count)
+        active = lo < hi
+        while active.any():
+            mid = (lo[active] + hi[active]) // 2
+            less = self[mid] < values[active]
+            lo[active] = np.where(less, mid + 1, lo[active])
+            hi[active] = np.where(less, hi[active], mid)
+            active = lo < hi
+        return lo
+
+    def searchsorted_one(self, value: int) -> int:
+        # searchsorted for a single value
+        lo = 0
+        if self.count > FENCE_STEP:
+            lo = max(int(np.searchsorted(self.fence, np.uint64(value), 'left')) - 1, 0) * FENCE_STEP
+        hi = min(lo + FENCE_STEP, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class FwdIntPacked:
+    """
+    Integers (with an optional prefix) stored as ``value - base`` in exactly as many bits as the range of
+    the block needs (frame of reference). Since the range is only known once the block is complete, the
+    values are buffered and packed by finish(), followed by the base, the number of bits, and whether
+    the values are sorted. Values that would widen the range by more than PACK_SLACK_BITS bits over the
+    seeded one end the block (rather than repacking all of its values more widely).
+    """
+    NAME = 'intpacked'
+    def __init__(self, prefix=None):
+        self.prefix_re = re.compile(r'[0-9]+$')
+        self.reset()
+        self.prefix = prefix
+
+    def seed(self, id):
+        match = self.prefix_re.search(id)
+        if not match:
+            return False
+        prefix = id[:match.span()[0]]
+        if self.prefix is None:
+            self.prefix = prefix
+        if self.prefix != prefix:
+            return False
+        number = int(match.group())
+        if self.prefix + str(number) != id or number.bit_length() > 64:
+            return False
+        self.seed_min = number if self.seed_min is None else min(self.seed_min, number)
+        self.seed_max = number if self.seed_max is None else max(self.seed_max, number)
+        return True
+
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted
+        if len(ids) == 0:
+            return True
+        prefixes, digits = split_ids(ids, 'int')
+        if self.prefix is None:
+            self.prefix = prefixes[0].decode()
+        numbers, valid = parse_ints(digits)
+        if not (valid.all() and (prefixes == self.prefix.encode()).all()):
+            return False
+        low, high = int(numbers.min()), int(numbers.max())
+        self.seed_min = low if self.seed_min is None else min(self.seed_min, low)
+        self.seed_max = high if self.seed_max is None else max(self.seed_max, high)
+        return True
+
+    def reset(self):
+        self.prefix = None
+        self.seed_min = None
+        self.seed_max = None
+        self.values = array('Q')
+        self.min = None
+        self.max = None
+
+    def config(self):
+        return {'prefix': self.prefix}
+
+    def size(self):
+        return _bits(self.seed_max - self.seed_min) / 8
+
+    def encode(self, id):
+        match = self.prefix_re.search(id)
+        if not match:
+            return None
+        prefix = id[:match.span()[0]]
+        if prefix != self.prefix:
+            return None
+        number = int(match.group())
+        if number.bit_length() > 64 or self.prefix + str(number) != id:
+            return None
+        lo = number if self.min is None else min(self.min, number)
+        hi = number if self.max is None else max(self.max, number)
+        if _bits(hi - lo) > self._max_bits():
+            return None
+        self.min, self.max = lo, hi
+        self.values.append(number)
+        return b''
+
+    def _max_bits(self):
+        if self.seed_min is None:
+            return 64
+        return _bits((self.seed_max - self.seed_min) << PACK_SLACK_BITS)
+
+    def encode_many(self, ids: np.array):
+        prefix = self.prefix.encode()
+        values, valid = parse_ints(slice_vectorized(ids, len(prefix)))
+        valid &= startswith(ids, prefix)
+        # running range of the block (values after the first invalid one do not matter)
+        lo, hi = np.minimum.accumulate(values), np.maximum.accumulate(values)
+        if self.min is not None:
+            lo, hi = np.minimum(lo, np.uint64(self.min)), np.maximum(hi, np.uint64(self.max))
+        max_bits = self._max_bits()
+        if max_bits < 64:
+            valid &= hi - lo < np.uint64(1 << max_bits)
+        count = leading_count(valid)
+        if count > 0:
+            self.min, self.max = int(lo[count-1]), int(hi[count-1])
+        self.values.frombytes(values[:count].tobytes())
+        return b'', count
+
+    def finish(self):
+        values = np.frombuffer(self.values, dtype=np.uint64)
+        base = int(values.min()) if len(values) else 0
+        bits = _bits(int(values.max()) - base) if len(values) else 0
+        is_sorted = bool((values[1:] > values[:-1]).all())
+        return pack_bits(values - np.uint64(base), bits) + struct.pack(FOOTER_FORMAT, base, bits, is_sorted)
+
+    def build_context(self, mmp, count):
+        base, bits, is_sorted = struct.unpack(FOOTER_FORMAT, mmp[len(mmp)-FOOTER_SIZE:])
+        return PackedInts(wrap_mmap(mmp[:len(mmp)-FOOTER_SIZE], np.uint8), count, base, bits, bool(is_sorted))
+
+    def lookup(self, idxs: np.array, ctxt) -> np.array:
+        return format_ints(ctxt[idxs], self.prefix.encode() if self.prefix else b'')
+
+    def lookup_heap(self, idxs: np.array, ctxt):
+        return format_ints_heap(ctxt[idxs], self.prefix.encode() if self.prefix else b'')
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        return f'{self.prefix or ""}{ctxt.get(idx)}'.encode()
+
+    def iterator(self, ctxt):
+        for start in range(0, len(ctxt), 4096):
+            for docno in self.lookup(np.arange(start, min(start + 4096, len(ctxt))), ctxt):
+                yield docno.decode()
+
+    def __repr__(self):
+        return f'{self.NAME} [prefix={self.prefix}]'
@@ -1,5 +1,7 @@
 import re
 import numpy as np
+from npids import codecs
+from npids.utils import format_ints, format_ints_heap, parse_ints, startswith, leading_count, slice_vectorized
 
 
 class FwdIntSequence:
@@ -62,16 +64,40 @@ class FwdIntSequence:
         self.encode_prev = number
         return b''
 
+    def encode_many(self, ids: np.array):
+        prefix = self.prefix.encode()
+        values, valid = parse_ints(slice_vectorized(ids, len(prefix)))
+        valid &= startswith(ids, prefix)
+        expected = self.start if self.encode_prev is None else self.encode_prev + 1
+        valid &= values == np.uint64(expected) + np.arange(len(ids), dtype=np.uint64)
+        count = leading_count(valid)
+        if count > 0:
+            self.encode_prev = int(values[count-1])
+        return b'', count
+
+    def upgrade(self):
+        # continues this block as an intsequencegaps block (only possible since nothing is stored)
+        if self.encode_prev is None:
+            return None
+        return codecs.fwd['intsequencegaps'].from_sequence(self.prefix, self.start, self.encode_prev - self.start + 1)
+
     def build_context(self, mmp, count):
         return count
 
     def lookup(self, idxs: np.array, ctxt) -> np.array:
-        docnos = idxs
+        docnos = idxs.astype(np.uint64)
         if self.start:
-            docnos = docnos + self.start
-        if self.prefix:
-            docnos = np.char.mod(f'{self.prefix}%i'.encode(), docnos)
-        return docnos.astype('S')
+            docnos += np.uint64(self.start)
+        return format_ints(docnos, self.prefix.encode() if self.prefix else b'')
+
+    def lookup_heap(self, idxs: np.array, ctxt):
+        docnos = idxs.astype(np.uint64)
+        if self.start:
+            docnos += np.uint64(self.start)
+        return format_ints_heap(docnos, self.prefix.encode() if self.prefix else b'')
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        return f'{self.prefix or ""}{idx + (self.start or 0)}'.encode()
 
     def iterator(self, ctxt):
         count = ctxt
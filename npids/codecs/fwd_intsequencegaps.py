@@ -0,0 +1,243 @@
+import re
+import struct
+from math import gcd
+from array import array
+import numpy as np
+from npids.utils import wrap_mmap, byte_matrix, row_lengths, split_ids, format_ints, format_ints_heap, parse_ints, startswith, leading_count, slice_vectorized, popcount64, bit_test, bit_rank, bit_select, bit_test_one, bit_rank_one, bit_select_one, RANK_BLOCK_WORDS
+
+
+MAX_GAP = 64 # maximum distance (in strides) between consecutive values
+
+
+class FwdIntSequenceGaps:
+    """
+    An increasing sequence of integers (with optional prefix and zero-padding) with a constant stride,
+    where some values of the sequence may be missing. A bitmap marks which values of the sequence are
+    present, so forward lookups are a select over the bitmap and inverse lookups a rank. The bitmap is
+    written as it is built; finish() appends a rank directory (the number of set bits before every
+    block of RANK_BLOCK_WORDS words) and the number of words.
+    """
+    NAME = 'intsequencegaps'
+    def __init__(self, prefix=None, start=None, stride=1, pad=0):
+        self.prefix_re = re.compile(r'[0-9]+$')
+        self.reset()
+        self.prefix = prefix
+        self.start = start
+        self.stride = stride
+        self.pad = pad
+
+    def seed(self, id):
+        match = self.prefix_re.search(id)
+        if not match:
+            return False
+        prefix = id[:match.span()[0]]
+        if self.prefix is None:
+            self.prefix = prefix
+        if self.prefix != prefix:
+            return False
+        digits = match.group()
+        number = int(digits)
+        if number.bit_length() > 64:
+            return False
+        if self.start is None:
+            self.start = number
+        else:
+            if number <= self.seed_prev:
+                return False
+            self.stride = gcd(self.stride, number - self.start) if self.seed_count > 1 else number - self.start
+            self.seed_max_diff = max(self.seed_max_diff, number - self.seed_prev)
+            if self.seed_max_diff > MAX_GAP * self.stride:
+                return False
+        # either zero-padded to a constant width or without leading zeros
+        self.seed_leading_zero = self.seed_leading_zero or (digits[0] == '0' and len(digits) > 1)
+        self.seed_lengths.add(len(digits))
+        if self.seed_leading_zero and len(self.seed_lengths) > 1:
+            return False
+        self.seed_prev = number
+        self.seed_count += 1
+        return True
+
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted. Since the checks of seed only get
+        # stricter as IDs are added (the stride only shrinks), they are done once all the ids are seeded.
+        if len(ids) > 0 and self.start is None:
+            if not self.seed(ids[0].decode()):
+                return False
+            ids = ids[1:]
+        if len(ids) == 0:
+            return True
+        prefixes, digits = split_ids(ids, 'int')
+        if not (prefixes == self.prefix.encode()).all():
+            return False
+        b = byte_matrix(digits)
+        lengths = row_lengths(b)
+        self.seed_lengths.update(np.unique(lengths).tolist())
+        self.seed_leading_zero = self.seed_leading_zero or bool(((lengths > 1) & (b[:, 0] == ord('0'))).any())
+        if self.seed_leading_zero and len(self.seed_lengths) > 1:
+            return False
+        # (zero-padded digits of a single width, or digits without leading zeros)
+        numbers, valid = parse_ints(digits, pad=next(iter(self.seed_lengths)) if self.seed_leading_zero else 0)
+        if not valid.all():
+            return False
+        prev = np.concatenate([np.array([self.seed_prev], dtype=np.uint64), numbers[:-1]])
+        if not (numbers > prev).all():
+            return False
+        self.stride = gcd(self.stride if self.seed_count > 1 else 0, int(np.gcd.reduce(numbers - np.uint64(self.start))))
+        self.seed_max_diff = max(self.seed_max_diff, int((numbers - prev).max()))
+        if self.seed_max_diff > MAX_GAP * self.stride:
+            return False
+        self.seed_prev = int(numbers[-1])
+        self.seed_count += len(ids)
+        return True
+
+    def reset(self):
+        self.prefix = None
+        self.start = None
+        self.stride = 1
+        self.pad = 0
+        self.seed_prev = None
+        self.seed_count = 0
+        self.seed_max_diff = 0
+        self.seed_leading_zero = False
+        self.seed_lengths = set()
+        self.last_pos = -1
+        self.word_index = 0
+        self.word = 0
+        self.total = 0
+        self.ranks = array('Q')
+        self.pending = b''
+
+    def config(self):
+        if self.seed_leading_zero:
+            self.pad = next(iter(self.seed_lengths))
+        return {'prefix': self.prefix, 'start': self.start, 'stride': self.stride, 'pad': self.pad}
+
+    def size(self):
+        positions = (self.seed_prev - self.start) // self.stride + 1
+        return positions * (1 / 8 + 8 / (64 * RANK_BLOCK_WORDS)) / self.seed_count
+
+    @staticmethod
+    def from_sequence(prefix, start, count, pad=0):
+        # a codec that has already encoded the count consecutive values from start (used to continue an
+        # intsequence block once a value is missing)
+        result = FwdIntSequenceGaps(prefix, start, 1, pad)
+        full_words = count // 64
+        result.pending = b'\xff' * 8 * full_words
+        result.ranks.extend(range(0, full_words * 64, 64 * RANK_BLOCK_WORDS))
+        result.total = full_words * 64
+        result.word_index = full_words
+        result.word = (1 << (count % 64)) - 1
+        result.last_pos = count - 1
+        return result
+
+    def _emit_words(self, words):
+        # emits the completed words (uint64 array) that follow self.word_index, updating the rank directory
+        counts = popcount64(words)
+        before = self.total + np.cumsum(counts) - counts
+        block_starts = (self.word_index + np.arange(len(words))) % RANK_BLOCK_WORDS == 0
+        self.ranks.frombytes(before[block_starts].astype(np.uint64).tobytes())
+        self.total += int(counts.sum())
+        self.word_index += len(words)
+        result = self.pending + words.astype('<u8').tobytes()
+        self.pending = b''
+        return result
+
+    def encode(self, id):
+        match = self.prefix_re.search(id)
+        if not match:
+            return None
+        prefix = id[:match.span()[0]]
+        if prefix != self.prefix:
+            return None
+        digits = match.group()
+        number = int(digits)
+        if number < self.start or (number - self.start) % self.stride != 0:
+            return None
+        if self.prefix + (format(number, f'0{self.pad}d') if self.pad else str(number)) != id:
+            return None
+        pos = (number - self.start) // self.stride
+        if pos <= self.last_pos or pos - self.last_pos > MAX_GAP:
+            return None
+        completed = []
+        while self.word_index + len(completed) < pos // 64:
+            completed.append(self.word)
+            self.word = 0
+        self.word |= 1 << (pos % 64)
+        self.last_pos = pos
+        return self._emit_words(np.array(completed, dtype=np.uint64))
+
+    def encode_many(self, ids: np.array):
+        prefix = self.prefix.encode()
+        values, valid = parse_ints(slice_vectorized(ids, len(prefix)), pad=self.pad)
+        valid &= startswith(ids, prefix)
+        valid &= values >= np.uint64(self.start)
+        offsets = values - np.uint64(self.start)
+        valid &= offsets % np.uint64(self.stride) == 0
+        pos = (offsets // np.uint64(self.stride)).astype(np.int64)
+        prev = np.concatenate([[self.last_pos], pos[:-1]])
+        valid &= (pos > prev) & (pos - prev <= MAX_GAP)
+        count = leading_count(valid)
+        if count == 0:
+            return b'', 0
+        pos = pos[:count]
+        words = np.zeros(pos[-1] // 64 - self.word_index + 1, dtype=np.uint64)
+        words[0] = self.word
+        np.bitwise_or.at(words, pos // 64 - self.word_index, np.uint64(1) << (pos % 64).astype(np.uint64))
+        self.word = int(words[-1])
+        self.last_pos = int(pos[-1])
+        return self._emit_words(words[:-1]), count
+
+    def finish(self):
+        words = self._emit_words(np.array([self.word], dtype=np.uint64))
+        return words + np.frombuffer(self.ranks, dtype=np.uint64).astype('<u8').tobytes() + struct.pack('<Q', self.word_index)
+
+    def build_context(self, mmp, count):
+        n_words, = struct.unpack('<Q', mmp[len(mmp)-8:])
+        words = wrap_mmap(mmp[:n_words*8], '<u8')
+        ranks = wrap_mmap(mmp[n_words*8:len(mmp)-8], '<u8')
+        return words, ranks
+
+    def lookup(self, idxs: np.array, ctxt) -> np.array:
+        words, ranks = ctxt
+        values = bit_select(words, ranks, idxs).astype(np.uint64) * np.uint64(self.stride) + np.uint64(self.start)
+        return format_ints(values, self.prefix.encode() if self.prefix else b'', self.pad)
+
+    def lookup_heap(self, idxs: np.array, ctxt):
+        words, ranks = ctxt
+        values = bit_select(words, ranks, idxs).astype(np.uint64) * np.uint64(self.stride) + np.uint64(self.start)
+        return format_ints_heap(values, self.prefix.encode() if self.prefix else b'', self.pad)
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        words, ranks = ctxt
+        value = bit_select_one(words, ranks, idx) * self.stride + self.start
+        return f'{self.prefix or ""}{value:0{self.pad}d}'.encode()
+
+    def rank(self, values: np.array, ctxt):
+        # indices of the values (uint64) in the block and whether they are present
+        words, ranks = ctxt
+        offsets = values - np.uint64(self.start) # values below start wrap around and fail the range check
+        valid = offsets % np.uint64(self.stride) == 0
+        pos = offsets // np.uint64(self.stride)
+        valid &= pos < np.uint64(len(words) * 64)
+        pos = np.where(valid, pos, 0).astype(np.int64)
+        valid &= bit_test(words, pos)
+        return bit_rank(words, ranks, pos), valid
+
+    def rank_one(self, value: int, ctxt):
+        # rank for a single value; None if it is not present
+        words, ranks = ctxt
+        offset = value - self.start
+        if offset < 0 or offset % self.stride != 0 or offset // self.stride >= len(words) * 64:
+            return None
+        pos = offset // self.stride
+        return bit_rank_one(words, ranks, pos) if bit_test_one(words, pos) else None
+
+    def iterator(self, ctxt):
+        words, ranks = ctxt
+        count = int(popcount64(words).sum())
+        for start in range(0, count, 4096):
+            for docno in self.lookup(np.arange(start, min(start + 4096, count)), ctxt):
+                yield docno.decode()
+
+    def __repr__(self):
+        return f'{self.NAME} [prefix={self.prefix} start={self.start} stride={self.stride} pad={self.pad}]'
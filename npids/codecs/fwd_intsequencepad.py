@@ -1,5 +1,7 @@
 import re
 import numpy as np
+from npids import codecs
+from npids.utils import format_ints, format_ints_heap, parse_ints, byte_matrix, row_lengths, startswith, leading_count, slice_vectorized
 
 
 class FwdIntSequencePad:
@@ -71,15 +73,41 @@ class FwdIntSequencePad:
         self.encode_prev = number
         return b''
 
+    def encode_many(self, ids: np.array):
+        prefix = self.prefix.encode()
+        digits = slice_vectorized(ids, len(prefix))
+        values, valid = parse_ints(digits, pad=self.pad)
+        valid &= startswith(ids, prefix) & (row_lengths(byte_matrix(digits)) == self.pad)
+        expected = self.start if self.encode_prev is None else self.encode_prev + 1
+        valid &= values == np.uint64(expected) + np.arange(len(ids), dtype=np.uint64)
+        count = leading_count(valid)
+        if count > 0:
+            self.encode_prev = int(values[count-1])
+        return b'', count
+
+    def upgrade(self):
+        # continues this block as an intsequencegaps block (only possible since nothing is stored)
+        if self.encode_prev is None:
+            return None
+        return codecs.fwd['intsequencegaps'].from_sequence(self.prefix, self.start, self.encode_prev - self.start + 1, self.pad)
+
     def build_context(self, mmp, count):
         return count
 
     def lookup(self, idxs: np.array, ctxt) -> np.array:
-        docnos = idxs
+        docnos = idxs.astype(np.uint64)
         if self.start:
-            docnos = docnos + self.start
-        docnos = np.char.mod(f'{self.prefix}%0{self.pad}d'.encode(), docnos)
-        return docnos.astype('S')
+            docnos += np.uint64(self.start)
+        return format_ints(docnos, self.prefix.encode() if self.prefix else b'', pad=self.pad)
+
+    def lookup_heap(self, idxs: np.array, ctxt):
+        docnos = idxs.astype(np.uint64)
+        if self.start:
+            docnos += np.uint64(self.start)
+        return format_ints_heap(docnos, self.prefix.encode() if self.prefix else b'', pad=self.pad)
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        return f'{self.prefix or ""}{idx + (self.start or 0):0{self.pad}d}'.encode()
 
     def iterator(self, ctxt):
         count = ctxt
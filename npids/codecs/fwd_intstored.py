@@ -1,6 +1,6 @@
 import re
 import numpy as np
-from npids.utils import wrap_mmap
+from npids.utils import wrap_mmap, split_ids, format_ints, format_ints_heap, parse_ints, startswith, leading_count, slice_vectorized
 
 
 class FwdIntStored:
@@ -35,6 +35,20 @@ class FwdIntStored:
             self.int_bytes = max(1, self.int_bytes or 0)
         return True
 
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted
+        if len(ids) == 0:
+            return True
+        prefixes, digits = split_ids(ids, 'int')
+        if self.prefix is None:
+            self.prefix = prefixes[0].decode()
+        numbers, valid = parse_ints(digits)
+        if not (valid.all() and (prefixes == self.prefix.encode()).all()):
+            return False
+        n_bytes = (int(numbers.max()).bit_length() + 7) // 8
+        self.int_bytes = max(next(b for b in (1, 2, 4, 8) if n_bytes <= b), self.int_bytes or 0)
+        return True
+
     def reset(self):
         self.prefix = None
         self.int_bytes = None
@@ -59,14 +73,27 @@ class FwdIntStored:
             return None
         return {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}[self.int_bytes](number).tobytes()
 
+    def encode_many(self, ids: np.array):
+        prefix = self.prefix.encode()
+        values, valid = parse_ints(slice_vectorized(ids, len(prefix)))
+        valid &= startswith(ids, prefix)
+        if self.int_bytes < 8:
+            valid &= values < np.uint64(1 << (self.int_bytes * 8))
+        count = leading_count(valid)
+        return values[:count].astype(f'u{self.int_bytes}').tobytes(), count
+
     def build_context(self, mmp, count):
         return wrap_mmap(mmp, f'u{self.int_bytes}')
 
     def lookup(self, idxs: np.array, ctxt) -> np.array:
         mmp = ctxt
-        fmt = f'{self.prefix}%i'.encode()
-        docnos = np.char.mod(fmt, mmp[idxs])
-        return docnos.astype('S')
+        return format_ints(mmp[idxs], self.prefix.encode() if self.prefix else b'')
+
+    def lookup_heap(self, idxs: np.array, ctxt):
+        return format_ints_heap(ctxt[idxs], self.prefix.encode() if self.prefix else b'')
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        return f'{self.prefix or ""}{int(ctxt[idx])}'.encode()
 
     def iterator(self, ctxt):
         mmp = ctxt
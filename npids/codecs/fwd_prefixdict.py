@@ -0,0 +1,228 @@
+import re
+import json
+import struct
+import numpy as np
+from npids.utils import wrap_mmap, byte_matrix, row_lengths, leading_count, parse_ints, parse_int, format_ints, format_ints_heap, gather_heap, heap_from_rows, heap_join, heap_offsets, split_ids, split_id
+
+
+MAX_PREFIXES = 256 # prefix ids are stored in a single byte
+MIN_PREFIX_ROWS = 16 # minimum mean number of seeded IDs per prefix (otherwise the prefixes are not a small set)
+INT_RE = re.compile(rb'[0-9]+$')
+BYTES_RE = re.compile(rb'[^0-9]*')
+
+
+class FwdPrefixDict:
+    """
+    IDs drawn from a small set of prefixes (e.g., ``AP880212-0001``, ``WSJ870101-0001``, ``FT911-1``), where
+    the common prefix of the block would be (nearly) empty. Each ID is stored as a one-byte id into a
+    dictionary of up to MAX_PREFIXES prefixes, followed by the remainder: either an integer (``int`` mode,
+    the prefix being everything before the trailing digits) or fixed-width bytes (``bytes`` mode, the prefix
+    being everything before the first digit). New prefixes can be added to the dictionary while encoding,
+    so the dictionary is written by finish(), as JSON followed by its length.
+    """
+    NAME = 'prefixdict'
+    def __init__(self, mode=None, width=None):
+        self.reset()
+        self.mode = mode
+        self.width = width
+        if mode is not None:
+            self._compile()
+
+    def seed(self, id):
+        id = id.encode()
+        if self.seed_int_prefixes is not None:
+            match = INT_RE.search(id)
+            number = int(match.group()) if match else None
+            if number is None or str(number).encode() != match.group() or number.bit_length() > 64:
+                self.seed_int_prefixes = None
+            else:
+                self.seed_int_prefixes.add(id[:match.start()])
+                self.seed_int_max = max(self.seed_int_max, number)
+                if len(self.seed_int_prefixes) > MAX_PREFIXES:
+                    self.seed_int_prefixes = None
+        if self.seed_bytes_prefixes is not None:
+            prefix = BYTES_RE.match(id).group()
+            self.seed_bytes_prefixes.add(prefix)
+            self.seed_bytes_width = max(self.seed_bytes_width, len(id) - len(prefix))
+            if len(self.seed_bytes_prefixes) > MAX_PREFIXES:
+                self.seed_bytes_prefixes = None
+        self.seed_count += 1
+        return self.seed_int_prefixes is not None or self.seed_bytes_prefixes is not None
+
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted
+        if len(ids) == 0:
+            return True
+        if self.seed_int_prefixes is not None:
+            prefixes, rests = split_ids(ids, 'int')
+            numbers, valid = parse_ints(rests)
+            if not valid.all():
+                self.seed_int_prefixes = None
+            else:
+                self.seed_int_prefixes.update(np.unique(prefixes).tolist())
+                self.seed_int_max = max(self.seed_int_max, int(numbers.max()))
+                if len(self.seed_int_prefixes) > MAX_PREFIXES:
+                    self.seed_int_prefixes = None
+        if self.seed_bytes_prefixes is not None:
+            prefixes, rests = split_ids(ids, 'bytes')
+            self.seed_bytes_prefixes.update(np.unique(prefixes).tolist())
+            self.seed_bytes_width = max(self.seed_bytes_width, int(row_lengths(byte_matrix(rests)).max()))
+            if len(self.seed_bytes_prefixes) > MAX_PREFIXES:
+                self.seed_bytes_prefixes = None
+        self.seed_count += len(ids)
+        return self.seed_int_prefixes is not None or self.seed_bytes_prefixes is not None
+
+    def reset(self):
+        self.mode = None
+        self.width = None
+        self.seed_int_prefixes = set()
+        self.seed_int_max = 0
+        self.seed_bytes_prefixes = set()
+        self.seed_bytes_width = 0
+        self.seed_count = 0
+        self.prefixes = []
+        self.prefix_ids = {}
+
+    def _layout(self):
+        # the (mode, width) that stores the seeded IDs in the fewest bytes
+        # (None if neither split gives a small set of prefixes; a single prefix is better left to other codecs)
+        options = []
+        if self._small_set(self.seed_int_prefixes):
+            options.append(('int', 4 if self.seed_int_max <= 0xFFFFFFFF else 8))
+        if self._small_set(self.seed_bytes_prefixes):
+            options.append(('bytes', max(self.seed_bytes_width, 1)))
+        return min(options, key=lambda o: o[1], default=None)
+
+    def _small_set(self, prefixes):
+        return prefixes is not None and 1 < len(prefixes) <= self.seed_count / MIN_PREFIX_ROWS
+
+    def size(self):
+        layout = self._layout()
+        return float('inf') if layout is None else 1 + layout[1]
+
+    def config(self):
+        self.mode, self.width = self._layout()
+        self._compile()
+        return {'mode': self.mode, 'width': self.width}
+
+    def _compile(self):
+        rest = f'<u{self.width}' if self.mode == 'int' else f'S{self.width}'
+        self.dtype = np.dtype([('prefix', 'u1'), ('rest', rest)])
+
+    def _prefix_id(self, prefix: bytes):
+        if prefix not in self.prefix_ids:
+            if len(self.prefixes) == MAX_PREFIXES:
+                return None
+            self.prefix_ids[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+        return self.prefix_ids[prefix]
+
+    def encode(self, id):
+        id = id.encode()
+        if self.mode == 'int':
+            match = INT_RE.search(id)
+            if not match:
+                return None
+            rest = int(match.group())
+            if str(rest).encode() != match.group() or rest.bit_length() > 8 * self.width:
+                return None
+            prefix = id[:match.start()]
+        else:
+            prefix = BYTES_RE.match(id).group()
+            rest = id[len(prefix):]
+            if len(rest) > self.width:
+                return None
+        prefix_id = self._prefix_id(prefix)
+        if prefix_id is None:
+            return None
+        return np.array([(prefix_id, rest)], dtype=self.dtype).tobytes()
+
+    def encode_many(self, ids: np.array):
+        # vectorized encode of an S array; returns the encoding of the leading ids that fit and their count
+        prefixes, rests, valid = self.parse(ids)
+        # new prefixes are added to the dictionary in order of first appearance, until it is full
+        uniques, first = np.unique(prefixes[:leading_count(valid)], return_index=True)
+        new = [(i, p) for i, p in sorted(zip(first.tolist(), uniques.tolist())) if p not in self.prefix_ids]
+        if len(self.prefixes) + len(new) > MAX_PREFIXES:
+            valid[new[MAX_PREFIXES - len(self.prefixes)][0]:] = False
+        count = leading_count(valid)
+        for i, prefix in new:
+            if i < count:
+                self._prefix_id(prefix)
+        records = np.empty(count, dtype=self.dtype)
+        records['prefix'] = self._prefix_ids(prefixes[:count])
+        records['rest'] = rests[:count]
+        return records.tobytes(), count
+
+    def parse(self, ids: np.array):
+        # vectorized split of an S array into (prefixes, remainders, valid), the remainders being uint64
+        # values in int mode
+        prefixes, rests = split_ids(ids, self.mode)
+        if self.mode == 'int':
+            rests, valid = parse_ints(rests)
+            if self.width < 8:
+                valid &= rests < np.uint64(1 << (8 * self.width))
+        else:
+            valid = row_lengths(byte_matrix(rests)) <= self.width
+            rests = rests.astype(f'S{self.width}')
+        return prefixes, rests, valid
+
+    def parse_one(self, id: bytes):
+        # parse for a single ID; (prefix, remainder) or None if it is not valid
+        prefix, rest = split_id(id, self.mode)
+        if self.mode == 'int':
+            rest = parse_int(rest)
+            if rest is None or rest >> (8 * self.width) != 0:
+                return None
+        elif len(rest) > self.width:
+            return None
+        return prefix, rest
+
+    def _prefix_ids(self, prefixes: np.array):
+        # ids of prefixes that are all in the dictionary
+        width = max([prefixes.dtype.itemsize] + [len(p) for p in self.prefixes])
+        table = np.array(self.prefixes, dtype=f'S{width}')
+        order = np.argsort(table)
+        return order[np.searchsorted(table[order], prefixes.astype(f'S{width}'))]
+
+    def finish(self):
+        prefixes = json.dumps([p.decode() for p in self.prefixes]).encode()
+        return prefixes + struct.pack('<I', len(prefixes))
+
+    def build_context(self, mmp, count):
+        length, = struct.unpack('<I', mmp[len(mmp)-4:])
+        self.prefixes = [p.encode() for p in json.loads(bytes(mmp[len(mmp)-4-length:len(mmp)-4]))]
+        self.prefix_ids = {p: i for i, p in enumerate(self.prefixes)}
+        table = np.array(self.prefixes, dtype=f'S{max(max(map(len, self.prefixes), default=1), 1)}')
+        return wrap_mmap(mmp[:count*self.dtype.itemsize], self.dtype), table
+
+    def lookup(self, idxs: np.array, ctxt) -> np.array:
+        records, table = ctxt
+        records = records[idxs]
+        rests = format_ints(records['rest'].astype(np.uint64)) if self.mode == 'int' else records['rest']
+        return np.char.add(table[records['prefix']], rests)
+
+    def lookup_heap(self, idxs: np.array, ctxt):
+        records, table = ctxt
+        records = records[idxs]
+        # the prefixes are gathered from the dictionary laid out as a heap
+        lengths = np.array([len(p) for p in self.prefixes], dtype=np.int64)
+        table_heap = np.frombuffer(b''.join(self.prefixes), dtype=np.uint8)
+        prefix_ids = records['prefix'].astype(np.int64)
+        prefixes = gather_heap(table_heap, heap_offsets(lengths)[prefix_ids], lengths[prefix_ids])
+        rests = format_ints_heap(records['rest']) if self.mode == 'int' else heap_from_rows(byte_matrix(records['rest']))
+        return heap_join([prefixes, rests])
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        records, _ = ctxt
+        prefix, rest = records[idx].item()
+        return self.prefixes[prefix] + (b'%d' % rest if self.mode == 'int' else rest)
+
+    def iterator(self, ctxt):
+        records, table = ctxt
+        for start in range(0, len(records), 4096):
+            for docno in self.lookup(np.arange(start, min(start + 4096, len(records))), ctxt):
+                yield docno.decode()
+
+    def __repr__(self):
+        return f'{self.NAME} [mode={self.mode} width={self.width} prefixes={len(self.prefixes)}]'
@@ -0,0 +1,317 @@
+import re
+import numpy as np
+from npids.utils import wrap_mmap, byte_matrix, row_lengths, leading_count, format_ints
+
+
+MAX_FIELD_DIGITS = 19 # 10**19 < 2**64
+RECORD_BYTES = (1, 2, 4, 8)
+TOKEN_RE = re.compile(r'[0-9]+|[^0-9]+')
+DIGITS = '0123456789'
+
+
+def _record_bytes(radix):
+    # None if the records do not fit in 64 bits
+    return next((b for b in RECORD_BYTES if radix <= 1 << (8 * b)), None)
+
+
+def _radix(template):
+    radix = 1
+    for part in template:
+        if not isinstance(part, str):
+            radix *= 10 ** part[0]
+    return radix
+
+
+class FwdTemplate:
+    """
+    IDs that follow a template of literal text and integer fields, like ``clueweb09-en0000-00-00000``.
+    Each field is either zero-padded to a fixed number of digits (``[digits, True]``) or written
+    without leading zeros with up to ``digits`` digits (``[digits, False]``). The fields of an ID are
+    combined into a single mixed-radix record (the first field being the most significant), stored in
+    1, 2, 4, or 8 bytes. Fields that are constant while seeding are folded into the literal text when
+    keeping them would need a larger record. A trailing byte indicates whether the records are sorted,
+    in which case the template inverse can binary search them.
+    """
+    NAME = 'template'
+    def __init__(self, template=None):
+        self.reset()
+        self.template = template
+        if template is not None:
+            self._compile()
+
+    def seed(self, id):
+        tokens = TOKEN_RE.findall(id)
+        if self.tokens is None:
+            self.tokens = [({'literal': t} if t[0] not in DIGITS else {'min_len': len(t), 'max_len': len(t), 'value': t, 'leading_zero': False}) for t in tokens]
+        if len(tokens) != len(self.tokens):
+            return False
+        for token, stats in zip(tokens, self.tokens):
+            if 'literal' in stats:
+                if token != stats['literal']:
+                    return False
+            else:
+                if token[0] not in DIGITS or len(token) > MAX_FIELD_DIGITS:
+                    return False
+                before = stats['max_len'] if stats['value'] is None else 0
+                stats['min_len'] = min(stats['min_len'], len(token))
+                stats['max_len'] = max(stats['max_len'], len(token))
+                stats['leading_zero'] = stats['leading_zero'] or (len(token) > 1 and token[0] == '0')
+                if stats['value'] != token:
+                    stats['value'] = None
+                if stats['leading_zero'] and stats['min_len'] != stats['max_len']:
+                    return False # neither padded nor canonical
+                # only the digits of the fields that vary count towards the radix (constant ones can be folded)
+                self.variable_digits += (stats['max_len'] if stats['value'] is None else 0) - before
+        # same as _layout() being None: 10**19 < 2**64 < 10**20
+        return self.variable_digits <= MAX_FIELD_DIGITS
+
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted. Since the checks of seed only get
+        # stricter as IDs are added, this is the same as checking the statistics once all the ids are seeded.
+        if len(ids) > 0 and self.tokens is None:
+            if not self.seed(ids[0].decode()):
+                return False
+            ids = ids[1:]
+        if len(ids) == 0:
+            return True
+        b = byte_matrix(ids)
+        lengths = row_lengths(b)
+        cols = np.arange(b.shape[1])
+        in_row = cols < lengths[:, None]
+        is_digit = (b >= ord('0')) & (b <= ord('9')) & in_row
+        # tokens start at the first byte and wherever the bytes switch between digits and non-digits
+        token_starts = in_row.copy()
+        token_starts[:, 1:] &= is_digit[:, 1:] != is_digit[:, :-1]
+        if (token_starts.sum(axis=1) != len(self.tokens)).any():
+            return False
+        if len(self.tokens) == 0:
+            return True
+        if (is_digit[:, 0] != ('literal' not in self.tokens[0])).any():
+            return False # (tokens alternate, so the first one fixes the kind of all of them)
+        starts = np.nonzero(token_starts)[1].reshape(len(ids), len(self.tokens))
+        token_lengths = np.diff(np.concatenate([starts, lengths[:, None]], axis=1), axis=1)
+        heap = b.reshape(-1)
+        row_starts = np.arange(len(ids)) * b.shape[1]
+        def equal(k, token):
+            # whether token k of each id is token
+            token = np.frombuffer(token.encode(), dtype=np.uint8)
+            result = token_lengths[:, k] == len(token)
+            pos = np.minimum(row_starts[:, None] + starts[:, k:k+1] + np.arange(len(token)), len(heap) - 1)
+            return result & (heap[pos] == token).all(axis=1)
+        for k, stats in enumerate(self.tokens):
+            if 'literal' in stats:
+                if not equal(k, stats['literal']).all():
+                    return False
+                continue
+            if token_lengths[:, k].max() > MAX_FIELD_DIGITS:
+                return False
+            before = stats['max_len'] if stats['value'] is None else 0
+            stats['min_len'] = min(stats['min_len'], int(token_lengths[:, k].min()))
+            stats['max_len'] = max(stats['max_len'], int(token_lengths[:, k].max()))
+            stats['leading_zero'] = stats['leading_zero'] or bool(((token_lengths[:, k] > 1) & (heap[row_starts + starts[:, k]] == ord('0'))).any())
+            if stats['value'] is not None and not equal(k, stats['value']).all():
+                stats['value'] = None
+            if stats['leading_zero'] and stats['min_len'] != stats['max_len']:
+                return False
+            self.variable_digits += (stats['max_len'] if stats['value'] is None else 0) - before
+        return self.variable_digits <= MAX_FIELD_DIGITS
+
+    def reset(self):
+        self.template = None
+        self.tokens = None
+        self.variable_digits = 0
+        self.prev = 0
+        self.sorted = True
+
+    def _layout(self):
+        # builds the template from the seeding statistics (None if the records do not fit in 64 bits)
+        radix = 1
+        for stats in self.tokens:
+            if 'literal' not in stats and stats['value'] is None:
+                radix *= 10 ** stats['max_len']
+        if radix > 1 << 64:
+            return None
+        template = []
+        for stats in self.tokens:
+            if 'literal' in stats:
+                part = stats['literal']
+            elif stats['value'] is not None and _record_bytes(radix * 10 ** stats['max_len']) != _record_bytes(radix):
+                part = stats['value']
+            else:
+                if stats['value'] is not None:
+                    radix *= 10 ** stats['max_len']
+                part = [stats['max_len'], stats['min_len'] == stats['max_len']]
+            if isinstance(part, str) and template and isinstance(template[-1], str):
+                template[-1] += part
+            else:
+                template.append(part)
+        return template
+
+    def size(self):
+        return _record_bytes(_radix(self._layout()))
+
+    def config(self):
+        self.template = self._layout()
+        self._compile()
+        return {'template': self.template}
+
+    def _compile(self):
+        pattern = ''
+        self.radices = []
+        self.fixed_literals = [] # (offset, literal) of the literals that are not preceded by a variable-width field
+        offset = 0
+        for part in self.template:
+            if isinstance(part, str):
+                pattern += re.escape(part)
+                if offset is not None:
+                    self.fixed_literals.append((offset, part.encode()))
+                    offset += len(part.encode())
+            else:
+                digits, pad = part
+                pattern += f'([0-9]{{{digits}}})' if pad else f'(0|[1-9][0-9]{{0,{digits-1}}})'
+                self.radices.append(10 ** digits)
+                offset = offset + digits if pad and offset is not None else None
+        self.pattern = re.compile(pattern)
+        self.pattern_bytes = re.compile(pattern.encode())
+        self.record_bytes = _record_bytes(_radix(self.template))
+
+    def encode(self, id):
+        match = self.pattern.fullmatch(id)
+        if not match:
+            return None
+        record = 0
+        for value, radix in zip(match.groups(), self.radices):
+            record = record * radix + int(value)
+        self.sorted = self.sorted and record >= self.prev
+        self.prev = record
+        return record.to_bytes(self.record_bytes, 'little')
+
+    def parse_one(self, id: bytes):
+        # parse for a single ID; None if it does not match the template
+        match = self.pattern_bytes.fullmatch(id)
+        if not match:
+            return None
+        record = 0
+        for value, radix in zip(match.groups(), self.radices):
+            record = record * radix + int(value)
+        return record
+
+    def matches_literals(self, ids: np.array):
+        # quick filter of an S array: whether the literals at fixed offsets match (parse does a full match)
+        b = byte_matrix(ids)
+        result = np.ones(len(ids), dtype=bool)
+        for offset, literal in self.fixed_literals:
+            if offset + len(literal) > b.shape[1]:
+                return np.zeros(len(ids), dtype=bool)
+            result &= (b[:, offset:offset+len(literal)] == np.frombuffer(literal, dtype=np.uint8)).all(axis=1)
+        return result
+
+    def parse(self, ids: np.array):
+        # vectorized fullmatch of an S array against the template; returns (records, valid)
+        b = byte_matrix(ids)
+        lengths = row_lengths(b)
+        cursor = np.zeros(len(ids), dtype=np.int64)
+        valid = np.ones(len(ids), dtype=bool)
+        records = np.zeros(len(ids), dtype=np.uint64)
+        rows = np.arange(len(ids))[:, None]
+        def window(k):
+            # the k bytes at each cursor (NUL past the end)
+            cols = cursor[:, None] + np.arange(k)
+            if b.shape[1] == 0:
+                return np.zeros(cols.shape, dtype=np.uint8)
+            return np.where(cols < b.shape[1], b[rows, np.minimum(cols, b.shape[1] - 1)], 0)
+        for part in self.template:
+            if isinstance(part, str):
+                literal = np.frombuffer(part.encode(), dtype=np.uint8)
+                valid &= (window(len(literal)) == literal).all(axis=1)
+                cursor += len(literal)
+                continue
+            digits, pad = part
+            w = window(digits if pad else digits + 1)
+            is_digit = (w >= ord('0')) & (w <= ord('9'))
+            if pad:
+                run = np.where(is_digit.all(axis=1), digits, 0)
+            else:
+                run = np.where(is_digit.all(axis=1), digits + 1, is_digit.argmin(axis=1))
+                valid &= (run >= 1) & (run <= digits) & ((run == 1) | (w[:, 0] != ord('0')))
+            valid &= run > 0
+            value = np.zeros(len(ids), dtype=np.uint64)
+            for col in range(w.shape[1]):
+                active = col < run
+                value = np.where(active, value * np.uint64(10) + (w[:, col] - ord('0')).astype(np.uint64), value)
+            records = records * np.uint64(10 ** digits) + np.where(valid, value, 0)
+            cursor += run
+        valid &= cursor == lengths
+        records[~valid] = 0
+        return records, valid
+
+    def encode_many(self, ids: np.array):
+        # vectorized encode of an S array; returns the encoding of the leading ids that fit and their count
+        records, valid = self.parse(ids)
+        count = leading_count(valid)
+        records = records[:count]
+        if count > 0:
+            self.sorted = self.sorted and int(records[0]) >= self.prev and bool((records[1:] >= records[:-1]).all())
+            self.prev = int(records[-1])
+        return records.astype(f'<u{self.record_bytes}').tobytes(), count
+
+    def finish(self):
+        return bytes([int(self.sorted)])
+
+    def build_context(self, mmp, count):
+        n_bytes = count * self.record_bytes
+        records = wrap_mmap(mmp[:n_bytes], f'<u{self.record_bytes}')
+        return records, bool(mmp[n_bytes])
+
+    def lookup(self, idxs: np.array, ctxt) -> np.array:
+        records, _ = ctxt
+        records = records[idxs].astype(np.uint64)
+        values = []
+        for radix in reversed(self.radices):
+            values.append(records % np.uint64(radix))
+            records = records // np.uint64(radix)
+        values.reverse()
+        pieces = []
+        for part in self.template:
+            if isinstance(part, str):
+                pieces.append(np.full(len(idxs), part.encode(), dtype=f'S{max(len(part.encode()), 1)}'))
+            else:
+                digits, pad = part
+                pieces.append(format_ints(values.pop(0), pad=digits if pad else 0))
+        width = sum(p.dtype.itemsize for p in pieces)
+        result = np.zeros((len(idxs), max(width, 1)), dtype=np.uint8)
+        rows = np.arange(len(idxs))
+        cursor = np.zeros(len(idxs), dtype=np.int64)
+        for piece in pieces:
+            b = byte_matrix(piece)
+            piece_lengths = row_lengths(b)
+            for col in range(b.shape[1]):
+                active = col < piece_lengths
+                result[rows[active], cursor[active] + col] = b[active, col]
+            cursor += piece_lengths
+        return result.view(f'S{result.shape[1]}').reshape(len(idxs))
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        records, _ = ctxt
+        record = int(records[idx])
+        values = []
+        for radix in reversed(self.radices):
+            record, value = divmod(record, radix)
+            values.append(value)
+        pieces = []
+        for part in self.template:
+            if isinstance(part, str):
+                pieces.append(part)
+            else:
+                digits, pad = part
+                pieces.append(f'{values.pop():0{digits if pad else 0}d}')
+        return ''.join(pieces).encode()
+
+    def iterator(self, ctxt):
+        records, _ = ctxt
+        for start in range(0, len(records), 4096):
+            for docno in self.lookup(np.arange(start, min(start + 4096, len(records))), ctxt):
+                yield docno.decode()
+
+    def __repr__(self):
+        return f'{self.NAME} [template={self.template}]'
@@ -1,12 +1,11 @@
 import re
 import uuid
 import numpy as np
-from npids.utils import wrap_mmap
+from npids.utils import wrap_mmap, byte_matrix, hexlify, unhexlify, row_lengths, startswith, leading_count
 
-def _coerce_bytes(b):
-    if hasattr(b, 'tobytes'):
-        return b.tobytes()
-    return b
+# columns of the 36-character UUID string that hold hex digits (the rest are dashes)
+_DASH_COLS = np.array([8, 13, 18, 23])
+_HEX_COLS = np.array([i for i in range(36) if i not in _DASH_COLS])
 
 class FwdUuid:
     NAME = 'uuid'
@@ -15,7 +14,6 @@ class FwdUuid:
         self.prefix = prefix
         self.lc_re = re.compile(r'^[0-9a-f]{8}\b-[0-9a-f]{4}\b-[0-9a-f]{4}\b-[0-9a-f]{4}\b-[0-9a-f]{12}$')
         self.uc_re = re.compile(r'^[0-9A-F]{8}\b-[0-9A-F]{4}\b-[0-9A-F]{4}\b-[0-9A-F]{4}\b-[0-9A-F]{12}$')
-        self.vuuid = np.vectorize(lambda x: str(uuid.UUID(bytes=_coerce_bytes(x))).encode())
 
     def seed(self, id):
         if self.prefix is None:
@@ -26,6 +24,15 @@ class FwdUuid:
             return False
         return self.encode(id) is not None
 
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted (once the first id has set
+        # the layout, seed accepts exactly the ids that encode does)
+        if len(ids) > 0 and self.prefix is None:
+            if not self.seed(ids[0].decode()):
+                return False
+            ids = ids[1:]
+        return len(ids) == 0 or self.encode_many(ids)[1] == len(ids)
+
     def reset(self):
         self.upper = None
         self.prefix = None
@@ -37,7 +44,7 @@ class FwdUuid:
         return {'upper': self.upper, 'prefix': self.prefix}
 
     def encode(self, id):
-        if not id.startswith(self.prefix):
+        if not id.startswith(self.prefix) or len(id) != len(self.prefix) + 36:
             return None
         id = id[-36:]
         r = self.uc_re if self.upper else self.lc_re
@@ -45,17 +52,36 @@ class FwdUuid:
             return None
         return uuid.UUID(id).bytes
 
+    def encode_many(self, ids: np.array):
+        prefix = self.prefix.encode()
+        if ids.dtype.itemsize < len(prefix) + 36:
+            return b'', 0
+        b = byte_matrix(ids)
+        body = b[:, len(prefix):len(prefix)+36]
+        data, valid = unhexlify(body[:, _HEX_COLS], self.upper)
+        valid &= startswith(ids, prefix) & (row_lengths(b) == len(prefix) + 36)
+        valid &= (body[:, _DASH_COLS] == ord('-')).all(axis=1)
+        count = leading_count(valid)
+        return data[:count].tobytes(), count
+
     def build_context(self, mmp, count):
         return wrap_mmap(mmp, 'V16')
 
     def lookup(self, idxs: np.array, ctxt) -> np.array:
         mmp = ctxt
-        docnos = self.vuuid(mmp[idxs])
+        prefix = self.prefix.encode() if self.prefix else b''
+        result = np.empty((len(idxs), len(prefix) + 36), dtype=np.uint8)
+        result[:, :len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+        body = result[:, len(prefix):]
+        body[:] = ord('-')
+        body[:, _HEX_COLS] = hexlify(byte_matrix(mmp[idxs]), self.upper)
+        return result.view(f'S{result.shape[1]}').reshape(len(idxs))
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        docno = str(uuid.UUID(bytes=ctxt[idx].tobytes()))
         if self.upper:
-            docnos = np.char.upper(docnos)
-        if self.prefix:
-            docnos = np.char.add(self.prefix, docnos)
-        return docnos.astype('S')
+            docno = docno.upper()
+        return ((self.prefix or '') + docno).encode()
 
     def iterator(self, ctxt):
         mmp = ctxt
@@ -0,0 +1,105 @@
+from array import array
+import numpy as np
+from npids.utils import wrap_mmap, byte_matrix, row_lengths, common_prefix, startswith, leading_count, slice_vectorized, gather_rows, gather_heap, prefixed
+
+
+OFFSET_BYTES = 4
+
+
+class FwdVarBytes:
+    """
+    IDs sharing a prefix, with the remainders stored back to back in a heap. Since the number of IDs is
+    only known once the block is complete, the offsets of the IDs in the heap are written after it by
+    finish(), followed by a single byte with the width of each offset (4 or 8).
+    """
+    NAME = 'varbytes'
+    def __init__(self, prefix=None):
+        self.prefix = (prefix.encode() if prefix is not None else None)
+        self.seed_count = 0
+        self.seed_bytes = 0
+        self.lengths = array('Q')
+
+    def seed(self, id):
+        id = id.encode()
+        if self.prefix is None:
+            self.prefix = id
+        while not id.startswith(self.prefix):
+            self.prefix = self.prefix[:-1]
+        self.seed_count += 1
+        self.seed_bytes += len(id)
+        return True
+
+    def seed_many(self, ids: np.array):
+        # vectorized seed of an S array; whether all the ids are accepted
+        if len(ids) == 0:
+            return True
+        self.prefix = common_prefix(ids, self.prefix)
+        self.seed_count += len(ids)
+        self.seed_bytes += int(row_lengths(byte_matrix(ids)).sum())
+        return True
+
+    def reset(self):
+        self.prefix = None
+        self.seed_count = 0
+        self.seed_bytes = 0
+        self.lengths = array('Q')
+
+    def size(self):
+        return self.seed_bytes / max(self.seed_count, 1) - len(self.prefix) + OFFSET_BYTES
+
+    def config(self):
+        return {'prefix': self.prefix.decode()}
+
+    def encode(self, id):
+        id = id.encode()
+        if not id.startswith(self.prefix):
+            return None
+        id = id[len(self.prefix):]
+        self.lengths.append(len(id))
+        return id
+
+    def encode_many(self, ids: np.array):
+        # vectorized encode of an S array; returns the encoding of the leading ids that fit and their count
+        count = leading_count(startswith(ids, self.prefix))
+        b = byte_matrix(slice_vectorized(ids[:count], len(self.prefix)))
+        lengths = row_lengths(b)
+        self.lengths.frombytes(lengths.astype(np.uint64).tobytes())
+        return b[np.arange(b.shape[1]) < lengths[:, None]].tobytes(), count
+
+    def finish(self):
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.uint64)
+        np.cumsum(np.frombuffer(self.lengths, dtype=np.uint64), out=offsets[1:])
+        width = OFFSET_BYTES if offsets[-1] <= np.iinfo(f'<u{OFFSET_BYTES}').max else 8
+        return offsets.astype(f'<u{width}').tobytes() + bytes([width])
+
+    def build_context(self, mmp, count):
+        width = mmp[len(mmp) - 1]
+        offsets_start = len(mmp) - 1 - (count + 1) * width
+        offsets = wrap_mmap(mmp[offsets_start:len(mmp)-1], f'<u{width}')
+        heap = wrap_mmap(mmp[:offsets_start], np.uint8)
+        return heap, offsets
+
+    def lookup(self, idxs: np.array, ctxt) -> np.array:
+        heap, offsets = ctxt
+        starts = offsets[idxs]
+        lengths = (offsets[idxs + 1] - starts).astype(np.int64)
+        return prefixed(self.prefix, gather_rows(heap, starts, lengths))
+
+    def lookup_heap(self, idxs: np.array, ctxt):
+        heap, offsets = ctxt
+        starts = offsets[idxs]
+        lengths = (offsets[idxs + 1] - starts).astype(np.int64)
+        return gather_heap(heap, starts.astype(np.int64), lengths, self.prefix)
+
+    def lookup_one(self, idx: int, ctxt) -> bytes:
+        heap, offsets = ctxt
+        docno = heap[int(offsets[idx]):int(offsets[idx+1])].tobytes()
+        return self.prefix + docno if self.prefix else docno
+
+    def iterator(self, ctxt):
+        heap, offsets = ctxt
+        for i in range(len(offsets) - 1):
+            yield (self.prefix + heap[offsets[i]:offsets[i+1]].tobytes()).decode()
+
+    def __repr__(self):
+        return f'{self.NAME} [prefix={self.prefix}]'
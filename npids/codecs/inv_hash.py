@@ -1,4 +1,8 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+from npids.utils import byte_matrix
 
 
 def chunked(it, n):
@@ -24,55 +28,410 @@ def fnv1_32(batch):
     return hashes
 
 
+def fnv1a_64(batch):
+    basis, prime = np.uint64(14695981039346656037), np.uint64(1099511628211)
+    hashes = np.full(batch.shape, basis, dtype=np.uint64)
+    batch = byte_matrix(batch)
+    for i in range(batch.shape[1]):
+        mask = batch[:, i] != 0
+        np.bitwise_xor(hashes, batch[:, i], out=hashes, where=mask)
+        np.multiply(hashes, prime, out=hashes, where=mask)
+    return hashes
+
+
+def mix64(hashes):
+    # splitmix64 finalizer; spreads the entropy of every input bit across the output
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+LANE64_SEED = 0x243f6a8885a308d3
+LANE64_MUL = 0xff51afd7ed558ccd
+
+
+def lane64(batch):
+    # Processes each ID in 8-byte lanes and only visits the lanes a row actually uses, so a single
+    # long ID in a batch does not make every other row pay for its padding. (Trailing NUL padding is
+    # not part of an ID, so it is safe to treat rows as zero-padded to a multiple of 8 bytes.)
+    b = byte_matrix(batch)
+    n, width = b.shape
+    if width % 8 != 0:
+        padded = np.zeros((n, width + 8 - width % 8), dtype=np.uint8)
+        padded[:, :width] = b
+        b = padded
+    lanes = b.view('<u8')
+    row_lanes = np.zeros(n, dtype=np.intp)
+    for i in range(lanes.shape[1]):
+        row_lanes[lanes[:, i] != 0] = i + 1
+    hashes = np.full(n, LANE64_SEED, dtype=np.uint64)
+    for i in range(int(row_lanes.max()) if n else 0):
+        rows = row_lanes > i
+        n_rows = np.count_nonzero(rows)
+        if n_rows == n:
+            hashes = _lane64_step(hashes, lanes[:, i])
+        elif n_rows * 4 >= n:
+            # most rows still active: cheaper to compute everything and select than to gather
+            hashes = np.where(rows, _lane64_step(hashes, lanes[:, i]), hashes)
+        else:
+            rows = np.flatnonzero(rows)
+            hashes[rows] = _lane64_step(hashes[rows], lanes[rows, i])
+    return mix64(hashes)
+
+
+def _lane64_step(hashes, lane):
+    hashes = (hashes ^ lane) * np.uint64(LANE64_MUL)
+    hashes ^= hashes >> np.uint64(29)
+    return hashes
+
+
+HASH_FNS = {
+    'fnv1_32': fnv1_32,
+    'fnv1a_64': fnv1a_64,
+    'lane64': lane64,
+}
+
+MASK64 = 0xffffffffffffffff
+
+
+# scalar versions of the hash functions (plain Python ints), for lookups of a single ID
+
+def fnv1_32_one(docno: bytes):
+    h = 2166136261
+    for c in docno:
+        if c:
+            h = ((h ^ c) * 16777619) & 0xffffffff
+    return h
+
+
+def fnv1a_64_one(docno: bytes):
+    h = 14695981039346656037
+    for c in docno:
+        if c:
+            h = ((h ^ c) * 1099511628211) & MASK64
+    return h
+
+
+def mix64_one(h: int):
+    h ^= h >> 30
+    h = (h * 0xbf58476d1ce4e5b9) & MASK64
+    h ^= h >> 27
+    h = (h * 0x94d049bb133111eb) & MASK64
+    return h ^ (h >> 31)
+
+
+def lane64_one(docno: bytes):
+    h = LANE64_SEED
+    docno = docno.rstrip(b'\0')
+    docno += bytes(-len(docno) % 8)
+    for start in range(0, len(docno), 8):
+        h = ((h ^ int.from_bytes(docno[start:start+8], 'little')) * LANE64_MUL) & MASK64
+        h ^= h >> 29
+    return mix64_one(h)
+
+
+HASH_FNS_ONE = {
+    'fnv1_32': fnv1_32_one,
+    'fnv1a_64': fnv1a_64_one,
+    'lane64': lane64_one,
+}
+
+
+MAX_HASH_BITS = 32 # buckets are selected by the low bits of the hash (fnv1_32 only has 32)
+MIN_HASH_BITS = 8 # default for small lookups (including empty ones), where the table is tiny anyway
+
+
+def default_hash_bits(count):
+    # about one ID per bucket, between MIN_HASH_BITS and MAX_HASH_BITS (beyond 2**32 IDs, buckets hold several IDs)
+    return min(max((count - 1).bit_length(), MIN_HASH_BITS), MAX_HASH_BITS)
+
+
+def build_config(count, hash_bits=None, fingerprint_bits=0, hash_fn='lane64'):
+    # the config of an inverse over count IDs, filling in the defaults
+    if hash_bits is None:
+        hash_bits = default_hash_bits(count)
+    assert 0 <= hash_bits <= MAX_HASH_BITS, f"hash_bits must be between 0 and {MAX_HASH_BITS}"
+    assert fingerprint_bits in (0, 8, 16), "fingerprint_bits must be 0, 8, or 16"
+    config = {
+        'format': 'hash',
+        'hash_bits': hash_bits,
+        'hash_fn': hash_fn,
+    }
+    if fingerprint_bits:
+        config['fingerprint_bits'] = fingerprint_bits
+    if count > 0xFFFFFFFF:
+        config['index_bytes'] = 8
+    return config
+
+
+def fingerprint(hashes, fingerprint_bits):
+    # a second hash used to reject most non-matching bucket entries without a forward lookup
+    dtype = {8: np.uint8, 16: np.uint16}[fingerprint_bits]
+    return (mix64(hashes.astype(np.uint64)) >> np.uint64(64 - fingerprint_bits)).astype(dtype)
+
+
 class InvHash:
     NAME = 'hash'
-    def __init__(self, hash_offsets, dids, hash_bits, hash_fn='fnv1_32'):
+    def __init__(self, hash_offsets, dids, hash_bits, hash_fn='fnv1_32', fingerprints=None, fingerprint_bits=0):
         self.hash_offsets = hash_offsets
         self.dids = dids
         self.hash_bits = hash_bits
         self.hash_mask = (1 << hash_bits) - 1
         self.fwd = None
         self.hash_fn = hash_fn
+        self.fingerprints = fingerprints
+        self.fingerprint_bits = fingerprint_bits
 
     def _lookup(self, docnos: np.array) -> np.array:
-        hashes = fnv1_32(docnos) & self.hash_mask
-        pos, end = self.hash_offsets[hashes], self.hash_offsets[hashes+1]
+        hashes = HASH_FNS[self.hash_fn](docnos)
+        buckets = (hashes & np.uint64(self.hash_mask)).astype(np.int64)
+        pos, end = self.hash_offsets[buckets], self.hash_offsets[buckets+1]
+        if self.fingerprints is not None:
+            fps = fingerprint(hashes, self.fingerprint_bits)
         result = np.full(docnos.shape, -1, dtype=np.int64)
         todo = pos < end
         while todo.any():
-            cands = self.fwd.lookup(self.dids[pos[todo]], as_bytes=True)
-            matches = cands == docnos[todo]
+            check = todo.copy()
+            if self.fingerprints is not None:
+                check[todo] = self.fingerprints[pos[todo]] == fps[todo]
             mask = np.zeros_like(todo)
-            mask[todo] = matches
+            if check.any():
+                cands = self.fwd._lookup(self.dids[pos[check]])
+                mask[check] = cands == docnos[check]
             result[mask] = self.dids[pos[mask]]
-            todo[todo] = ~matches
+            todo &= ~mask
             pos[todo] += 1
             todo[todo] = pos[todo] < end[todo]
         return result
 
+    def _lookup_one(self, docno: bytes) -> int:
+        h = HASH_FNS_ONE[self.hash_fn](docno)
+        bucket = h & self.hash_mask
+        fp = mix64_one(h) >> (64 - self.fingerprint_bits) if self.fingerprints is not None else None
+        for pos in range(int(self.hash_offsets[bucket]), int(self.hash_offsets[bucket+1])):
+            if fp is not None and int(self.fingerprints[pos]) != fp:
+                continue
+            did = int(self.dids[pos])
+            if self.fwd.lookup_one(did) == docno:
+                return did
+        return -1
+
     @staticmethod
-    def build(fwd, writer):
-        num_buckets_bits = (len(fwd) - 1).bit_length()
-        num_buckets = 1 << num_buckets_bits
-        hash_mask = num_buckets - 1
-        buckets = np.empty(len(fwd), dtype=np.uint32)
-        for start_idx in range(0, len(fwd), 10_000):
-            end_idx = min(start_idx+10_000, len(fwd))
-            batch = fwd.lookup(np.arange(start_idx, end_idx), as_bytes=True)
-            hashes = fnv1_32(batch)
-            buckets[start_idx:end_idx] = hashes & hash_mask
-        bucket_counts = np.zeros(num_buckets, dtype=np.uint32)
-        idxs, counts = np.unique(buckets, return_counts=True)
-        bucket_counts[idxs] = counts.astype(np.uint32)
-        bucket_offsets = np.cumsum(bucket_counts).astype(np.uint32)
-        writer.write_header(1, len(fwd), {
-            'format': 'hash',
-            'hash_bits': num_buckets_bits,
-            'hash_fn': 'fnv1_32',
-        })
-        writer.write(np.array([0], dtype=np.uint32).tobytes())
+    def estimate_size(fwd, hash_bits=None, fingerprint_bits=0):
+        if hash_bits is None:
+            hash_bits = default_hash_bits(len(fwd))
+        index_bytes = 8 if len(fwd) > 0xFFFFFFFF else 4
+        return ((1 << hash_bits) + 1) * index_bytes + len(fwd) * (index_bytes + fingerprint_bits // 8)
+
+    @staticmethod
+    def build(fwd, writer, hash_bits=None, fingerprint_bits=0, hash_fn='lane64', workers=None, memory_budget=None):
+        config = build_config(len(fwd), hash_bits, fingerprint_bits, hash_fn)
+        hash_bits = config['hash_bits']
+        if memory_budget is not None:
+            return _build_external(fwd, writer, config, memory_budget, workers)
+        if workers is not None and workers > 1:
+            return _build_parallel(fwd, writer, config, workers)
+        num_buckets = 1 << hash_bits
+        hash_mask = np.uint64(num_buckets - 1)
+        index_dtype = _index_dtype(config)
+        hashes = hash_all(fwd, hash_fn)
+        buckets = (hashes & hash_mask).astype(np.int64)
+        bucket_offsets = np.cumsum(np.bincount(buckets, minlength=num_buckets)).astype(index_dtype)
+        writer.write_header(1, len(fwd), config)
+        writer.write(np.array([0], dtype=index_dtype).tobytes())
         writer.write(bucket_offsets.tobytes())
-        writer.write(np.argsort(buckets).astype(np.uint32).tobytes())
+        dids = np.argsort(buckets, kind='stable').astype(index_dtype)
+        writer.write(dids.tobytes())
+        if fingerprint_bits:
+            writer.write(fingerprint(hashes[dids], fingerprint_bits).tobytes())
 
     def __repr__(self):
+        if self.fingerprint_bits:
+            return f'{self.NAME} [hash_bits={self.hash_bits} fingerprint_bits={self.fingerprint_bits}]'
         return f'{self.NAME} [hash_bits={self.hash_bits}]'
+
+
+def hash_all(fwd, hash_fn, workers=None, tmp_dir=None):
+    # hashes every ID in fwd; with workers, disjoint ranges are hashed in a process pool (each reading
+    # the same lookup file) into a temporary memmap in tmp_dir
+    if workers is None or workers <= 1:
+        hashes = np.empty(len(fwd), dtype=np.uint64)
+        start_idx = 0
+        for batch in fwd.iter_batches(as_bytes=True):
+            hashes[start_idx:start_idx+len(batch)] = HASH_FNS[hash_fn](batch)
+            start_idx += len(batch)
+        return hashes
+    hashes_path = os.path.join(tmp_dir, 'hashes')
+    np.memmap(hashes_path, dtype=np.uint64, mode='w+', shape=(max(len(fwd), 1),)).flush()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_hash_range, *zip(*[(fwd.path, hash_fn, hashes_path, start, end) for start, end in _ranges(len(fwd), workers)])))
+    return np.memmap(hashes_path, dtype=np.uint64, mode='r', shape=(max(len(fwd), 1),))[:len(fwd)]
+
+
+def _index_dtype(config):
+    return np.dtype(f"u{config.get('index_bytes', 4)}")
+
+
+def _ranges(count, n):
+    bounds = np.linspace(0, count, n + 1).astype(np.int64)
+    return [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:]) if s < e]
+
+
+def _hash_range(path, hash_fn, hashes_path, start, end):
+    from npids import Lookup
+    with Lookup(path) as lookup:
+        hashes = np.memmap(hashes_path, dtype=np.uint64, mode='r+', offset=start * 8, shape=(end - start,))
+        for i in range(start, end, 2**16):
+            batch = lookup.fwd.lookup(np.arange(i, min(i + 2**16, end)), as_bytes=True)
+            hashes[i-start:i-start+len(batch)] = HASH_FNS[hash_fn](batch)
+        hashes.flush()
+
+
+BASES_CHUNK = 2**20 # buckets whose per-worker bases are computed at a time
+
+
+def _build_parallel(fwd, writer, config, workers):
+    # Parallel counting sort: each worker hashes and counts a disjoint range of indices. Those counts
+    # give every worker a private starting offset within each bucket, so the workers can then scatter
+    # their indices directly into the output file without any further coordination. The counts (and
+    # then the offsets) of each worker are a row of a temporary memmap, so that neither the workers nor
+    # the parent hold a dense array per worker.
+    num_buckets = 1 << config['hash_bits']
+    index_dtype = _index_dtype(config)
+    ranges = _ranges(len(fwd), workers)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(fwd.path))) as tmp_dir:
+        hash_all(fwd, config['hash_fn'], workers, tmp_dir)
+        hashes_path = os.path.join(tmp_dir, 'hashes')
+        bases_path = os.path.join(tmp_dir, 'bases')
+        bases = np.memmap(bases_path, dtype=index_dtype, mode='w+', shape=(max(len(ranges), 1), num_buckets))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_count_range, *zip(*[(hashes_path, bases_path, config, row, start, end) for row, (start, end) in enumerate(ranges)])))
+            writer.write_header(1, len(fwd), config)
+            writer.write(np.array([0], dtype=index_dtype).tobytes())
+            # counts -> offsets, a chunk of buckets at a time: each worker's offset within a bucket is the start
+            # of the bucket plus the counts of the workers before it
+            bucket_start = 0
+            for chunk_start in range(0, num_buckets, BASES_CHUNK):
+                counts = bases[:, chunk_start:chunk_start+BASES_CHUNK].astype(np.int64)
+                total = counts.sum(axis=0)
+                bucket_ends = bucket_start + np.cumsum(total)
+                writer.write(bucket_ends.astype(index_dtype).tobytes())
+                bases[:, chunk_start:chunk_start+BASES_CHUNK] = bucket_ends - total + np.cumsum(counts, axis=0) - counts
+                bucket_start = int(bucket_ends[-1])
+            bases.flush()
+            del bases
+            dids_pos = writer.reserve(len(fwd) * index_dtype.itemsize + len(fwd) * config.get('fingerprint_bits', 0) // 8)
+            writer.flush()
+            list(pool.map(_scatter_range, *zip(*[(hashes_path, bases_path, config, row, start, end, writer.path, dids_pos, len(fwd)) for row, (start, end) in enumerate(ranges)])))
+
+
+def _count_range(hashes_path, bases_path, config, row, start, end):
+    # counts of the range's buckets, written (sparsely) to its row of bases
+    hashes = np.memmap(hashes_path, dtype=np.uint64, mode='r', offset=start * 8, shape=(end - start,))
+    buckets = (hashes & np.uint64((1 << config['hash_bits']) - 1)).astype(np.int64)
+    index_dtype = _index_dtype(config)
+    num_buckets = 1 << config['hash_bits']
+    counts = np.memmap(bases_path, dtype=index_dtype, mode='r+', offset=row * num_buckets * index_dtype.itemsize, shape=(num_buckets,))
+    uniques, unique_counts = np.unique(buckets, return_counts=True)
+    counts[uniques] = unique_counts
+    counts.flush()
+
+
+def _scatter_range(hashes_path, bases_path, config, row, start, end, path, dids_pos, count):
+    hashes = np.memmap(hashes_path, dtype=np.uint64, mode='r', offset=start * 8, shape=(end - start,))
+    buckets = (hashes & np.uint64((1 << config['hash_bits']) - 1)).astype(np.int64)
+    order = np.argsort(buckets, kind='stable')
+    sorted_buckets = buckets[order]
+    rank_in_bucket = np.arange(len(order)) - np.searchsorted(sorted_buckets, sorted_buckets, 'left')
+    index_dtype = _index_dtype(config)
+    num_buckets = 1 << config['hash_bits']
+    base = np.memmap(bases_path, dtype=index_dtype, mode='r', offset=row * num_buckets * index_dtype.itemsize, shape=(num_buckets,))
+    pos = base[sorted_buckets].astype(np.int64) + rank_in_bucket
+    dids = np.memmap(path, dtype=index_dtype, mode='r+', offset=dids_pos, shape=(count,))
+    dids[pos] = order + start
+    dids.flush()
+    if config.get('fingerprint_bits'):
+        fp_dtype = {8: np.uint8, 16: np.uint16}[config['fingerprint_bits']]
+        fps = np.memmap(path, dtype=fp_dtype, mode='r+', offset=dids_pos + count * index_dtype.itemsize, shape=(count,))
+        fps[pos] = fingerprint(hashes[order], config['fingerprint_bits'])
+        fps.flush()
+
+
+# bytes of working memory per ID while partitioning (hash, index, partition, sort order) and while
+# sorting a partition (hash, index, bucket, sort order, output)
+EXTERNAL_PARTITION_BYTES = 32
+EXTERNAL_SORT_BYTES = 40
+
+
+def _build_external(fwd, writer, config, memory_budget, workers=None):
+    # Out-of-core counting sort, for when the hashes of the whole collection do not fit in memory_budget
+    # bytes. Buckets are split into 2**k partitions of contiguous bucket ranges (the top k bits of each
+    # bucket), sized so that a single partition can be sorted within the budget. A first pass hashes the
+    # IDs in batches and appends each batch, grouped by partition, as a run of (hash, index) pairs in
+    # temporary files. A second pass gathers each partition from the runs, sorts it by bucket and
+    # writes its slice of the offsets, dids, and fingerprints directly to their final position in the
+    # output file. Indices are visited in order, so the result is identical to the in-memory build.
+    count = len(fwd)
+    hash_bits = config['hash_bits']
+    index_dtype = _index_dtype(config)
+    fp_bits = config.get('fingerprint_bits', 0)
+    batch_size = max(memory_budget // EXTERNAL_PARTITION_BYTES, 1024)
+    partition_bits = 0
+    while partition_bits < hash_bits and (count >> partition_bits) * EXTERNAL_SORT_BYTES > memory_budget:
+        partition_bits += 1
+    bucket_shift = hash_bits - partition_bits
+    buckets_per_partition = 1 << bucket_shift
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(writer.path))) as tmp_dir:
+        if workers is not None and workers > 1:
+            all_hashes = hash_all(fwd, config['hash_fn'], workers, tmp_dir)
+            batches = (all_hashes[i:i+batch_size] for i in range(0, count, batch_size))
+        else:
+            batches = (HASH_FNS[config['hash_fn']](batch) for batch in fwd.iter_batches(batch_size, as_bytes=True))
+
+        # pass 1: write runs of (hash, index) pairs, grouped by partition within each run
+        run_counts = []
+        start_idx = 0
+        with open(os.path.join(tmp_dir, 'run_hashes'), 'wb') as f_hashes, open(os.path.join(tmp_dir, 'run_idxs'), 'wb') as f_idxs:
+            for hashes in batches:
+                partitions = ((hashes & np.uint64((1 << hash_bits) - 1)) >> np.uint64(bucket_shift)).astype(np.int64)
+                order = np.argsort(partitions, kind='stable')
+                f_hashes.write(hashes[order].tobytes())
+                f_idxs.write((order + start_idx).astype(index_dtype).tobytes())
+                run_counts.append(np.bincount(partitions, minlength=1 << partition_bits))
+                start_idx += len(hashes)
+        run_counts = np.array(run_counts, dtype=np.int64).reshape(-1, 1 << partition_bits)
+        run_starts = np.cumsum(run_counts, axis=1) - run_counts + (np.cumsum(run_counts.sum(axis=1)) - run_counts.sum(axis=1))[:, None]
+        if count:
+            run_hashes = np.memmap(os.path.join(tmp_dir, 'run_hashes'), dtype=np.uint64, mode='r', shape=(count,))
+            run_idxs = np.memmap(os.path.join(tmp_dir, 'run_idxs'), dtype=index_dtype, mode='r', shape=(count,))
+
+        # pass 2: sort each partition by bucket and write it out in place
+        writer.write_header(1, count, config)
+        offsets_pos = writer.reserve(((1 << hash_bits) + 1) * index_dtype.itemsize)
+        dids_pos = writer.reserve(count * index_dtype.itemsize)
+        fps_pos = writer.reserve(count * fp_bits // 8)
+        end_pos = writer.tell()
+        base = 0
+        for partition in range(1 << partition_bits):
+            starts, counts = run_starts[:, partition], run_counts[:, partition]
+            hashes = np.concatenate([run_hashes[s:s+c] for s, c in zip(starts, counts)] + [np.empty(0, dtype=np.uint64)])
+            idxs = np.concatenate([run_idxs[s:s+c] for s, c in zip(starts, counts)] + [np.empty(0, dtype=index_dtype)])
+            buckets = (hashes & np.uint64(buckets_per_partition - 1)).astype(np.int64)
+            offsets = base + np.cumsum(np.bincount(buckets, minlength=buckets_per_partition))
+            if partition == 0:
+                offsets = np.concatenate([[0], offsets])
+                writer.seek(offsets_pos)
+            else:
+                writer.seek(offsets_pos + (partition * buckets_per_partition + 1) * index_dtype.itemsize)
+            writer.write(offsets.astype(index_dtype).tobytes())
+            order = np.argsort(buckets, kind='stable')
+            writer.seek(dids_pos + base * index_dtype.itemsize)
+            writer.write(idxs[order].tobytes())
+            if fp_bits:
+                writer.seek(fps_pos + base * fp_bits // 8)
+                writer.write(fingerprint(hashes[order], fp_bits).tobytes())
+            base += len(hashes)
+        writer.seek(end_pos)
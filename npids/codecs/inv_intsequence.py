@@ -1,17 +1,6 @@
 import numpy as np
 from npids import codecs
-
-
-def slice_vectorized(a, start):
-    b = a.view('S1').reshape(len(a), -1)[:, start:]
-    return np.ascontiguousarray(b).view(f'S{b.shape[1]}').reshape(len(a))
-
-
-def isnumeric(a):
-    # much faster than np.char.isnumeric because it doesn't need to be converted to unicode
-    b = a.view(np.uint8).reshape(len(a), -1)
-    mask = (b >= 48) & (b <= 57) | (b == 0) # 48=0, 57=9, 0=NUL
-    return mask.all(axis=1)
+from npids.utils import slice_vectorized, parse_ints, parse_int
 
 
 class InvIntSequence:
@@ -23,22 +12,26 @@ class InvIntSequence:
         self.fwd = None
 
     def _lookup(self, docnos: np.array) -> np.array:
-        result = np.full(docnos.shape, -1)
+        result = np.full(docnos.shape, -1, dtype=np.int64)
         if self.prefix:
             mask = docnos.astype(f'S{len(self.prefix)}') == self.prefix
             docnos = slice_vectorized(docnos, len(self.prefix))
-            mask = mask & isnumeric(docnos)
         else:
-            mask = isnumeric(docnos)
-
-        result[mask] = docnos[mask].astype(int)
-        if self.start:
-            result[mask] -= self.start
-        invalid_mask = (result < 0) | (result >= self.count)
-        if invalid_mask.any():
-            result[invalid_mask] = -1
+            mask = np.ones(docnos.shape, dtype=bool)
+        values, valid = parse_ints(docnos)
+        values -= np.uint64(self.start or 0) # values below start wrap around and fail the range check
+        mask &= valid & (values < np.uint64(self.count))
+        result[mask] = values[mask]
         return result
 
+    def _lookup_one(self, docno: bytes) -> int:
+        if not docno.startswith(self.prefix):
+            return -1
+        value = parse_int(docno[len(self.prefix):])
+        if value is None or not 0 <= value - (self.start or 0) < self.count:
+            return -1
+        return value - (self.start or 0)
+
     @staticmethod
     def build(fwd, writer):
         assert len(fwd.codecs) == 1 and isinstance(fwd.codecs[0].fmt, codecs.fwd['intsequence'])
@@ -49,5 +42,10 @@ class InvIntSequence:
             'count': len(fwd),
         })
 
+    @staticmethod
+    def condition(fwd):
+        # must be a single intsequence fwd
+        return len(fwd.codecs) == 1 and isinstance(fwd.codecs[0].fmt, codecs.fwd['intsequence'])
+
     def __repr__(self):
         return f'{self.NAME} [prefix={self.prefix} start={self.start}]'
@@ -1,17 +1,6 @@
 import numpy as np
 from npids import codecs
-
-
-def slice_vectorized(a, start):
-    b = a.view('S1').reshape(len(a), -1)[:, start:]
-    return np.ascontiguousarray(b).view(f'S{b.shape[1]}').reshape(len(a))
-
-
-def isnumeric(a):
-    # much faster than np.char.isnumeric because it doesn't need to be converted to unicode
-    b = a.view(np.uint8).reshape(len(a), -1)
-    mask = (b >= 48) & (b <= 57) | (b == 0) # 48=0, 57=9, 0=NUL
-    return mask.all(axis=1)
+from npids.utils import parse_ints, parse_int, split_ids, split_id, group_by
 
 
 class InvIntSequenceMulti:
@@ -19,34 +8,90 @@ class InvIntSequenceMulti:
     def __init__(self, count):
         self.count = count
         self.fwd = None
+        self._routes = None
+
+    @property
+    def routes(self):
+        # the blocks of each prefix and padding, as (pad, lows, highs, blocks, disjoint), with the blocks sorted
+        # by their first value when their ranges are disjoint, and in file order (so that duplicated IDs resolve
+        # to their first occurrence) otherwise; resolved on first use, since the blocks are only known once fwd
+        # is set
+        if self._routes is None:
+            groups = {}
+            for codec, offset in zip(self.fwd.codecs, self.fwd.offsets):
+                start = codec.fmt.start or 0
+                if isinstance(codec.fmt, codecs.fwd['intsequencegaps']):
+                    words, _ = codec.ctxt
+                    end = start + (len(words) * 64 - 1) * codec.fmt.stride
+                else:
+                    end = start + codec.count - 1
+                prefix = codec.fmt.prefix.encode() if codec.fmt.prefix else b''
+                groups.setdefault(prefix, {}).setdefault(getattr(codec.fmt, 'pad', 0), []).append((start, end, codec, offset))
+            self._routes = {}
+            for prefix, pads in groups.items():
+                self._routes[prefix] = []
+                for pad, blocks in pads.items():
+                    ranked = sorted(blocks, key=lambda b: b[0])
+                    lows = np.array([b[0] for b in ranked], dtype=np.uint64)
+                    highs = np.array([b[1] for b in ranked], dtype=np.uint64)
+                    disjoint = bool((lows[1:] > highs[:-1]).all())
+                    self._routes[prefix].append((pad, lows, highs, [b[2:] for b in (ranked if disjoint else blocks)], disjoint))
+        return self._routes
 
     def _lookup(self, docnos: np.array) -> np.array:
-        result = np.full(docnos.shape, -1)
-        mask = result != -1
-        for codec, offset in zip(self.fwd.codecs, self.fwd.offsets):
-            if codec.fmt.prefix:
-              this_mask = (docnos.astype(f'S{len(codec.fmt.prefix.encode())}') == codec.fmt.prefix.encode()) & ~mask
-            else:
-              this_mask = ~mask
-            if this_mask.any():
-                if codec.fmt.prefix:
-                  target_nums = slice_vectorized(docnos[this_mask], len(codec.fmt.prefix.encode()))
+        # IDs are grouped by prefix and routed to the block whose range of values covers them
+        result = np.full(docnos.shape, -1, dtype=np.int64)
+        prefixes, digits = split_ids(docnos, 'int')
+        for prefix, rows in group_by(prefixes):
+            for pad, lows, highs, blocks, disjoint in self.routes.get(bytes(prefix), []):
+                rows = rows[result[rows] == -1]
+                values, valid = parse_ints(digits[rows], pad=pad)
+                these_rows, values = rows[valid], values[valid]
+                if disjoint:
+                    which = np.searchsorted(lows, values, 'right') - 1
+                    covered = (which >= 0) & (values <= highs[np.maximum(which, 0)])
+                    these_rows, values, which = these_rows[covered], values[covered], which[covered]
+                    for block, positions in group_by(which):
+                        self._find(*blocks[block], these_rows[positions], values[positions], result)
                 else:
-                  target_nums = docnos[this_mask]
-                this_mask_2 = isnumeric(target_nums)
-                idxs = target_nums[this_mask_2].astype(int)
-                this_mask_3 = (idxs >= 0) & (idxs < codec.count)
-                idxs = idxs[this_mask_3]
-                if codec.fmt.start:
-                    idxs -= codec.fmt.start
-                this_mask[this_mask] = this_mask_2
-                this_mask[this_mask] = this_mask_3
-                result[this_mask] = idxs + offset
-                mask[this_mask] = True
-                if mask.all():
-                    break
+                    for codec, offset in blocks:
+                        todo = result[these_rows] == -1
+                        self._find(codec, offset, these_rows[todo], values[todo], result)
         return result
 
+    def _lookup_one(self, docno: bytes) -> int:
+        prefix, digits = split_id(docno, 'int')
+        for pad, lows, highs, blocks, disjoint in self.routes.get(prefix, []):
+            value = parse_int(digits, pad=pad)
+            if value is None:
+                continue
+            if disjoint:
+                which = int(np.searchsorted(lows, np.uint64(value), 'right')) - 1
+                blocks = blocks[which:which+1] if which >= 0 and value <= int(highs[which]) else []
+            for codec, offset in blocks:
+                index = self._find_one(codec, value)
+                if index is not None:
+                    return index + offset
+        return -1
+
+    @staticmethod
+    def _find_one(codec, value):
+        # _find for a single value; None if it is not in the block
+        if isinstance(codec.fmt, codecs.fwd['intsequencegaps']):
+            return codec.fmt.rank_one(value, codec.ctxt)
+        index = value - (codec.fmt.start or 0)
+        return index if 0 <= index < codec.count else None
+
+    @staticmethod
+    def _find(codec, offset, rows, values, result):
+        # computes the index of values in a block, setting result[rows] for the ones that are present
+        if isinstance(codec.fmt, codecs.fwd['intsequencegaps']):
+            indexes, valid = codec.fmt.rank(values, codec.ctxt)
+        else:
+            indexes = values - np.uint64(codec.fmt.start or 0) # values below start wrap around and fail the range check
+            valid = indexes < np.uint64(codec.count)
+        result[rows[valid]] = indexes[valid].astype(np.int64) + offset
+
     @staticmethod
     def build(fwd, writer):
         writer.write_header(1, len(fwd), {
@@ -56,8 +101,8 @@ class InvIntSequenceMulti:
 
     @staticmethod
     def condition(fwd):
-        # all fwds must be intsequence or intsequencepad
-        return all(isinstance(c.fmt, (codecs.fwd['intsequence'], codecs.fwd['intsequencepad'])) for c in fwd.codecs)
+        # all fwds must be intsequence, intsequencepad, or intsequencegaps
+        return all(isinstance(c.fmt, (codecs.fwd['intsequence'], codecs.fwd['intsequencepad'], codecs.fwd['intsequencegaps'])) for c in fwd.codecs)
 
     def __repr__(self):
         return f'{self.NAME}'
@@ -1,17 +1,7 @@
 import numpy as np
 from npids import codecs
-
-
-def slice_vectorized(a, start):
-    b = a.view('S1').reshape(len(a), -1)[:, start:]
-    return np.ascontiguousarray(b).view(f'S{b.shape[1]}').reshape(len(a))
-
-
-def isnumeric(a):
-    # much faster than np.char.isnumeric because it doesn't need to be converted to unicode
-    b = a.view(np.uint8).reshape(len(a), -1)
-    mask = (b >= 48) & (b <= 57) | (b == 0) # 48=0, 57=9, 0=NUL
-    return mask.all(axis=1)
+from npids.utils import parse_ints, parse_int, split_ids, split_id, group_by
+from .fwd_intpacked import PackedInts
 
 
 class InvIntStored:
@@ -19,38 +9,96 @@ class InvIntStored:
     def __init__(self, count):
         self.count = count
         self.fwd = None
+        self._routes = None
+
+    @property
+    def routes(self):
+        # the blocks of each prefix, as (lows, highs, blocks, disjoint). When their ranges of values are disjoint,
+        # the blocks are sorted by their smallest value (to route each ID to its block); otherwise they are kept in
+        # file order, which they are searched in so that duplicated IDs resolve to their first occurrence.
+        # Resolved on first use, since the blocks are only known once fwd is set.
+        if self._routes is None:
+            groups = {}
+            for codec, offset in zip(self.fwd.codecs, self.fwd.offsets):
+                if codec.count == 0:
+                    continue
+                bounds = codec.ctxt[np.array([0, codec.count - 1])]
+                prefix = codec.fmt.prefix.encode() if codec.fmt.prefix else b''
+                groups.setdefault(prefix, []).append((int(bounds[0]), int(bounds[1]), codec, offset))
+            self._routes = {}
+            for prefix, blocks in groups.items():
+                ranked = sorted(blocks, key=lambda b: b[0])
+                lows = np.array([b[0] for b in ranked], dtype=np.uint64)
+                highs = np.array([b[1] for b in ranked], dtype=np.uint64)
+                disjoint = bool((lows[1:] > highs[:-1]).all())
+                self._routes[prefix] = (lows, highs, [b[2:] for b in (ranked if disjoint else blocks)], disjoint)
+        return self._routes
 
     def _lookup(self, docnos: np.array) -> np.array:
-        result = np.full(docnos.shape, -1)
-        mask = result != -1
-        for codec, offset in zip(self.fwd.codecs, self.fwd.offsets):
-            if codec.fmt.prefix:
-              this_mask = (docnos.astype(f'S{len(codec.fmt.prefix.encode())}') == codec.fmt.prefix.encode()) & ~mask
+        # IDs are grouped by prefix and routed to the block whose range of values covers them (each block is
+        # binary searched only for its own IDs)
+        result = np.full(docnos.shape, -1, dtype=np.int64)
+        prefixes, digits = split_ids(docnos, 'int')
+        for prefix, rows in group_by(prefixes):
+            if bytes(prefix) not in self.routes:
+                continue
+            lows, highs, blocks, disjoint = self.routes[bytes(prefix)]
+            values, valid = parse_ints(digits[rows])
+            rows, values = rows[valid], values[valid]
+            if disjoint:
+                which = np.searchsorted(lows, values, 'right') - 1
+                covered = (which >= 0) & (values <= highs[np.maximum(which, 0)])
+                rows, values, which = rows[covered], values[covered], which[covered]
+                for block, positions in group_by(which):
+                    self._search(*blocks[block], rows[positions], values[positions], result)
             else:
-              this_mask = ~mask
-            if this_mask.any():
-                if codec.fmt.prefix:
-                  target_nums = slice_vectorized(docnos[this_mask], len(codec.fmt.prefix.encode()))
-                else:
-                  target_nums = docnos[this_mask]
-                this_mask2 = isnumeric(target_nums)
-                target_nums = target_nums[this_mask2].astype(int)
-                this_mask[np.where(this_mask)[0][~this_mask2]] = 0
-                indexes = np.searchsorted(codec.ctxt, target_nums)
-                indexes[indexes >= codec.ctxt.shape[0]] = -1
-                this_mask3 = codec.ctxt[indexes] == target_nums
-                indexes = indexes[this_mask3]
-                this_mask[np.where(this_mask)[0][~this_mask3]] = 0
-                try:
-                    result[this_mask] = indexes + offset
-                except:
-                    import pdb; pdb.set_trace()
-                    result[this_mask] = indexes + offset
-                mask = mask | this_mask
-            if mask.all():
-                break
+                for codec, offset in blocks:
+                    todo = result[rows] == -1
+                    self._search(codec, offset, rows[todo], values[todo], result)
         return result
 
+    def _lookup_one(self, docno: bytes) -> int:
+        prefix, digits = split_id(docno, 'int')
+        value = parse_int(digits)
+        if prefix not in self.routes or value is None:
+            return -1
+        lows, highs, blocks, disjoint = self.routes[prefix]
+        if disjoint:
+            which = int(np.searchsorted(lows, np.uint64(value), 'right')) - 1
+            blocks = blocks[which:which+1] if which >= 0 and value <= int(highs[which]) else []
+        for codec, offset in blocks:
+            index = self._search_one(codec, value)
+            if index is not None:
+                return index + offset
+        return -1
+
+    @staticmethod
+    def _search_one(codec, value):
+        # _search for a single value; None if it is not in the block
+        stored = codec.ctxt
+        if isinstance(stored, PackedInts):
+            index = stored.searchsorted_one(value)
+            return index if index < len(stored) and stored.get(index) == value else None
+        if value > np.iinfo(stored.dtype).max:
+            return None
+        index = int(np.searchsorted(stored, stored.dtype.type(value)))
+        return index if index < len(stored) and int(stored[index]) == value else None
+
+    @staticmethod
+    def _search(codec, offset, rows, values, result):
+        # binary searches a (sorted) block for values, setting result[rows] for the ones that are found
+        stored = codec.ctxt
+        if isinstance(stored, PackedInts):
+            indexes = stored.searchsorted(values)
+        else:
+            valid = values <= np.uint64(np.iinfo(stored.dtype).max)
+            rows, values = rows[valid], values[valid].astype(stored.dtype)
+            indexes = np.searchsorted(stored, values)
+        in_range = indexes < len(stored)
+        rows, values, indexes = rows[in_range], values[in_range], indexes[in_range]
+        found = stored[indexes] == values
+        result[rows[found]] = indexes[found] + offset
+
     @staticmethod
     def build(fwd, writer):
         writer.write_header(1, len(fwd), {
@@ -60,11 +108,11 @@ class InvIntStored:
 
     @staticmethod
     def condition(fwd):
-        # all fwds must be intstored
-        if not all(isinstance(c.fmt, codecs.fwd['intstored']) for c in fwd.codecs):
+        # all fwds must be intstored or intpacked
+        if not all(isinstance(c.fmt, (codecs.fwd['intstored'], codecs.fwd['intpacked'])) for c in fwd.codecs):
             return False
         # all must be exclusively increasing
-        if not all((c.ctxt[1:] > c.ctxt[:-1]).all() for c in fwd.codecs):
+        if not all(c.ctxt.sorted if isinstance(c.ctxt, PackedInts) else (c.ctxt[1:] > c.ctxt[:-1]).all() for c in fwd.codecs):
             return False
         return True
 
@@ -0,0 +1,151 @@
+import os
+import tempfile
+import numpy as np
+from npids.utils import wrap_mmap, rank_directory, bit_test, bit_rank, bit_test_one, bit_rank_one
+from .inv_hash import HASH_FNS, HASH_FNS_ONE, MASK64, mix64, mix64_one, hash_all
+
+
+MAX_LEVELS = 64
+LEVEL_SEED = 0x9e3779b97f4a7c15
+
+
+def _level_positions(hashes, level, n_bits):
+    seed = np.uint64((LEVEL_SEED * (level + 1)) & 0xffffffffffffffff)
+    return (mix64(hashes ^ seed) % np.uint64(n_bits)).astype(np.int64)
+
+
+class InvMph:
+    """
+    Minimal perfect hash (BBHash-style) over the IDs. Each level is a bit array with gamma bits per
+    remaining key; a key is placed at the first level where no other key shares its bit, and its slot
+    is the rank of that bit across all levels. Slots map to indices through ``dids``, so every lookup
+    needs exactly one forward verification. Keys that never get a bit to themselves (i.e., duplicate
+    IDs or full 64-bit hash collisions) are stored in a small sorted fallback table.
+    """
+    NAME = 'mph'
+    def __init__(self, words, ranks, dids, fallback_hashes, fallback_dids, levels, hash_fn='lane64'):
+        self.words = words
+        self.ranks = ranks
+        self.dids = dids
+        self.fallback_hashes = fallback_hashes
+        self.fallback_dids = fallback_dids
+        self.levels = levels
+        self.hash_fn = hash_fn
+        self.fwd = None
+
+    def _lookup(self, docnos: np.array) -> np.array:
+        hashes = HASH_FNS[self.hash_fn](docnos)
+        result = np.full(docnos.shape, -1, dtype=np.int64)
+        slots = np.full(docnos.shape, -1, dtype=np.int64)
+        todo = np.arange(len(docnos))
+        for level, (word_offset, n_bits) in enumerate(self.levels):
+            if len(todo) == 0:
+                break
+            pos = _level_positions(hashes[todo], level, n_bits) + word_offset * 64
+            hit = bit_test(self.words, pos)
+            slots[todo[hit]] = bit_rank(self.words, self.ranks, pos[hit])
+            todo = todo[~hit]
+        found = np.flatnonzero(slots != -1)
+        if len(found) > 0:
+            cands = self.dids[slots[found]]
+            matches = self.fwd._lookup(cands) == docnos[found]
+            result[found[matches]] = cands[matches]
+        if len(todo) > 0 and len(self.fallback_hashes) > 0:
+            self._lookup_fallback(docnos, hashes, todo, result)
+        return result
+
+    def _lookup_one(self, docno: bytes) -> int:
+        h = HASH_FNS_ONE[self.hash_fn](docno)
+        for level, (word_offset, n_bits) in enumerate(self.levels):
+            pos = mix64_one(h ^ ((LEVEL_SEED * (level + 1)) & MASK64)) % n_bits + word_offset * 64
+            if bit_test_one(self.words, pos):
+                did = int(self.dids[bit_rank_one(self.words, self.ranks, pos)])
+                return did if self.fwd.lookup_one(did) == docno else -1
+        start = int(np.searchsorted(self.fallback_hashes, np.uint64(h), 'left'))
+        for pos in range(start, len(self.fallback_hashes)):
+            if int(self.fallback_hashes[pos]) != h:
+                break
+            did = int(self.fallback_dids[pos])
+            if self.fwd.lookup_one(did) == docno:
+                return did
+        return -1
+
+    def _lookup_fallback(self, docnos, hashes, todo, result):
+        pos = np.searchsorted(self.fallback_hashes, hashes[todo], 'left')
+        end = np.searchsorted(self.fallback_hashes, hashes[todo], 'right')
+        active = pos < end
+        todo, pos, end = todo[active], pos[active], end[active]
+        while len(todo) > 0:
+            cands = self.fallback_dids[pos]
+            matches = self.fwd._lookup(cands) == docnos[todo]
+            result[todo[matches]] = cands[matches]
+            pos += 1
+            active = ~matches & (pos < end)
+            todo, pos, end = todo[active], pos[active], end[active]
+
+    @staticmethod
+    def load(mmp, count, levels, fallback, hash_fn='lane64'):
+        n_words = sum(n_bits for _, n_bits in levels) // 64
+        n_ranks = -(-n_words // 8)
+        here = 0
+        def take(dtype, n):
+            nonlocal here
+            size = np.dtype(dtype).itemsize * n
+            result = wrap_mmap(mmp[here:here+size], dtype)
+            here += size
+            return result
+        words = take('<u8', n_words)
+        ranks = take('<u4', n_ranks)
+        dids = take('<u4', count - fallback)
+        fallback_hashes = take('<u8', fallback)
+        fallback_dids = take('<u4', fallback)
+        return InvMph(words, ranks, dids, fallback_hashes, fallback_dids, levels, hash_fn)
+
+    @staticmethod
+    def build(fwd, writer, gamma=2.0, hash_fn='lane64', workers=None):
+        if workers is not None and workers > 1:
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(fwd.path))) as tmp_dir:
+                hashes = np.array(hash_all(fwd, hash_fn, workers, tmp_dir))
+        else:
+            hashes = hash_all(fwd, hash_fn)
+        remaining = np.arange(len(fwd), dtype=np.int64)
+        bit_pos = np.empty(len(fwd), dtype=np.int64)
+        levels, level_words, word_offset = [], [], 0
+        while len(remaining) > 0 and len(levels) < MAX_LEVELS:
+            n_bits = max(64, int(np.ceil(len(remaining) * gamma / 64)) * 64)
+            pos = _level_positions(hashes[remaining], len(levels), n_bits)
+            alone = np.bincount(pos, minlength=n_bits)[pos] == 1
+            bits = np.zeros(n_bits, dtype=bool)
+            bits[pos[alone]] = True
+            level_words.append(np.packbits(bits, bitorder='little').view('<u8'))
+            bit_pos[remaining[alone]] = pos[alone] + word_offset * 64
+            levels.append([word_offset, n_bits])
+            word_offset += n_bits // 64
+            remaining = remaining[~alone]
+            if not alone.any():
+                # stop early if only duplicate hashes remain; they can never be placed
+                _, inv, counts = np.unique(hashes[remaining], return_inverse=True, return_counts=True)
+                if (counts[inv] > 1).all():
+                    break
+        words = np.concatenate(level_words) if level_words else np.zeros(0, dtype='<u8')
+        ranks = rank_directory(words)
+        placed = np.ones(len(fwd), dtype=bool)
+        placed[remaining] = False
+        placed = np.flatnonzero(placed)
+        dids = np.empty(len(placed), dtype='<u4')
+        dids[bit_rank(words, ranks, bit_pos[placed])] = placed
+        order = np.argsort(hashes[remaining], kind='stable')
+        writer.write_header(1, len(fwd), {
+            'format': 'mph',
+            'levels': levels,
+            'fallback': len(remaining),
+            'hash_fn': hash_fn,
+        })
+        writer.write(words.tobytes())
+        writer.write(ranks.astype('<u4').tobytes())
+        writer.write(dids.tobytes())
+        writer.write(hashes[remaining][order].astype('<u8').tobytes())
+        writer.write(remaining[order].astype('<u4').tobytes())
+
+    def __repr__(self):
+        return f'{self.NAME} [levels={len(self.levels)} fallback={len(self.fallback_hashes)}]'
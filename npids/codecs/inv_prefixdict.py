@@ -0,0 +1,106 @@
+import numpy as np
+from npids import codecs
+from npids.utils import wrap_mmap
+
+
+class InvPrefixDict:
+    """
+    Inverse of ``prefixdict`` blocks. For each block, stores where the rows of each prefix start in the
+    sorted order, followed by the permutation that sorts the records by (prefix id, remainder). A lookup
+    maps the prefix of the ID to its id in the block's dictionary and binary searches the remainder among
+    the rows of that prefix, reading the records directly (without a full forward lookup).
+    """
+    NAME = 'prefixdict'
+    def __init__(self, mmp, index_bytes=4):
+        self.mmp = mmp
+        self.index_bytes = index_bytes
+        self.fwd = None
+        self._blocks = None
+
+    @property
+    def blocks(self):
+        # (starts, perm) of each block; the layout depends on the forward blocks, so it is resolved on first use
+        if self._blocks is None:
+            self._blocks = []
+            here = 0
+            for codec in self.fwd.codecs:
+                n_starts = len(codec.fmt.prefixes) + 1
+                starts = wrap_mmap(self.mmp[here:here+n_starts*self.index_bytes], f'u{self.index_bytes}')
+                here += starts.nbytes
+                perm = wrap_mmap(self.mmp[here:here+codec.count*self.index_bytes], f'u{self.index_bytes}')
+                here += perm.nbytes
+                self._blocks.append((starts, perm))
+        return self._blocks
+
+    def _lookup(self, docnos: np.array) -> np.array:
+        result = np.full(docnos.shape, -1, dtype=np.int64)
+        todo = np.arange(len(docnos))
+        for codec, offset, (starts, perm) in zip(self.fwd.codecs, self.fwd.offsets, self.blocks):
+            if len(todo) == 0:
+                break
+            prefixes, rests, valid = codec.fmt.parse(docnos[todo])
+            uniques, inverse = np.unique(prefixes, return_inverse=True)
+            prefix_ids = np.array([codec.fmt.prefix_ids.get(p, -1) for p in uniques.tolist()], dtype=np.int64)[inverse.reshape(-1)]
+            valid &= prefix_ids >= 0
+            candidates, rests, prefix_ids = todo[valid], rests[valid], prefix_ids[valid]
+            records, _ = codec.ctxt
+            lo = starts[prefix_ids].astype(np.int64)
+            end = starts[prefix_ids + 1].astype(np.int64)
+            hi = end.copy()
+            active = lo < hi
+            while active.any():
+                mid = (lo[active] + hi[active]) // 2
+                less = records['rest'][perm[mid]] < rests[active]
+                lo[active] = np.where(less, mid + 1, lo[active])
+                hi[active] = np.where(less, hi[active], mid)
+                active = lo < hi
+            found = lo < end
+            indexes = perm[lo[found]].astype(np.int64)
+            matches = records['rest'][indexes] == rests[found]
+            result[candidates[found][matches]] = indexes[matches] + offset
+            todo = todo[result[todo] == -1]
+        return result
+
+    def _lookup_one(self, docno: bytes) -> int:
+        for codec, offset, (starts, perm) in zip(self.fwd.codecs, self.fwd.offsets, self.blocks):
+            parsed = codec.fmt.parse_one(docno)
+            if parsed is None or parsed[0] not in codec.fmt.prefix_ids:
+                continue
+            prefix_id = codec.fmt.prefix_ids[parsed[0]]
+            records, _ = codec.ctxt
+            lo, end = int(starts[prefix_id]), int(starts[prefix_id + 1])
+            hi = end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if records[int(perm[mid])]['rest'].item() < parsed[1]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < end and records[int(perm[lo])]['rest'].item() == parsed[1]:
+                return int(perm[lo]) + int(offset)
+        return -1
+
+    @staticmethod
+    def build(fwd, writer):
+        index_bytes = 8 if len(fwd) > 0xFFFFFFFF else 4
+        config = {
+            'format': 'prefixdict',
+        }
+        if index_bytes != 4:
+            config['index_bytes'] = index_bytes
+        writer.write_header(1, len(fwd), config)
+        for codec in fwd.codecs:
+            records, _ = codec.ctxt
+            perm = np.argsort(np.array(records), order=['prefix', 'rest'], kind='stable')
+            starts = np.zeros(len(codec.fmt.prefixes) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(records['prefix'], minlength=len(codec.fmt.prefixes)), out=starts[1:])
+            writer.write(starts.astype(f'u{index_bytes}').tobytes())
+            writer.write(perm.astype(f'u{index_bytes}').tobytes())
+
+    @staticmethod
+    def condition(fwd):
+        # all fwds must be prefixdict blocks
+        return len(fwd.codecs) > 0 and all(isinstance(c.fmt, codecs.fwd['prefixdict']) for c in fwd.codecs)
+
+    def __repr__(self):
+        return f'{self.NAME}'
@@ -0,0 +1,102 @@
+from bisect import bisect_right
+import numpy as np
+from npids.utils import wrap_mmap
+from .fwd_fixedbytes import FwdFixedBytes
+
+
+FENCE_STEP = 64
+
+
+class InvSorted:
+    """
+    Permutation of the indices that sorts the IDs, for forward lookups that consist only of
+    ``fixedbytes`` blocks (where a forward lookup is a cheap fixed-width read). Every ``fence_step``-th
+    key of the sorted order is kept in memory, so a lookup does one binary search over the fence and
+    then a short binary search (log2(fence_step) rounds of forward lookups) within a single window of
+    the permutation.
+    """
+    NAME = 'sorted'
+    def __init__(self, perm, fence, fence_step):
+        self.perm = perm
+        self.fence = fence
+        self.fence_step = fence_step
+        self.fwd = None
+        self._fence_list = None
+
+    def _lookup(self, docnos: np.array) -> np.array:
+        result = np.full(docnos.shape, -1, dtype=np.int64)
+        window = np.searchsorted(self.fence, docnos, 'right') - 1
+        todo = np.flatnonzero(window >= 0)
+        docnos = docnos[todo]
+        lo = window[todo] * self.fence_step
+        hi = np.minimum(lo + self.fence_step, len(self.perm))
+        active = lo < hi
+        while active.any():
+            mid = (lo[active] + hi[active]) // 2
+            less = self.fwd._lookup(self.perm[mid]) < docnos[active]
+            lo[active] = np.where(less, mid + 1, lo[active])
+            hi[active] = np.where(less, hi[active], mid)
+            active = lo < hi
+        found = lo < len(self.perm)
+        cands = self.perm[lo[found]]
+        matches = self.fwd._lookup(cands) == docnos[found]
+        result[todo[found][matches]] = cands[matches]
+        return result
+
+    def _lookup_one(self, docno: bytes) -> int:
+        if self._fence_list is None:
+            self._fence_list = self.fence.tolist()
+        window = bisect_right(self._fence_list, docno) - 1
+        if window < 0:
+            return -1
+        lo = window * self.fence_step
+        hi = min(lo + self.fence_step, len(self.perm))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.fwd.lookup_one(int(self.perm[mid])) < docno:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self.perm):
+            return -1
+        did = int(self.perm[lo])
+        return did if self.fwd.lookup_one(did) == docno else -1
+
+    @staticmethod
+    def condition(fwd):
+        return len(fwd.codecs) > 0 and all(isinstance(codec.fmt, FwdFixedBytes) for codec in fwd.codecs)
+
+    @staticmethod
+    def estimate_size(fwd, fence_step=FENCE_STEP):
+        width = max(codec.fmt.length for codec in fwd.codecs)
+        index_bytes = 8 if len(fwd) > 0xFFFFFFFF else 4
+        return len(fwd) * index_bytes + -(-len(fwd) // fence_step) * width
+
+    @staticmethod
+    def load(mmp, count, fence_step, fence_width, index_bytes=4):
+        perm = wrap_mmap(mmp[:count*index_bytes], f'u{index_bytes}')
+        fence_count = -(-count // fence_step)
+        # the fence is small, and every lookup searches it, so keep it in memory
+        fence = np.array(wrap_mmap(mmp[count*index_bytes:count*index_bytes+fence_count*fence_width], f'S{fence_width}'))
+        return InvSorted(perm, fence, fence_step)
+
+    @staticmethod
+    def build(fwd, writer, fence_step=FENCE_STEP):
+        keys = np.concatenate([batch for batch in fwd.iter_batches(as_bytes=True)] + [np.empty(0, dtype='S1')])
+        index_bytes = 8 if len(fwd) > 0xFFFFFFFF else 4
+        perm = np.argsort(keys, kind='stable').astype(f'u{index_bytes}')
+        fence = keys[perm[::fence_step]]
+        fence_width = max(fence.dtype.itemsize, 1)
+        config = {
+            'format': 'sorted',
+            'fence_step': fence_step,
+            'fence_width': fence_width,
+        }
+        if index_bytes != 4:
+            config['index_bytes'] = index_bytes
+        writer.write_header(1, len(fwd), config)
+        writer.write(perm.tobytes())
+        writer.write(fence.astype(f'S{fence_width}').tobytes())
+
+    def __repr__(self):
+        return f'{self.NAME} [fence_step={self.fence_step}]'
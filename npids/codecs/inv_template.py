@@ -0,0 +1,50 @@
+import numpy as np
+from npids import codecs
+
+
+class InvTemplate:
+    NAME = 'template'
+    def __init__(self):
+        self.fwd = None
+
+    def _lookup(self, docnos: np.array) -> np.array:
+        # parse the IDs against the template of each block, then binary search the (sorted) records
+        result = np.full(docnos.shape, -1, dtype=np.int64)
+        todo = np.arange(len(docnos))
+        for codec, offset in zip(self.fwd.codecs, self.fwd.offsets):
+            if len(todo) == 0:
+                break
+            candidates = todo[codec.fmt.matches_literals(docnos[todo])]
+            records, valid = codec.fmt.parse(docnos[candidates])
+            candidates, records = candidates[valid], records[valid]
+            stored, _ = codec.ctxt
+            indexes = np.minimum(np.searchsorted(stored, records), len(stored) - 1)
+            found = stored[indexes] == records
+            result[candidates[found]] = indexes[found] + offset
+            todo = todo[result[todo] == -1]
+        return result
+
+    def _lookup_one(self, docno: bytes) -> int:
+        for codec, offset in zip(self.fwd.codecs, self.fwd.offsets):
+            record = codec.fmt.parse_one(docno)
+            if record is None:
+                continue
+            stored, _ = codec.ctxt
+            index = int(np.searchsorted(stored, stored.dtype.type(record)))
+            if index < len(stored) and int(stored[index]) == record:
+                return index + int(offset)
+        return -1
+
+    @staticmethod
+    def build(fwd, writer):
+        writer.write_header(1, len(fwd), {
+            'format': 'template',
+        })
+
+    @staticmethod
+    def condition(fwd):
+        # all fwds must be template blocks with records in sorted order
+        return len(fwd.codecs) > 0 and all(isinstance(c.fmt, codecs.fwd['template']) and c.ctxt[1] for c in fwd.codecs)
+
+    def __repr__(self):
+        return f'{self.NAME}'
@@ -1,26 +1,35 @@
 from collections.abc import Iterable as Iter
+from bisect import bisect_right
 import mmap
+import os
 import numpy as np
 from typing import Iterable, Union
 import contextlib
-from .builder import FwdLookupBuilder, InvLookupBuilder
-from .utils import FileManager, peekable, wrap_mmap
+from .builder import FwdLookupBuilder, InvLookupBuilder, BLOCK_COST, optimize as optimize_lookup
+from .utils import FileManager, LRUCache, StringHeap, peekable, wrap_mmap, group_by, heap_offsets, heap_scatter, heap_from_rows, byte_matrix
 from . import codecs
 
 
+DEFAULT_BATCH_SIZE = 2**16
+
 class Lookup:
-    def __init__(self, path):
+    def __init__(self, path, load_inv=True, cache_size=None):
+        # blocks and the inverse are only decoded when they are first used; with load_inv=False, the
+        # inverse is not loaded at all (inv is None). With cache_size, the results of up to cache_size
+        # forward and cache_size inverse lookups are kept (evicting the least recently used ones).
         self.path = path
-        self.fwd, self.inv = self._load()
+        self.fwd, self.inv = self._load(load_inv, cache_size)
 
     def __getitem__(self, idx):
         return self.lookup(idx)
 
-    def lookup(self, idx, as_bytes=False):
+    def lookup(self, idx, as_bytes=False, as_heap=False):
         # detect if we're doing a fwd or inv lookup
         mode = None
         detector = idx
-        if isinstance(idx, (list, tuple)):
+        if isinstance(idx, StringHeap) or (hasattr(idx, 'buffers') and hasattr(idx, 'type')):
+            mode = 'inv' # heaps and pyarrow string arrays hold IDs
+        elif isinstance(idx, (list, tuple)):
             if len(idx) > 0:
                 detector = idx[0]
             else:
@@ -43,13 +52,13 @@ class Lookup:
         elif hasattr(detector, 'dtype'):
             if detector.dtype.kind in 'iu':
                 mode = 'fwd'
-            elif detector.dtype.kind in 'SUO':
+            elif detector.dtype.kind in 'SUOT':
                 mode = 'inv'
 
         if mode == 'inv':
             return self.inv.lookup(idx)
         elif mode == 'fwd':
-            return self.fwd.lookup(idx, as_bytes=as_bytes)
+            return self.fwd.lookup(idx, as_bytes=as_bytes, as_heap=as_heap)
         raise RuntimeError('Cannot detect input type to route to fwd or inv lookup. Try using .inv or .fwd directly, depending on your needs.')
 
     def __len__(self) -> int:
@@ -58,6 +67,9 @@ class Lookup:
     def __iter__(self) -> Iterable[str]:
         return iter(self.fwd)
 
+    def iter_batches(self, batch_size=DEFAULT_BATCH_SIZE, as_bytes=False, as_heap=False) -> Iterable[np.array]:
+        return self.fwd.iter_batches(batch_size=batch_size, as_bytes=as_bytes, as_heap=as_heap)
+
     def __enter__(self):
         return self
 
@@ -79,6 +91,13 @@ class Lookup:
             self.inv.close()
             self.inv = None
 
+    def cache_info(self):
+        # hits, misses, maxsize, and currsize of the forward and inverse caches (None without a cache)
+        return {
+            'fwd': self.fwd.cache_info() if self.fwd is not None else None,
+            'inv': self.inv.cache_info() if self.inv is not None else None,
+        }
+
     def describe(self) -> str:
         result = [f'{self!r} (count={len(self)})']
         if self.fwd is not None:
@@ -95,68 +114,128 @@ class Lookup:
 
     @staticmethod
     @contextlib.contextmanager
-    def builder(path, build_inv=True, min_block=None):
-        builder = FwdLookupBuilder(path, min_block=min_block)
+    def builder(path, build_inv=True, min_block=None, inv_format=None, inv_options=None, workers=None, optimize=False):
+        # with optimize=True, the blocks are first built in a temporary file and then re-planned into path
+        build_path = f'{path}.unoptimized' if optimize else path
+        if optimize and os.path.exists(path):
+            raise FileExistsError(f'{path} already exists')
+        builder = FwdLookupBuilder(build_path, min_block=min_block)
         try:
             yield builder
             builder.close()
         except:
             raise
-        if build_inv:
-            InvLookupBuilder.build(path)
+        if optimize:
+            optimize_lookup(build_path, path, build_inv=build_inv, inv_format=inv_format, inv_options=inv_options, workers=workers)
+            os.remove(build_path)
+        elif build_inv:
+            InvLookupBuilder.build(path, inv_format=inv_format, inv_options=inv_options, workers=workers)
 
     @staticmethod
-    def build(docnos, path, build_inv=True, min_block=None, return_self=True):
-        with Lookup.builder(path, build_inv=build_inv, min_block=min_block) as builder:
-            for docno in docnos:
-                builder.add(docno)
+    def build(docnos, path, build_inv=True, min_block=None, return_self=True, inv_format=None, inv_options=None, workers=None, optimize=False):
+        with Lookup.builder(path, build_inv=build_inv, min_block=min_block, inv_format=inv_format, inv_options=inv_options, workers=workers, optimize=optimize) as builder:
+            builder.add_many(docnos)
         if return_self:
             return Lookup(path)
 
-    def _load(self):
+    @staticmethod
+    def optimize(src, dst, block_cost=BLOCK_COST, build_inv=True, inv_format=None, inv_options=None, workers=None):
+        """
+        Rewrites the lookup at src into dst (a new file), merging and re-splitting its forward blocks to
+        minimize their estimated size plus block_cost bytes per block, and builds a new inverse. Returns a
+        dict with the size of the files (bytes_before/bytes_after), the size of their forward blocks
+        (fwd_bytes_before/fwd_bytes_after, which leaves out the inverses), and the number of blocks
+        (blocks_before/blocks_after).
+        """
+        return optimize_lookup(src, dst, block_cost=block_cost, build_inv=build_inv, inv_format=inv_format, inv_options=inv_options, workers=workers)
+
+    def _load(self, load_inv=True, cache_size=None):
         with FileManager(self.path, 'r') as f:
             mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-            next_ptr = f.tell()
             start_idx = 0
             parts = []
-            inv = None
-            while next_ptr != -1:
-                f.seek(next_ptr)
-                type_id, next_ptr, doc_count, config = f.read_header()
-                here = f.tell()
+            inv_block = None
+            for type_id, _, here, end, doc_count, config in f.blocks():
                 if type_id == 0:
-                    Fmt = codecs.fwd[config.pop('format')]
-                    part = FormatFwdBlock(Fmt(**config), mm[here:None if next_ptr == -1 else next_ptr], doc_count)
+                    part = FormatFwdBlock(config.pop('format'), config, mm, here, end, doc_count)
                     parts.append((start_idx, part))
                     start_idx += len(part)
                 elif type_id == 1:
-                    if config['format'] == 'hash':
-                        count = (1 << config['hash_bits']) + 1
-                        hashes = wrap_mmap(mm[here:here+count*np.dtype(np.uint32).itemsize], np.uint32)
-                        here += hashes.nbytes
-                        dids = wrap_mmap(mm[here:here+doc_count*np.dtype(np.uint32).itemsize], np.uint32)
-                        inv = codecs.inv['hash'](hashes, dids, config['hash_bits'])
-                    elif config['format'] == 'intsequence':
-                        config.pop('format')
-                        inv = codecs.inv['intsequence'](**config)
-                    elif config['format'] == 'intsequencemulti':
-                        config.pop('format')
-                        inv = codecs.inv['intsequencemulti'](**config)
-                    elif config['format'] == 'intstored':
-                        config.pop('format')
-                        inv = codecs.inv['intstored'](**config)
-        fwd = FwdLookup([p[1] for p in parts], np.array([p[0] for p in parts]))
-        if inv is not None:
-            inv.fwd = fwd
-            inv = InvLookup(inv)
+                    inv_block = (here, end, doc_count, config)
+        fwd = FwdLookup([p[1] for p in parts], np.array([p[0] for p in parts]), self.path, cache_size=cache_size)
+        inv = None
+        if inv_block is not None and load_inv:
+            inv = InvLookup(load=lambda: self._load_inv(mm, fwd, *inv_block), cache_size=cache_size)
         return fwd, inv
 
+    @staticmethod
+    def _load_inv(mm, fwd, here, end, doc_count, config):
+        if config['format'] == 'hash':
+            count = (1 << config['hash_bits']) + 1
+            index_dtype = np.dtype(f"u{config.get('index_bytes', 4)}")
+            hashes = wrap_mmap(mm[here:here+count*index_dtype.itemsize], index_dtype)
+            here += hashes.nbytes
+            dids = wrap_mmap(mm[here:here+doc_count*index_dtype.itemsize], index_dtype)
+            here += dids.nbytes
+            fingerprints = None
+            if config.get('fingerprint_bits'):
+                fp_dtype = {8: np.uint8, 16: np.uint16}[config['fingerprint_bits']]
+                fingerprints = wrap_mmap(mm[here:here+doc_count*np.dtype(fp_dtype).itemsize], fp_dtype)
+            inv = codecs.inv['hash'](hashes, dids, config['hash_bits'], config.get('hash_fn', 'fnv1_32'), fingerprints, config.get('fingerprint_bits', 0))
+        elif config['format'] == 'intsequence':
+            config.pop('format')
+            inv = codecs.inv['intsequence'](**config)
+        elif config['format'] == 'intsequencemulti':
+            config.pop('format')
+            inv = codecs.inv['intsequencemulti'](**config)
+        elif config['format'] == 'intstored':
+            config.pop('format')
+            inv = codecs.inv['intstored'](**config)
+        elif config['format'] == 'mph':
+            config.pop('format')
+            inv = codecs.inv['mph'].load(mm[here:end], doc_count, **config)
+        elif config['format'] == 'template':
+            inv = codecs.inv['template']()
+        elif config['format'] == 'prefixdict':
+            config.pop('format')
+            inv = codecs.inv['prefixdict'](mm[here:end], **config)
+        elif config['format'] == 'sorted':
+            config.pop('format')
+            inv = codecs.inv['sorted'].load(mm[here:end], doc_count, **config)
+        inv.fwd = fwd
+        return inv
+
 
 class FormatFwdBlock:
-    def __init__(self, fmt, mmp, count):
-        self.fmt = fmt
-        self.ctxt = fmt.build_context(mmp, count)
+    def __init__(self, format, config, mm, start, end, count):
+        # the codec and its context are built on first use, from the [start, end) range of mm
+        self.format = format
+        self.config = config
+        self.mm = mm
+        self.start = start
+        self.end = end
         self.count = count
+        self._fmt = None
+        self._ctxt = None
+
+    @property
+    def fmt(self):
+        if self._fmt is None:
+            self._build()
+        return self._fmt
+
+    @property
+    def ctxt(self):
+        if self._ctxt is None:
+            self._build()
+        return self._ctxt
+
+    def _build(self):
+        # the codec and its context are built together, since building the context can complete the state of
+        # the codec (e.g., the dictionary of prefixdict)
+        fmt = codecs.fwd[self.format](**self.config)
+        self._ctxt = fmt.build_context(self.mm[self.start:self.end], self.count)
+        self._fmt = fmt
 
     def __getitem__(self, idx):
         if isinstance(idx, (int, np.int64, np.int32)):
@@ -168,21 +247,40 @@ class FormatFwdBlock:
     def _lookup(self, idxs: np.array, as_bytes=False) -> np.array:
         return self.fmt.lookup(idxs, self.ctxt)
 
+    def lookup_one(self, idx: int) -> bytes:
+        if hasattr(self.fmt, 'lookup_one'):
+            return self.fmt.lookup_one(idx, self.ctxt)
+        return bytes(self._lookup(np.array([idx], dtype=np.int64))[0])
+
+    def lookup_heap(self, idxs: np.array):
+        # (offsets, data) of the IDs; codecs without a heap path go through their S array
+        if hasattr(self.fmt, 'lookup_heap'):
+            return self.fmt.lookup_heap(idxs, self.ctxt)
+        return heap_from_rows(byte_matrix(self._lookup(idxs)))
+
     def close(self):
         pass
 
     def __iter__(self):
         return iter(self.fmt.iterator(self.ctxt))
 
+    def iter_batches(self, batch_size=DEFAULT_BATCH_SIZE, as_heap=False):
+        for start in range(0, self.count, batch_size):
+            idxs = np.arange(start, min(start+batch_size, self.count), dtype=np.int64)
+            yield StringHeap(*self.lookup_heap(idxs)) if as_heap else self._lookup(idxs)
+
     def __len__(self):
         return self.count
 
 
 class FwdLookup:
-    def __init__(self, codecs, offsets):
+    def __init__(self, codecs, offsets, path=None, cache_size=None):
         self.codecs = codecs
         self.offsets = offsets
+        self.path = path
+        self.cache = LRUCache(cache_size) if cache_size else None
         self._count = sum(len(c) for c in self.codecs)
+        self._starts = self.offsets.tolist()
 
     def __getitem__(self, keys):
         return self.lookup(keys)
@@ -191,44 +289,57 @@ class FwdLookup:
         for codec in self.codecs:
             yield from codec
 
-    def lookup(self, idxs, as_bytes=False):
+    def iter_batches(self, batch_size=DEFAULT_BATCH_SIZE, as_bytes=False, as_heap=False):
+        # batches never span blocks, so each one comes from a single codec's vectorized lookup
+        assert batch_size > 0
+        for codec in self.codecs:
+            for batch in codec.iter_batches(batch_size, as_heap=as_heap):
+                if not as_bytes and not as_heap:
+                    batch = np.char.decode(batch, encoding='utf8')
+                yield batch
+
+    def lookup_one(self, idx: int) -> bytes:
+        # a single (in bounds) index, using the scalar path of its codec rather than the vectorized one
+        block = bisect_right(self._starts, idx) - 1
+        return self.codecs[block].lookup_one(idx - self._starts[block])
+
+    def lookup(self, idxs, as_bytes=False, as_heap=False):
+        # with as_heap, batches are returned as a StringHeap (UTF-8 bytes behind offsets) rather than as
+        # an array or list of strings padded to the longest one
         out_format = None
         idxs_inp = None
-        if isinstance(idxs, (int,)):
-            out_format = 'single'
+        if isinstance(idxs, (int, np.integer)):
             if idxs < 0 or idxs >= self._count:
                 raise LookupError(f'{idxs} is out of bounds [0, {self._count})')
-            idxs_inp = np.array([idxs], dtype=np.uint32)
+            idxs = int(idxs)
+            docno = self.cache.get(idxs) if self.cache is not None else None
+            if docno is None:
+                docno = self.lookup_one(idxs)
+                if self.cache is not None:
+                    self.cache.put(idxs, docno)
+            return docno if as_bytes else docno.decode()
         elif hasattr(idxs, 'dtype'):
             if idxs.shape == tuple():
                 out_format = 'single'
-                idxs_inp = np.array([idxs], dtype=np.uint32)
+                idxs_inp = np.array([idxs], dtype=np.int64)
             else:
                 out_format = 'numpy'
-                idxs_inp = np.array(idxs, dtype=np.uint32)
+                idxs_inp = np.array(idxs, dtype=np.int64)
                 out_shape = idxs_inp.shape
                 idxs_inp = idxs_inp.reshape(-1)
         elif isinstance(idxs, (list, tuple)):
             out_format = 'list'
-            idxs_inp = np.array(idxs, dtype=np.uint32)
+            idxs_inp = np.array(idxs, dtype=np.int64)
         # TODO: iterables, np.ints, etc.?
 
-        if len(self.codecs) == 1:
-            result = self.codecs[0]._lookup(idxs_inp)
+        if as_heap and out_format != 'single':
+            if self.cache is not None:
+                return StringHeap.from_bytes(self._lookup_cached(idxs_inp))
+            return StringHeap(*self._lookup_heap(idxs_inp))
+        if self.cache is not None:
+            result = np.array(self._lookup_cached(idxs_inp), dtype='S')
         else:
-            handlers, inv = np.unique(np.searchsorted(self.offsets, idxs_inp, 'right') - 1, return_inverse=True)
-            docnos_and_masks = []
-            for i, h in enumerate(handlers):
-                mask = inv == i
-                these_docnos = self.codecs[h]._lookup(idxs_inp[mask] - self.offsets[h])
-                docnos_and_masks.append((these_docnos, mask))
-            if len(docnos_and_masks) == 1:
-                result = docnos_and_masks[0][0] # short circuit -- no need to merge them since they all came from one part
-            else:
-                max_docno_size = max((d.dtype for d, m in docnos_and_masks), key=lambda d: d.itemsize)
-                result = np.empty(idxs_inp.shape, dtype=max_docno_size)
-                for d, m in docnos_and_masks:
-                    result[m] = d
+            result = self._lookup(idxs_inp)
 
         if not as_bytes:
             result = np.char.decode(result, encoding='utf8')
@@ -240,6 +351,61 @@ class FwdLookup:
         if out_format == 'list':
             return result.tolist()
 
+    def _lookup(self, idxs: np.array) -> np.array:
+        # vectorized lookup of an array of indices (without the cache); returns an S array
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if len(self.codecs) == 1:
+            result = self.codecs[0]._lookup(idxs)
+        else:
+            # positions are grouped by block with a single sort (rather than a mask over the batch per block)
+            docnos_and_positions = []
+            for h, positions in group_by(np.searchsorted(self.offsets, idxs, 'right') - 1):
+                these_docnos = self.codecs[h]._lookup(idxs[positions] - self.offsets[h])
+                docnos_and_positions.append((these_docnos, positions))
+            if len(docnos_and_positions) == 0:
+                result = np.empty(0, dtype='S1')
+            elif len(docnos_and_positions) == 1:
+                result = docnos_and_positions[0][0] # short circuit -- no need to merge them since they all came from one part
+            else:
+                max_docno_size = max((d.dtype for d, p in docnos_and_positions), key=lambda d: d.itemsize)
+                result = np.empty(idxs.shape, dtype=max_docno_size)
+                for d, p in docnos_and_positions:
+                    result[p] = d
+        return result
+
+    def _lookup_heap(self, idxs: np.array):
+        # like _lookup, but returns (offsets, data), merging the blocks' heaps without padding the IDs
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if len(self.codecs) == 1:
+            return self.codecs[0].lookup_heap(idxs)
+        heaps_and_positions = []
+        for h, positions in group_by(np.searchsorted(self.offsets, idxs, 'right') - 1):
+            heaps_and_positions.append((self.codecs[h].lookup_heap(idxs[positions] - self.offsets[h]), positions))
+        if len(heaps_and_positions) == 1:
+            return heaps_and_positions[0][0] # all from one block, and in order (the sort is stable)
+        lengths = np.zeros(len(idxs), dtype=np.int64)
+        for (offsets, _), positions in heaps_and_positions:
+            lengths[positions] = np.diff(offsets)
+        result_offsets = heap_offsets(lengths)
+        result_data = np.empty(result_offsets[-1], dtype=np.uint8)
+        for (offsets, data), positions in heaps_and_positions:
+            heap_scatter(result_data, result_offsets[positions], offsets, data)
+        return result_offsets, result_data
+
+    def _lookup_cached(self, idxs: np.array) -> list:
+        # serves the indices that are in the cache, and only looks up the others; returns a list of bytes
+        keys = idxs.tolist()
+        docnos = self.cache.get_many(keys)
+        missing = [i for i, docno in enumerate(docnos) if docno is None]
+        if missing:
+            for i, docno in zip(missing, StringHeap(*self._lookup_heap(idxs[missing])).tolist(as_bytes=True)):
+                docnos[i] = docno
+                self.cache.put(keys[i], docno)
+        return docnos
+
+    def cache_info(self):
+        return self.cache.info() if self.cache is not None else None
+
     def close(self):
         pass
 
@@ -257,30 +423,72 @@ class FwdLookup:
 
 
 class InvLookup:
-    def __init__(self, codec):
-        self.codec = codec
+    def __init__(self, codec=None, load=None, cache_size=None):
+        # either the codec or a function that loads it on first use
+        self._codec = codec
+        self._load = load
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    @property
+    def codec(self):
+        if self._codec is None:
+            self._codec = self._load()
+        return self._codec
 
     def __getitem__(self, keys):
         return self.lookup(keys)
 
     def lookup(self, keys):
         if isinstance(keys, (str, bytes)):
-            res = self.lookup(np.array([keys]))
-            if res[0] == -1:
+            key = (keys.encode() if isinstance(keys, str) else keys).rstrip(b'\0')
+            res = self.cache.get(key) if self.cache is not None else None
+            if res is None:
+                res = self.lookup_one(key)
+                if self.cache is not None:
+                    self.cache.put(key, res)
+            if res == -1:
                 raise LookupError(f'{repr(keys)} not found')
-            return res.item()
+            return res
         elif isinstance(keys, (list, tuple)):
             return self.lookup(np.array(keys)).tolist()
+        elif isinstance(keys, StringHeap):
+            return self.lookup(keys.to_bytes_array())
+        elif hasattr(keys, 'buffers') and hasattr(keys, 'type'):
+            # pyarrow string/large_string array
+            return self.lookup(StringHeap.from_arrow(keys))
         elif hasattr(keys, 'dtype'):
-            if keys.dtype.kind == 'U':
+            if keys.dtype.kind in 'UT': # fixed-width or variable-width (StringDType) unicode
                 keys = np.char.encode(keys, encoding='utf8')
             keys = np.array(keys, dtype='S')
+            if self.cache is not None:
+                return self._lookup_cached(keys)
             return self.codec._lookup(keys)
         elif isinstance(keys, (Iter)):
             return self.lookup(list(keys))
 
         raise ValueError(f'Unsupported input to lookup: {keys!r}')
 
+    def lookup_one(self, key: bytes) -> int:
+        # a single ID (-1 if not found), using the scalar path of the codec rather than the vectorized one
+        key = key.rstrip(b'\0') # like the S arrays of the vectorized path
+        if hasattr(self.codec, '_lookup_one'):
+            return self.codec._lookup_one(key)
+        return int(self.codec._lookup(np.array([key], dtype='S'))[0])
+
+    def _lookup_cached(self, keys: np.array) -> np.array:
+        # serves the IDs that are in the cache, and only looks up the others
+        key_list = keys.tolist()
+        result = np.array(self.cache.get_many(key_list, -2), dtype=np.int64)
+        missing = np.flatnonzero(result == -2)
+        if len(missing) > 0:
+            result[missing] = self.codec._lookup(keys[missing])
+            for i, res in zip(missing.tolist(), result[missing].tolist()):
+                self.cache.put(key_list[i], res)
+        return result
+
+    def cache_info(self):
+        return self.cache.info() if self.cache is not None else None
+
     def close(self):
         pass
 
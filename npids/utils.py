@@ -1,6 +1,8 @@
+import re
 import json
 import warnings
 import struct
+from collections import OrderedDict, namedtuple
 from pathlib import Path
 import numpy as np
 
@@ -9,6 +11,445 @@ def wrap_mmap(mm, dtype):
     return np.ndarray.__new__(np.memmap, shape=(len(mm) // descr.itemsize,), dtype=descr, buffer=mm, order='C')
 
 
+HEX_LOWER = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+HEX_UPPER = np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)
+
+
+def byte_matrix(arr):
+    # views a fixed-width (S or V) array as a (len, itemsize) uint8 matrix
+    arr = np.ascontiguousarray(arr)
+    return arr.view(np.uint8).reshape(len(arr), arr.dtype.itemsize)
+
+
+def row_lengths(b):
+    # length of each row of a uint8 matrix, ignoring trailing NUL padding
+    if b.shape[1] == 0:
+        return np.zeros(b.shape[0], dtype=np.intp)
+    # (S arrays already ignore trailing NULs)
+    return np.char.str_len(rows_as_bytes(b)).astype(np.intp)
+
+
+def startswith(a, prefix: bytes):
+    if not prefix:
+        return np.ones(a.shape, dtype=bool)
+    return a.astype(f'S{len(prefix)}') == prefix
+
+
+def leading_count(mask):
+    # number of leading True values in mask
+    return len(mask) if mask.all() else int(np.argmin(mask))
+
+
+def common_prefix(a, prefix: bytes = None):
+    # the longest prefix shared by all the rows of a non-empty S array (and by prefix, if given)
+    b = byte_matrix(a)
+    first = b[0, :row_lengths(b).min()]
+    if prefix is not None:
+        first = first[:len(prefix)]
+        first = first[:leading_count(first == np.frombuffer(prefix[:len(first)], dtype=np.uint8))]
+    return first[:leading_count((b[:, :len(first)] == first).all(axis=0))].tobytes()
+
+
+def hexlify(b, upper=False):
+    # (n, k) uint8 matrix -> (n, 2k) uint8 matrix of ASCII hex digits
+    table = HEX_UPPER if upper else HEX_LOWER
+    result = np.empty((b.shape[0], b.shape[1] * 2), dtype=np.uint8)
+    result[:, 0::2] = table[b >> 4]
+    result[:, 1::2] = table[b & 0xf]
+    return result
+
+
+_UNHEX_LOWER = np.full(256, 255, dtype=np.uint8)
+_UNHEX_LOWER[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+_UNHEX_UPPER = np.full(256, 255, dtype=np.uint8)
+_UNHEX_UPPER[np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)] = np.arange(16)
+
+
+def unhexlify(h, upper=False):
+    # (n, 2k) uint8 matrix of ASCII hex digits -> ((n, k) uint8 matrix, valid mask)
+    nibbles = (_UNHEX_UPPER if upper else _UNHEX_LOWER)[h]
+    valid = (nibbles != 255).all(axis=1)
+    return (nibbles[:, 0::2] << 4) | nibbles[:, 1::2], valid
+
+
+def prefixed(prefix: bytes, body):
+    # (n, k) uint8 matrix -> S array with prefix prepended to each row
+    width = len(prefix) + body.shape[1]
+    if width == 0:
+        return np.zeros(body.shape[0], dtype='S1')
+    result = np.empty((body.shape[0], width), dtype=np.uint8)
+    result[:, :len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+    result[:, len(prefix):] = body
+    return result.view(f'S{width}').reshape(body.shape[0])
+
+
+def gather_rows(heap, starts, lengths):
+    # gathers heap[starts[i]:starts[i]+lengths[i]] for each i into a NUL-padded (n, max(lengths)) uint8 matrix
+    width = int(lengths.max()) if len(lengths) > 0 else 0
+    cols = np.arange(width)
+    active = cols < lengths[:, None]
+    pos = np.where(active, starts.astype(np.int64)[:, None] + cols, 0)
+    if len(heap) == 0:
+        return np.zeros(active.shape, dtype=np.uint8)
+    return np.where(active, heap[pos], 0).astype(np.uint8)
+
+
+# Heaps: variable-length strings stored back to back in a uint8 data array, the i-th one being
+# data[offsets[i]:offsets[i+1]] (with int64 offsets, starting at 0)
+
+def heap_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def heap_scatter(out, out_starts, offsets, data):
+    # copies each string of the heap (offsets, data) into out, the i-th one starting at out_starts[i]
+    lengths = np.diff(offsets)
+    out[np.repeat(out_starts - offsets[:-1], lengths) + np.arange(offsets[-1])] = data[:offsets[-1]]
+
+
+def heap_from_rows(b):
+    # NUL-padded (n, k) uint8 matrix -> (offsets, data)
+    lengths = row_lengths(b)
+    return heap_offsets(lengths), b[np.arange(b.shape[1]) < lengths[:, None]]
+
+
+def heap_to_rows(offsets, data):
+    # (offsets, data) -> NUL-padded (n, max length) uint8 matrix (the inverse of heap_from_rows)
+    lengths = np.diff(offsets)
+    width = int(lengths.max()) if len(lengths) > 0 else 0
+    result = np.zeros((len(lengths), width), dtype=np.uint8)
+    heap_scatter(result.reshape(-1), np.arange(len(lengths), dtype=np.int64) * width, offsets, data)
+    return result
+
+
+def gather_heap(heap, starts, lengths, prefix: bytes = b''):
+    # gathers prefix + heap[starts[i]:starts[i]+lengths[i]] for each i into (offsets, data), like gather_rows
+    # (but without padding the strings to the longest one)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = heap_offsets(lengths + len(prefix))
+    data = np.empty(offsets[-1], dtype=np.uint8)
+    fill_prefix(data, offsets, prefix)
+    inner = heap_offsets(lengths) # offsets without the prefixes
+    pos = np.arange(inner[-1]) - np.repeat(inner[:-1], lengths) # position of each byte within its string
+    data[np.repeat(offsets[:-1] + len(prefix), lengths) + pos] = heap[np.repeat(np.asarray(starts, dtype=np.int64), lengths) + pos]
+    return offsets, data
+
+
+def fill_prefix(data, offsets, prefix: bytes):
+    # writes prefix at the start of each string of a heap
+    for i, c in enumerate(prefix):
+        data[offsets[:-1] + i] = c
+
+
+def heap_join(heaps):
+    # concatenates the strings of several heaps (of the same length) element-wise
+    lengths = sum(np.diff(offsets) for offsets, _ in heaps)
+    offsets = heap_offsets(lengths)
+    data = np.empty(offsets[-1], dtype=np.uint8)
+    cursor = offsets[:-1].copy()
+    for part_offsets, part_data in heaps:
+        heap_scatter(data, cursor, part_offsets, part_data)
+        cursor += np.diff(part_offsets)
+    return offsets, data
+
+
+def split_ids(ids: np.array, mode: str):
+    # vectorized split of an S array into (prefixes, remainders). In 'int' mode, the remainder is the
+    # trailing run of digits (rows without one get an empty remainder); in 'bytes' mode, it starts at
+    # the first digit.
+    b = byte_matrix(ids)
+    lengths = row_lengths(b)
+    cols = np.arange(b.shape[1])
+    in_row = cols < lengths[:, None]
+    is_digit = (b >= ord('0')) & (b <= ord('9')) & in_row
+    if mode == 'int':
+        other = ~is_digit & in_row
+        prefix_lengths = np.where(other.any(axis=1), b.shape[1] - other[:, ::-1].argmax(axis=1), 0)
+    else:
+        prefix_lengths = np.where(is_digit.any(axis=1), is_digit.argmax(axis=1), lengths)
+    if len(ids) > 0 and (prefix_lengths == prefix_lengths[0]).all():
+        # (usual within a block) all the rows are split at the same column
+        return rows_as_bytes(b[:, :prefix_lengths[0]]), rows_as_bytes(b[:, prefix_lengths[0]:])
+    # the prefixes are the leading bytes of the rows as they are; only the remainders need to be shifted
+    width = int(prefix_lengths.max()) if len(ids) > 0 else 0
+    prefixes = np.where(cols[:width] < prefix_lengths[:, None], b[:, :width], 0).astype(np.uint8)
+    starts = np.arange(len(ids), dtype=np.int64) * b.shape[1]
+    remainders = gather_rows(b.reshape(-1), starts + prefix_lengths, lengths - prefix_lengths)
+    return rows_as_bytes(prefixes), rows_as_bytes(remainders)
+
+
+INT_TAIL_RE = re.compile(rb'[0-9]*\Z')
+FIRST_DIGIT_RE = re.compile(rb'[0-9]|\Z')
+
+
+def split_id(id: bytes, mode: str):
+    # split_ids for a single ID
+    regex = INT_TAIL_RE if mode == 'int' else FIRST_DIGIT_RE
+    start = regex.search(id).start()
+    return id[:start], id[start:]
+
+
+def rows_as_bytes(b):
+    # (n, k) uint8 matrix -> S array (the inverse of byte_matrix)
+    if b.shape[1] == 0:
+        return np.zeros(b.shape[0], dtype='S1')
+    return np.ascontiguousarray(b).view(f'S{b.shape[1]}').reshape(b.shape[0])
+
+
+def group_by(keys):
+    # positions of each distinct key (in sorted order of the keys), via a single stable sort; yields (key, positions)
+    if len(keys) == 0:
+        return
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    bounds = np.concatenate([[0], np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1, [len(keys)]])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield sorted_keys[start], order[start:end]
+
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+RANK_BLOCK_WORDS = 8 # rank directory samples every 512 bits
+
+
+def popcount64(words):
+    words = np.ascontiguousarray(words, dtype='<u8')
+    return _POPCOUNT8[words.view(np.uint8).reshape(words.shape + (8,))].sum(axis=-1, dtype=np.int64)
+
+
+def rank_directory(words):
+    # number of set bits before each block of RANK_BLOCK_WORDS words
+    counts = np.zeros(-(-len(words) // RANK_BLOCK_WORDS) * RANK_BLOCK_WORDS, dtype=np.int64)
+    counts[:len(words)] = popcount64(words)
+    block_counts = counts.reshape(-1, RANK_BLOCK_WORDS).sum(axis=1)
+    return (np.cumsum(block_counts) - block_counts).astype(np.uint32)
+
+
+def bit_test(words, pos):
+    return (words[pos >> 6] >> (pos & 63).astype(np.uint64)) & np.uint64(1) == 1
+
+
+def bit_rank(words, ranks, pos):
+    # number of set bits strictly before each position in pos
+    word = pos >> 6
+    result = ranks[word // RANK_BLOCK_WORDS].astype(np.int64)
+    block_start = word - word % RANK_BLOCK_WORDS
+    for i in range(RANK_BLOCK_WORDS - 1):
+        before = block_start + i < word
+        if before.any():
+            result[before] += popcount64(words[block_start[before] + i])
+    partial = words[word] & ((np.uint64(1) << (pos & 63).astype(np.uint64)) - np.uint64(1))
+    return result + popcount64(partial)
+
+
+_SELECT8 = np.zeros((256, 8), dtype=np.uint8)
+for _byte in range(256):
+    _bits_set = [_bit for _bit in range(8) if _byte >> _bit & 1]
+    _SELECT8[_byte, :len(_bits_set)] = _bits_set
+
+
+def bit_select(words, ranks, k):
+    # position of the k-th (0-based) set bit, given a rank directory built over words
+    block = np.searchsorted(ranks, k, 'right') - 1
+    remaining = np.asarray(k, dtype=np.int64) - ranks[block].astype(np.int64)
+    word = block * RANK_BLOCK_WORDS
+    for i in range(RANK_BLOCK_WORDS - 1):
+        count = popcount64(words[np.minimum(word, len(words) - 1)])
+        move = (remaining >= count) & (word + 1 < len(words))
+        remaining -= np.where(move, count, 0)
+        word += move
+    byte_values = np.ascontiguousarray(words[word], dtype='<u8').view(np.uint8).reshape(len(word), 8)
+    cum = np.cumsum(_POPCOUNT8[byte_values], axis=1, dtype=np.int64)
+    byte = (cum <= remaining[:, None]).sum(axis=1)
+    remaining -= np.where(byte > 0, cum[np.arange(len(word)), np.maximum(byte - 1, 0)], 0)
+    return word * 64 + byte * 8 + _SELECT8[byte_values[np.arange(len(word)), byte], remaining]
+
+
+def popcount(word: int):
+    return bin(word).count('1')
+
+
+def bit_test_one(words, pos: int):
+    return int(words[pos >> 6]) >> (pos & 63) & 1 == 1
+
+
+def bit_rank_one(words, ranks, pos: int):
+    # bit_rank for a single position
+    word = pos >> 6
+    block_start = word - word % RANK_BLOCK_WORDS
+    result = int(ranks[word // RANK_BLOCK_WORDS])
+    for i in range(block_start, word):
+        result += popcount(int(words[i]))
+    return result + popcount(int(words[word]) & ((1 << (pos & 63)) - 1))
+
+
+def bit_select_one(words, ranks, k: int):
+    # bit_select for a single k
+    block = int(np.searchsorted(ranks, k, 'right')) - 1
+    remaining = k - int(ranks[block])
+    word = block * RANK_BLOCK_WORDS
+    value = int(words[word])
+    count = popcount(value)
+    while remaining >= count and word + 1 < len(words):
+        remaining -= count
+        word += 1
+        value = int(words[word])
+        count = popcount(value)
+    for _ in range(remaining):
+        value &= value - 1 # clear the lowest set bit
+    return word * 64 + (value & -value).bit_length() - 1
+
+
+PACK_CHUNK = 2**16 # values packed at a time (a multiple of 8, so chunks start on a byte boundary)
+
+
+def pack_bits(values, bits):
+    # packs values (uint64) into a little-endian bit stream of bits bits each, followed by 8 bytes of
+    # padding so that unpack_bits can always read 8 bytes at a time
+    chunks = []
+    shifts = np.arange(bits, dtype=np.uint64)
+    for start in range(0, len(values), PACK_CHUNK):
+        chunk = np.asarray(values[start:start+PACK_CHUNK], dtype=np.uint64)
+        bit_matrix = ((chunk[:, None] >> shifts) & np.uint64(1)).astype(np.uint8)
+        chunks.append(np.packbits(bit_matrix.reshape(-1), bitorder='little').tobytes())
+    return b''.join(chunks) + bytes(8)
+
+
+def unpack_bits(data, idxs, bits):
+    # values at idxs of a stream written by pack_bits (bits <= 57, or 64)
+    bit_pos = np.asarray(idxs, dtype=np.int64) * bits
+    words = data[(bit_pos >> 3)[:, None] + np.arange(8)].view('<u8').reshape(len(bit_pos))
+    if bits == 64:
+        return words.astype(np.uint64)
+    return (words >> (bit_pos & 7).astype(np.uint64)) & np.uint64((1 << bits) - 1)
+
+
+def unpack_bits_one(data: memoryview, idx: int, bits: int):
+    # unpack_bits for a single index (data is a memoryview, which is much cheaper to slice than an array)
+    bit_pos = idx * bits
+    word = int.from_bytes(data[bit_pos >> 3:(bit_pos >> 3) + 8], 'little')
+    return word if bits == 64 else word >> (bit_pos & 7) & ((1 << bits) - 1)
+
+
+def slice_vectorized(a, start):
+    b = byte_matrix(a)[:, start:]
+    if b.shape[1] == 0:
+        return np.zeros(len(a), dtype='S1')
+    return np.ascontiguousarray(b).view(f'S{b.shape[1]}').reshape(len(a))
+
+
+SAFE_DIGITS = 19 # 10**19 - 1 < 2**64
+POWERS_OF_TEN = np.array([10 ** i for i in range(SAFE_DIGITS)], dtype=np.uint64)
+
+
+def parse_ints(a, pad: int = 0):
+    # vectorized inverse of format_ints for an S array of digits (with any prefix already sliced off).
+    # Returns (values, valid). Only the canonical representation is valid: no leading zeros, or
+    # exactly pad digits (zero-padded) when pad is given. Values that do not fit in uint64 are invalid.
+    b = byte_matrix(a)
+    min_width = max(pad, 1)
+    if 0 < len(a) and 0 < b.shape[1] <= SAFE_DIGITS and b[:, -1].all():
+        # (usual within a block) all the values have the same number of digits
+        digits = b - np.uint8(ord('0'))
+        valid = (digits <= 9).all(axis=1) & (b.shape[1] >= min_width) & ((b.shape[1] <= min_width) | (b[:, 0] != ord('0')))
+        values = (digits.astype(np.uint64) * POWERS_OF_TEN[b.shape[1] - 1::-1]).sum(axis=1, dtype=np.uint64)
+        values[~valid] = 0
+        return values, valid
+    cols = np.arange(b.shape[1])
+    lengths = row_lengths(b)
+    active = cols < lengths[:, None]
+    valid = ((b >= ord('0')) & (b <= ord('9')) | ~active).all(axis=1)
+    valid &= lengths >= min_width
+    if b.shape[1] > 0:
+        valid &= (lengths <= min_width) | (b[:, 0] != ord('0'))
+    values = np.zeros(len(a), dtype=np.uint64)
+    # values of up to SAFE_DIGITS digits cannot overflow, so their digits are weighted and summed at once
+    short = valid & (lengths <= SAFE_DIGITS)
+    if short.any():
+        width = min(b.shape[1], SAFE_DIGITS)
+        short_active = active[:, :width] & short[:, None]
+        digits = np.where(short_active, b[:, :width] - ord('0'), 0).astype(np.uint64)
+        values = (digits * POWERS_OF_TEN[np.where(short_active, lengths[:, None] - 1 - cols[:width], 0)]).sum(axis=1, dtype=np.uint64)
+    # longer ones (e.g., zero-padded) are parsed digit by digit, checking for overflow
+    long = valid & ~short
+    ten = np.uint64(10)
+    max_value = np.uint64(np.iinfo(np.uint64).max)
+    for col in range(b.shape[1] if long.any() else 0):
+        digit = (b[:, col] - ord('0')).astype(np.uint64)
+        col_active = active[:, col] & long & valid
+        if not col_active.any():
+            break
+        valid &= ~col_active | (values <= (max_value - digit) // ten) # overflow
+        col_active &= valid
+        values = np.where(col_active, values * ten + digit, values)
+    values[~valid] = 0
+    return values, valid
+
+
+def parse_int(digits: bytes, pad: int = 0):
+    # parse_ints for a single value; None if it is not valid
+    min_width = max(pad, 1)
+    if not digits.isdigit() or len(digits) < min_width or (len(digits) > min_width and digits[0] == 48): # b'0'
+        return None
+    value = int(digits)
+    return value if value >> 64 == 0 else None
+
+
+FORMAT_INTS_SMALL = 16
+
+
+def format_ints(values, prefix: bytes = b'', pad: int = 0):
+    # vectorized equivalent of np.char.mod(prefix + b'%0{pad}d', values) for non-negative integers
+    values = np.asarray(values).astype(np.uint64)
+    if 0 < len(values) <= FORMAT_INTS_SMALL:
+        # the per-digit passes cost more than formatting a few values one at a time (e.g., lookups that are
+        # spread over many blocks)
+        return np.array([prefix + b'%0*d' % (pad, v) for v in values.tolist()], dtype='S')
+    max_value = int(values.max()) if len(values) else 0
+    min_width = max(pad, 1)
+    width = max(len(str(max_value)), min_width)
+    # extract digits right-to-left
+    digits = np.empty((len(values), width), dtype=np.uint8)
+    rem = values.copy()
+    ten = np.uint64(10)
+    for col in range(width - 1, -1, -1):
+        digits[:, col] = rem % ten
+        rem //= ten
+    digits += ord('0')
+    # left-justify rows that are shorter than the widest value
+    lengths = np.full(len(values), min_width, dtype=np.intp)
+    for k in range(min_width, width):
+        lengths += values >= np.uint64(10**k)
+    if (lengths != width).any():
+        cols = np.arange(width) + (width - lengths)[:, None]
+        digits = np.take_along_axis(digits, np.minimum(cols, width - 1), axis=1)
+        digits[cols >= width] = 0
+    return prefixed(prefix, digits)
+
+
+def format_ints_heap(values, prefix: bytes = b'', pad: int = 0):
+    # format_ints, but producing (offsets, data) (without padding the values to the longest one)
+    values = np.asarray(values).astype(np.uint64)
+    min_width = max(pad, 1)
+    lengths = np.full(len(values), min_width, dtype=np.int64)
+    for k in range(min_width, 20): # 10**19 < 2**64 < 10**20
+        lengths += values >= np.uint64(10**k)
+    offsets = heap_offsets(lengths + len(prefix))
+    data = np.empty(offsets[-1], dtype=np.uint8)
+    fill_prefix(data, offsets, prefix)
+    # write digits right-to-left, dropping the values that have no digits left
+    ends, rem = offsets[1:] - 1, values.copy()
+    ten = np.uint64(10)
+    for col in range(int(lengths.max()) if len(values) > 0 else 0):
+        if col >= min_width:
+            keep = lengths > col
+            ends, rem, lengths = ends[keep], rem[keep], lengths[keep]
+        data[ends - col] = (rem % ten).astype(np.uint8) + ord('0')
+        rem //= ten
+    return offsets, data
+
+
 V0_HEADER_FORMAT = "<qqII" # next_ptr, doc_count, config_len, type_id
 V0_HEADER_SIZE = struct.calcsize(V0_HEADER_FORMAT)
 V0_PREFIX_SIZE = 0
@@ -19,7 +460,14 @@ PREFIX_SIZE = struct.calcsize(HEADER_FORMAT[:2])
 PREFIX2_SIZE = struct.calcsize(HEADER_FORMAT[:3])
 MAGIC_TYPE = 1145655374 # type_id=b'NPID'
 MAGIC_DOC_COUNT = 0
-THIS_VERSION = 1
+THIS_VERSION = 2
+# Version 2 files end with a table of contents of their blocks (TOC_ENTRY entries, a JSON list of their
+# configs, and a trailer with the position of the table), so that they can be opened without walking the
+# headers. The table is removed when a file is appended to and written again when it is closed.
+TOC_ENTRY = np.dtype([('type_id', '<u4'), ('header', '<i8'), ('start', '<i8'), ('end', '<i8'), ('doc_count', '<i8')])
+TOC_TRAILER_FORMAT = '<qQ8s' # position of the table, number of entries, magic
+TOC_TRAILER_SIZE = struct.calcsize(TOC_TRAILER_FORMAT)
+TOC_MAGIC = b'NPIDTOC\x00'
 
 
 class FileManager:
@@ -29,6 +477,7 @@ class FileManager:
         self._path = Path(path)
         self._file = None
         self._last_ptr = None
+        self._toc = None
         if not self._path.exists():
             if mode == 'a':
                 # init file
@@ -38,6 +487,7 @@ class FileManager:
                 self._write_header(MAGIC_TYPE, 0, len(enc_config))
                 self.write(enc_config)
                 self._last_ptr = 0
+                self._first_ptr = self.tell()
             else:
                 # raise error
                 raise FileNotFoundError(str(self._path) + ' not found')
@@ -54,7 +504,18 @@ class FileManager:
                 self.config = json.loads(self._file.read(config_len))
                 if self.config['version'] > THIS_VERSION:
                     raise RuntimeError(f'This file was created with a newer version of npids (file format version={config["version"]}, max supported version={THIS_VERSION}). Please upgrade npids to read this file.')
-            if mode == 'a':
+            self._first_ptr = self._file.tell()
+            if self.config['version'] >= 2:
+                self._toc = self._read_toc()
+                self._file.seek(self._first_ptr)
+            if mode == 'a' and self._toc is not None:
+                toc_ptr, entries, _ = self._toc
+                self._last_ptr = int(entries['header'][-1]) if len(entries) else 0
+                # the table is written again on close
+                self._toc = None
+                self._file.truncate(toc_ptr)
+                self._file.seek(0, 2)
+            elif mode == 'a':
                 pos = [0]
                 while pos[-1] != -1:
                     self._file.seek(pos[-1])
@@ -70,9 +531,50 @@ class FileManager:
         self.close()
 
     def close(self):
+        if self._mode == 'a' and self.config['version'] >= 2:
+            self._write_toc()
         self._file.close()
         self._file = None
 
+    def blocks(self):
+        # (type_id, header position, data start, data end, doc_count, config) of each block, from the table of
+        # contents when there is one, otherwise by walking the headers. The end of the last block is None when
+        # it extends to the end of the file.
+        if self._toc is not None:
+            _, entries, configs = self._toc
+            for entry, config in zip(entries.tolist(), configs):
+                yield entry + (config,)
+            return
+        size = self._file.seek(0, 2)
+        ptr = self._first_ptr
+        while ptr != -1 and ptr < size:
+            self._file.seek(ptr)
+            type_id, next_ptr, doc_count, config = self.read_header()
+            yield type_id, ptr, self._file.tell(), None if next_ptr == -1 else next_ptr, doc_count, config
+            ptr = next_ptr
+
+    def _read_toc(self):
+        size = self._file.seek(0, 2)
+        if size < self._first_ptr + TOC_TRAILER_SIZE:
+            return None
+        self._file.seek(size - TOC_TRAILER_SIZE)
+        toc_ptr, count, magic = struct.unpack(TOC_TRAILER_FORMAT, self._file.read(TOC_TRAILER_SIZE))
+        if magic != TOC_MAGIC or not (self._first_ptr <= toc_ptr <= size - TOC_TRAILER_SIZE - count * TOC_ENTRY.itemsize):
+            return None # e.g., the writer did not close the file
+        self._file.seek(toc_ptr)
+        data = self._file.read(size - TOC_TRAILER_SIZE - toc_ptr)
+        entries = np.frombuffer(data[:count*TOC_ENTRY.itemsize], dtype=TOC_ENTRY)
+        return toc_ptr, entries, json.loads(data[count*TOC_ENTRY.itemsize:])
+
+    def _write_toc(self):
+        toc_ptr = self._file.seek(0, 2)
+        blocks = list(self.blocks())
+        entries = np.array([b[:3] + (toc_ptr if b[3] is None else b[3], b[4]) for b in blocks], dtype=TOC_ENTRY)
+        self._file.seek(toc_ptr)
+        self.write(entries.tobytes())
+        self.write(json.dumps([b[5] for b in blocks]).encode())
+        self.write(struct.pack(TOC_TRAILER_FORMAT, toc_ptr, len(blocks), TOC_MAGIC))
+
     def write_header(self, type_id, doc_count=0, config=None):
         if config is not None:
             config_enc = json.dumps(config).encode()
@@ -127,6 +629,30 @@ class FileManager:
         self.write(struct.pack(V0_HEADER_FORMAT, -1, doc_count, config_len, type_id))
         self._last_ptr = here
 
+    def rewrite_last_config(self, config):
+        # replaces the config of the last header; only valid while no data follows it
+        self._file.seek(self._last_ptr)
+        type_id, next_ptr, doc_count, _ = self._read_header()
+        config_enc = json.dumps(config).encode()
+        self._file.seek(self._last_ptr)
+        self._file.truncate()
+        if self.config['version'] >= 1:
+            self.write(struct.pack(HEADER_FORMAT, type_id, next_ptr, doc_count, len(config_enc)))
+        else:
+            self.write(struct.pack(V0_HEADER_FORMAT, next_ptr, doc_count, len(config_enc), type_id))
+        self.write(config_enc)
+
+    def reserve(self, size):
+        # extends the file by size zero bytes (to be filled in later) and returns their position
+        here = self._file.tell()
+        self._file.truncate(here + size)
+        self._file.seek(here + size)
+        return here
+
+    @property
+    def path(self):
+        return self._path
+
     def flush(self):
         self._file.flush()
 
@@ -141,6 +667,123 @@ class FileManager:
 
 
 _marker = object()
+_MISSING = object()
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache:
+    # mapping of up to maxsize keys that evicts the least recently used ones, counting hits and misses
+    # (like functools.lru_cache, but filled explicitly so that batches can be split into hits and misses)
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.data.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def get_many(self, keys, default=None):
+        # get for a batch of keys, with the bookkeeping done in bulk
+        values = [self.data.get(key, _MISSING) for key in keys]
+        move_to_end = self.data.move_to_end
+        hits = 0
+        for i, (key, value) in enumerate(zip(keys, values)):
+            if value is _MISSING:
+                values[i] = default
+            else:
+                move_to_end(key)
+                hits += 1
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return values
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
+
+
+class StringHeap:
+    """
+    A batch of strings stored back to back in ``data`` (UTF-8, uint8), the i-th one being
+    ``data[offsets[i]:offsets[i+1]]`` (``offsets`` being int64, starting at 0). This is the layout of
+    Arrow's ``large_string`` arrays, so unlike ``S``/``U`` arrays, the strings are not padded to the
+    longest one in the batch.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def from_bytes(docnos):
+        # list of bytes -> StringHeap
+        return StringHeap(heap_offsets([len(d) for d in docnos]), np.frombuffer(b''.join(docnos), dtype=np.uint8))
+
+    @staticmethod
+    def from_arrow(array):
+        # pyarrow string or large_string array (without nulls) -> StringHeap, sharing its data buffer
+        import pyarrow as pa
+        if not (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)):
+            raise ValueError(f'Unsupported arrow type {array.type} (expected string or large_string)')
+        if array.null_count > 0:
+            raise ValueError(f'Unsupported arrow array with {array.null_count} nulls')
+        _, offsets, data = array.buffers()
+        offset_dtype = np.int64 if pa.types.is_large_string(array.type) else np.int32
+        offsets = np.frombuffer(offsets, dtype=offset_dtype)[array.offset:array.offset+len(array)+1].astype(np.int64)
+        data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, dtype=np.uint8)
+        return StringHeap(offsets - offsets[0], data[offsets[0]:offsets[-1]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.data[self.offsets[idx]:self.offsets[idx+1]].tobytes().decode()
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __repr__(self):
+        return f'StringHeap({self.tolist()!r})'
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def tolist(self, as_bytes=False):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        result = [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return result if as_bytes else [d.decode() for d in result]
+
+    def to_bytes_array(self):
+        # NUL-padded S array
+        return rows_as_bytes(heap_to_rows(self.offsets, self.data))
+
+    def to_numpy(self):
+        # variable-width StringDType array on numpy>=2 (object array otherwise)
+        dtype = getattr(getattr(np, 'dtypes', None), 'StringDType', None)
+        return np.array(self.tolist(), dtype=dtype() if dtype is not None else object)
+
+    def to_arrow(self):
+        # pyarrow large_string array over the same buffers (no copy)
+        import pyarrow as pa
+        return pa.LargeStringArray.from_buffers(len(self), pa.py_buffer(self.offsets), pa.py_buffer(self.data))
+
+
 class peekable:
     """Simplified version of more_itertools.peekable.
     Based on <https://more-itertools.readthedocs.io/en/stable/_modules/more_itertools/more.html#peekable>
@@ -0,0 +1,203 @@
+import unittest
+import tempfile
+import uuid
+import numpy as np
+from npids import Lookup
+
+
+class TestCodecs(unittest.TestCase):
+    def _test_roundtrip(self, docnos, fwd_format=None, **kwargs):
+        with tempfile.TemporaryDirectory() as tdir:
+            lookup = Lookup.build(docnos, f'{tdir}/docnos', **kwargs)
+            # an inverse lookup before the forward blocks are used (they are loaded lazily)
+            self.assertEqual(len(docnos) - 1, lookup.inv[docnos[-1]])
+            if fwd_format is not None:
+                self.assertEqual({fwd_format}, {c.fmt.NAME for c in lookup.fwd.codecs})
+            idxs = np.random.permutation(len(docnos))
+            self.assertEqual([docnos[i] for i in idxs], lookup.fwd[idxs].tolist())
+            self.assertEqual(docnos[-1], lookup.fwd[len(docnos)-1])
+            self.assertEqual(docnos, list(lookup))
+            self.assertEqual(idxs.tolist(), lookup.inv[[docnos[i] for i in idxs]])
+            # the scalar paths agree with the vectorized ones
+            for i in idxs[:100].tolist():
+                self.assertEqual(docnos[i], lookup.fwd[i])
+                self.assertEqual(i, lookup.inv[docnos[i]])
+            for docno in [docnos[0] + '0', docnos[0][:-1], 'x' + docnos[-1], docnos[-1] + 'x', '']:
+                self.assertEqual(lookup.inv[[docno]][0], lookup.inv.lookup_one(docno.encode()))
+            # the heap output agrees with the padded one, and is accepted by the inverse
+            heap = lookup.fwd.lookup(idxs, as_heap=True)
+            self.assertEqual([docnos[i] for i in idxs], heap.tolist())
+            self.assertEqual(idxs.tolist(), lookup.inv[heap].tolist())
+            return lookup.describe()
+
+    def test_uuid(self):
+        docnos = [str(uuid.uuid4()) for _ in range(1000)]
+        self._test_roundtrip(docnos, 'uuid')
+        self._test_roundtrip([f'doc-{d.upper()}' for d in docnos], 'uuid')
+
+    def test_hexdigest(self):
+        rng = np.random.default_rng(0)
+        docnos = [rng.bytes(16).hex() for _ in range(1000)]
+        self._test_roundtrip(docnos, 'hexdigest')
+        self._test_roundtrip([f'doc-{d.upper()}' for d in docnos], 'hexdigest')
+
+    def test_ints(self):
+        self._test_roundtrip([str(i) for i in range(1000)], 'intsequence')
+        self._test_roundtrip([f'D{i}' for i in range(5, 1005)], 'intsequence')
+        self._test_roundtrip([f'D{i:06d}' for i in range(95, 1095)], 'intsequencepad')
+        rng = np.random.default_rng(0)
+        self._test_roundtrip([f'D{i}' for i in rng.permutation(256)], 'intstored')
+        self._test_roundtrip([f'D{i}' for i in rng.choice(10**9, 1000, replace=False)], 'intpacked')
+        self.assertIn('intstored', self._test_roundtrip([f'D{i}' for i in np.sort(rng.choice(10**7, 1000, replace=False)) + 10**7], 'intpacked'))
+        # values that would widen the packed range far beyond the seeded one end the block (by add and add_many)
+        self.assertIn('intpacked [prefix=] (count=300)', self._test_roundtrip([str(i) for i in np.sort(rng.choice(10**6, 300, replace=False))] + [str(2**63 + i * 7) for i in range(10)]))
+        docnos = [f'D{i}' for i in rng.choice(10**10, 2000, replace=False)]
+        docnos = docnos[:1000] + [f'D{2**64-1}'] + docnos[1000:]
+        self.assertIn('intpacked [prefix=D] (count=1000)', self._test_roundtrip(docnos))
+        with tempfile.TemporaryDirectory() as tdir:
+            with Lookup.builder(f'{tdir}/add', build_inv=False) as builder:
+                for docno in docnos:
+                    builder.add(docno)
+            with Lookup.builder(f'{tdir}/add_many', build_inv=False) as builder:
+                builder.add_many(docnos)
+            with open(f'{tdir}/add', 'rb') as f1, open(f'{tdir}/add_many', 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+        self._test_roundtrip([str(i) for i in [0, 9, 10, 99, 100, 2**64-1]], 'intstored')
+
+    def test_duplicated_ids(self):
+        # IDs that appear in several blocks with overlapping ranges resolve to their first occurrence (in file order)
+        rng = np.random.default_rng(0)
+        a = np.sort(rng.choice(10**12, 1000, replace=False)) + 10**12
+        b = np.sort(np.concatenate([rng.choice(10**12, 500, replace=False), a[::10]]))
+        cases = {
+            'intstored': ([f'D{i}' for i in a] + [f'E{i}' for i in np.sort(rng.choice(10**9, 300, replace=False))] + [f'D{i}' for i in b], a[::10]),
+            'intsequencemulti': ([f'D{i}' for i in range(500, 1500)] + [f'D{i}' for i in range(100, 600, 2)], np.arange(500, 600, 2)),
+        }
+        for inv_format, (docnos, duplicated) in cases.items():
+            with self.subTest(inv_format), tempfile.TemporaryDirectory() as tdir:
+                lookup = Lookup.build(docnos, f'{tdir}/docnos')
+                self.assertEqual(inv_format, lookup.inv.codec.NAME)
+                queries = [f'D{i}' for i in duplicated]
+                expected = [docnos.index(q) for q in queries]
+                self.assertEqual(expected, lookup.inv[queries])
+                self.assertEqual(expected, [lookup.inv[q] for q in queries])
+
+    def test_intsequencegaps(self):
+        rng = np.random.default_rng(0)
+        ids = np.sort(rng.choice(20000, 5000, replace=False))
+        self.assertIn('intsequencemulti', self._test_roundtrip([f'D{i}' for i in ids], 'intsequencegaps'))
+        self._test_roundtrip([f'D{i * 5 + 3:07d}' for i in ids], 'intsequencegaps')
+        # a sequence that only starts missing values after the builder has chosen intsequence is upgraded in place
+        docnos = [str(i) for i in range(5000) if i not in (4000, 4500, 4501)]
+        self.assertIn('intsequencemulti', self._test_roundtrip(docnos, 'intsequencegaps'))
+        with tempfile.TemporaryDirectory() as tdir:
+            lookup = Lookup.build([f'D{i * 3:05d}' for i in ids], f'{tdir}/docnos')
+            for docno in [f'D{ids[0] * 3 - 3:05d}', f'D{ids[0] * 3 + 1:05d}', f'D{ids[-1] * 3 + 3:05d}', f'D{ids[5] * 3}', 'D', 'E00003']:
+                with self.subTest(docno):
+                    self.assertFalse(docno in lookup)
+            self.assertEqual(np.setdiff1d(np.arange(ids[0], ids[-1]), ids)[:10].tolist(), [i for i in range(ids[0], ids[-1]) if f'D{i * 3:05d}' not in lookup][:10])
+
+    def test_prefixdict(self):
+        rng = np.random.default_rng(0)
+        sources = {
+            'AP': lambda: f'AP88{rng.integers(101, 1231):04d}-{rng.integers(1, 10000):04d}',
+            'WSJ': lambda: f'WSJ87{rng.integers(101, 1231):04d}-{rng.integers(1, 10000):04d}',
+            'FT': lambda: f'FT9{rng.integers(10, 100)}-{rng.integers(1, 100000)}',
+            'FR': lambda: f'FR94{rng.integers(101, 1231):04d}-{rng.integers(0, 3)}-{rng.integers(1, 100000):05d}',
+        }
+        docnos = list(dict.fromkeys(sources[rng.choice(list(sources))]() for _ in range(3000)))
+        self.assertIn('prefixdict [mode=bytes', self._test_roundtrip(docnos, 'prefixdict'))
+        docnos = list(dict.fromkeys(f'{rng.choice(["D", "X", "doc-"])}{rng.integers(10**6)}' for _ in range(3000)))
+        self.assertIn('prefixdict [mode=int', self._test_roundtrip(docnos, 'prefixdict'))
+        # more prefixes than fit in the dictionary of a single block
+        docnos = [f'{"PQRS"[i % 4]}{10**6 + i}' for i in range(1000)] + [f'{chr(103 + i % 20)}{chr(103 + i // 20 % 20)}{10**6 + i}' for i in range(1000, 2000)]
+        self.assertIn('prefixdict [mode=int width=4 prefixes=256] (count=1252)', self._test_roundtrip(docnos))
+        with tempfile.TemporaryDirectory() as tdir:
+            lookup = Lookup.build(docnos[:1000], f'{tdir}/docnos')
+            self.assertEqual('prefixdict', lookup.inv.codec.NAME)
+            for docno in ['P1000001', 'P01000000', 'P', 'T1000004', 'P1000004P', '1000004', 'P1001000', '']:
+                with self.subTest(docno):
+                    self.assertFalse(docno in lookup)
+            # the inverse only covers files of prefixdict blocks; other files fall back to hash
+            mixed = docnos[:1000] + [f'{i:032x}' for i in range(1000)]
+            lookup = Lookup.build(mixed, f'{tdir}/mixed')
+            self.assertEqual('prefixdict', lookup.fwd.codecs[0].fmt.NAME)
+            self.assertNotEqual({'prefixdict'}, {c.fmt.NAME for c in lookup.fwd.codecs})
+            self.assertEqual('hash', lookup.inv.codec.NAME)
+            self.assertEqual(list(range(2000)), lookup.inv[mixed])
+            with self.assertRaises(ValueError):
+                Lookup.build(mixed, f'{tdir}/mixed_prefixdict', inv_format='prefixdict')
+
+    def test_varbytes(self):
+        rng = np.random.default_rng(0)
+        docnos = [f'http://example.com/{rng.bytes(rng.integers(0, 5) ** 3).hex()}/{i}' for i in range(1000)] + ['http://example.com/', 'http://example.com/é']
+        self.assertIn('varbytes', self._test_roundtrip(docnos, 'varbytes'))
+        self._test_roundtrip([''] + [f'{i}:' * (i % 5 + 1) ** 2 for i in range(1, 1000)], 'varbytes')
+        self._test_roundtrip(docnos, 'varbytes', min_block=2000)
+
+    def test_frontcoded(self):
+        rng = np.random.default_rng(0)
+        # sorted IDs whose leading fields change every few dozen IDs (and whose source changes) share a block
+        docnos = [f'FR94{m:02d}{d:02d}-{p}-{i:05d}' for m in range(1, 3) for d in range(1, 29) for p in range(2) for i in range(1, rng.integers(20, 60))]
+        docnos += [f'LA{m:02d}{d:02d}89-{i:04d}' for m in range(1, 3) for d in range(1, 29) for i in range(1, rng.integers(20, 60))]
+        self.assertIn(f'frontcoded [prefix=] (count={len(docnos)})', self._test_roundtrip(docnos, 'frontcoded'))
+        urls = sorted({f'http://{rng.choice(["a.com", "b.org"])}/{"/".join(rng.choice(list("abcd"), rng.integers(0, 40)))}' for _ in range(3000)})
+        self.assertIn('frontcoded', self._test_roundtrip(urls + ['http://é', 'http://éé', 'http://' + 'z' * 248]))
+
+    def test_template(self):
+        rng = np.random.default_rng(0)
+        ids = np.sort(rng.choice(10**9, 5000, replace=False))
+        docnos = [f'clueweb09-en{i // 10**7:04d}-{i // 10**5 % 100:02d}-{i % 10**5:05d}' for i in ids]
+        self.assertIn("'-', [5, True]]", self._test_roundtrip(docnos, 'template'))
+        docnos = [f'page{i}.html' for i in np.sort(rng.choice(10**6, 1000, replace=False))]
+        self.assertIn("['page', [6, False], '.html']", self._test_roundtrip(docnos, 'template'))
+        self._test_roundtrip([f'{i // 1000}-{i % 1000}' for i in np.sort(rng.choice(10**5, 3000, replace=False))], 'template')
+        with tempfile.TemporaryDirectory() as tdir:
+            lookup = Lookup.build(docnos, f'{tdir}/docnos')
+            self.assertEqual('template', lookup.inv.codec.NAME)
+            for docno in ['page01234.html', 'page1234.htm', 'page1234.html.', 'page.html', 'page1234567.html', 'Page1234.html']:
+                with self.subTest(docno):
+                    self.assertFalse(docno in lookup)
+
+    def test_ints_invalid(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            seq = Lookup.build([f'D{i}' for i in range(5, 1005)], f'{tdir}/seq')
+            pad = Lookup.build([f'D{i:04d}' for i in range(5, 1005)], f'{tdir}/pad')
+            stored = Lookup.build([f'D{i}' for i in range(1000, 0, -1)], f'{tdir}/stored')
+            self.assertEqual(0, seq.inv['D5'])
+            self.assertEqual(0, pad.inv['D0005'])
+            self.assertEqual(999, stored.inv['D1'])
+            for lookup, docno in [(seq, 'D05'), (seq, 'D4'), (seq, 'D1005'), (seq, 'D'), (seq, 'D99999999999999999999999'),
+                                  (pad, 'D5'), (pad, 'D00005'), (pad, 'D0004'), (stored, 'D01'), (stored, 'D1001'), (stored, 'D1\x002')]:
+                with self.subTest(docno):
+                    self.assertFalse(docno in lookup)
+
+    def test_seed_many(self):
+        # seed_many accepts the same blocks as seed, and estimates the same size
+        from npids import codecs
+        rng = np.random.default_rng(0)
+        cases = [
+            [f'FR94{m:02d}{d:02d}-{p}-{i:05d}' for m in range(1, 3) for d in range(1, 5) for p in range(2) for i in range(1, 20)],
+            [f'G{i:06d}' for i in np.sort(rng.choice(1000, 300, replace=False)) * 3],
+            [f'D{i}' for i in np.sort(rng.choice(1000, 300, replace=False))],
+            [f'{["FT", "LA", "AP"][i % 3]}{i}' for i in rng.integers(0, 10**5, 300)],
+            [f'{["FT", "LA"][i % 2]}{i}x' for i in rng.integers(0, 10**5, 300)],
+            sorted(f'http://s.com/{"/".join(rng.choice(["news", "sport", "about"], rng.integers(0, 6)))}' for _ in range(300)),
+            [f'p{i}-{j}.html' for i in range(20) for j in range(0, 10**9, 10**8)],
+            ['ab', 'abc', 'é', ''] * 50,
+        ]
+        # (and the same blocks ending with IDs that some of the codecs reject)
+        cases += [docnos + [extra] for docnos in cases for extra in ['G000001', 'D0123', 'D' + '9' * 30, 'p1-01.html', '']]
+        for docnos in cases:
+            for name in ['frontcoded', 'template', 'prefixdict', 'intsequencegaps', 'intstored', 'intpacked']:
+                with self.subTest(name, docnos=docnos[:2] + docnos[-1:]):
+                    one, many = codecs.fwd[name](), codecs.fwd[name]()
+                    accepted = all(one.seed(docno) for docno in docnos)
+                    ids = np.array([docno.encode() for docno in docnos])
+                    self.assertEqual(accepted, many.seed_many(ids[:37]) and many.seed_many(ids[37:]))
+                    if accepted:
+                        self.assertEqual(one.size(), many.size())
+
+
+if __name__ == '__main__':
+    unittest.main()
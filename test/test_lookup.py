@@ -0,0 +1,314 @@
+import os
+import sys
+import subprocess
+import unittest
+import tempfile
+import uuid
+from unittest import mock
+import numpy as np
+from npids import Lookup, StringHeap
+from npids.builder import InvLookupBuilder
+from npids.utils import FileManager
+from npids.codecs import inv_hash
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+class TestLookup(unittest.TestCase):
+    def test_iter_batches(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'D{i}' for i in range(1000)] + ['abc', 'x', 'yz'] * 200 + [str(i) for i in range(500, 0, -1)]
+            lookup = Lookup.build(docnos, f'{tdir}/docnos', min_block=16)
+            batches = list(lookup.iter_batches(batch_size=128))
+            self.assertTrue(all(len(b) <= 128 for b in batches))
+            self.assertEqual(docnos, np.concatenate(batches).tolist())
+            batches = list(lookup.iter_batches(batch_size=100, as_bytes=True))
+            self.assertEqual([d.encode() for d in docnos], np.concatenate(batches).tolist())
+
+    def test_optimize(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            # a large block (kept as it is) followed by many blocks that only end because of a longer ID
+            docnos = [str(i) for i in range(70000)] + [f'D{i}' if i % 40 else 'odd' + 'x' * (i // 40) for i in range(10000)] + ['a', 'b']
+            Lookup.build(docnos, f'{tdir}/docnos', min_block=16)
+            stats = Lookup.optimize(f'{tdir}/docnos', f'{tdir}/optimized')
+            self.assertLess(stats['blocks_after'], stats['blocks_before'])
+            self.assertLess(stats['bytes_after'], stats['bytes_before'])
+            lookup = Lookup(f'{tdir}/optimized')
+            self.assertEqual(stats['blocks_after'], len(lookup.fwd.codecs))
+            self.assertIn('intsequence [prefix= start=0] (count=70000)', lookup.describe())
+            self.assertEqual(docnos, list(lookup))
+            idxs = np.random.permutation(len(docnos))
+            self.assertEqual(idxs.tolist(), lookup.inv[[docnos[i] for i in idxs]])
+            with self.assertRaises(FileExistsError):
+                Lookup.optimize(f'{tdir}/docnos', f'{tdir}/optimized')
+            lookup = Lookup.build(docnos, f'{tdir}/built', min_block=16, optimize=True)
+            self.assertEqual(stats['blocks_after'], len(lookup.fwd.codecs))
+            self.assertEqual(docnos, list(lookup))
+
+    def test_many_blocks(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            rng = np.random.default_rng(0)
+            # runs of 20 that are too far apart to be merged into a block
+            docnos = [f'D{i}' for start in range(0, 10**6, 1000) for i in range(start, start + 20)]
+            # increasing random values in each block, alternating between two prefixes; the blocks of each
+            # prefix either cover disjoint ranges of values or overlapping ones
+            stored = [f'{"AB"[b % 2]}{i}' for b in range(200) for i in np.sort(rng.choice(10**6, 50, replace=False)) + b // 2 * 10**6]
+            values = np.sort(rng.permutation(10**6)[:10000].reshape(200, 50), axis=1)
+            overlapping = [f'{"AB"[b % 2]}{i}' for b in range(200) for i in values[b]]
+            for name, ids, inv_format in [('seq', docnos, 'intsequencemulti'), ('stored', stored, 'intstored'), ('overlapping', overlapping, 'intstored')]:
+                with self.subTest(name):
+                    lookup = Lookup.build(ids, f'{tdir}/{name}', min_block=16)
+                    self.assertEqual(inv_format, lookup.inv.codec.NAME)
+                    self.assertGreater(len(lookup.fwd.codecs), 100)
+                    idxs = rng.integers(0, len(ids), 5000)
+                    self.assertEqual([ids[i] for i in idxs], lookup.fwd[idxs].tolist())
+                    self.assertEqual(idxs.tolist(), lookup.inv[[ids[i] for i in idxs]])
+                    self.assertEqual([-1] * 4, lookup.inv[['D20', 'A1000000000', 'C5', 'A']])
+
+    def test_toc(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [str(i) for i in range(1000)] + [f'doc-{i*7919 % 10007:x}' for i in range(1000)]
+            Lookup.build(docnos, f'{tdir}/docnos', build_inv=False)
+            with FileManager(f'{tdir}/docnos', 'r') as f:
+                self.assertIsNotNone(f._toc)
+                self.assertEqual([0, 0], [b[0] for b in f.blocks()])
+            # appending the inverse replaces the table of contents
+            InvLookupBuilder.build(f'{tdir}/docnos')
+            with FileManager(f'{tdir}/docnos', 'r') as f:
+                self.assertEqual([0, 0, 1], [b[0] for b in f.blocks()])
+            idxs = np.random.permutation(len(docnos))
+            self.assertEqual(idxs.tolist(), Lookup(f'{tdir}/docnos').inv[[docnos[i] for i in idxs]])
+            # without a (valid) table of contents, the headers are walked instead
+            with open(f'{tdir}/docnos', 'r+b') as fout:
+                fout.seek(-1, 2)
+                fout.write(b'!')
+            with FileManager(f'{tdir}/docnos', 'r') as f:
+                self.assertIsNone(f._toc)
+                self.assertEqual([0, 0, 1], [b[0] for b in f.blocks()])
+            lookup = Lookup(f'{tdir}/docnos')
+            self.assertEqual(docnos, list(lookup))
+            self.assertEqual(idxs.tolist(), lookup.inv[[docnos[i] for i in idxs]])
+
+    def test_lazy_load(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [str(i) for i in range(1000)] + [str(uuid.UUID(int=i)) for i in range(1000)]
+            Lookup.build(docnos, f'{tdir}/docnos')
+            lookup = Lookup(f'{tdir}/docnos')
+            self.assertTrue(all(c._ctxt is None for c in lookup.fwd.codecs))
+            self.assertIsNone(lookup.inv._codec)
+            self.assertEqual('1', lookup.fwd[1])
+            self.assertIsNotNone(lookup.fwd.codecs[0]._ctxt)
+            self.assertIsNone(lookup.fwd.codecs[-1]._ctxt)
+            self.assertEqual(1500, lookup.inv[docnos[1500]])
+            lookup = Lookup(f'{tdir}/docnos', load_inv=False)
+            self.assertIsNone(lookup.inv)
+            self.assertEqual(docnos[1500], lookup.fwd[1500])
+        # codec modules are imported on first use
+        code = 'import sys, npids; print(any(m.startswith("npids.codecs.") for m in sys.modules))'
+        self.assertEqual('False', subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)), text=True).strip())
+
+    def test_lazy_load_reopen(self):
+        # an inverse lookup on a freshly opened file, before any forward access (the inverse can depend on
+        # state that the forward codecs only have once their context is built, e.g., the prefixdict dictionary)
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'{["AP", "WSJ", "FT"][i % 3]}{880212 + i // 100}-{i % 100:04d}' for i in range(10000)]
+            Lookup.build(docnos, f'{tdir}/docnos')
+            lookup = Lookup(f'{tdir}/docnos')
+            self.assertEqual('prefixdict', lookup.inv.codec.NAME)
+            self.assertEqual([5000, 10], lookup.inv[[docnos[5000], docnos[10]]])
+            self.assertEqual(7, Lookup(f'{tdir}/docnos').inv[docnos[7]])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'doc-{i*7919 % 10007:x}' for i in range(1000)]
+            Lookup.build(docnos, f'{tdir}/docnos')
+            self.assertEqual({'fwd': None, 'inv': None}, Lookup(f'{tdir}/docnos').cache_info())
+            lookup = Lookup(f'{tdir}/docnos', cache_size=4)
+            self.assertEqual(docnos[5], lookup.fwd[5])
+            self.assertEqual(docnos[5], lookup.fwd[5])
+            self.assertEqual((1, 1, 4, 1), tuple(lookup.cache_info()['fwd']))
+            # batches are split into hits and misses; only the misses are looked up (and then cached)
+            self.assertEqual([docnos[i] for i in [5, 7, 5, 9]], lookup.fwd[[5, 7, 5, 9]])
+            self.assertEqual((3, 3, 4, 3), tuple(lookup.cache_info()['fwd']))
+            self.assertEqual([docnos[i] for i in [1, 2, 3]], lookup.fwd[np.array([1, 2, 3])].tolist())
+            self.assertEqual(4, lookup.cache_info()['fwd'].currsize)
+            self.assertEqual(docnos[5], lookup.fwd.lookup(5, as_bytes=True).decode()) # 5 was evicted
+            self.assertEqual((3, 7, 4, 4), tuple(lookup.cache_info()['fwd']))
+            # inverse lookups, including IDs that are not found
+            self.assertEqual(3, lookup.inv[docnos[3]])
+            with self.assertRaises(LookupError):
+                lookup.inv['missing']
+            self.assertEqual([3, -1, 4], lookup.inv[[docnos[3], 'missing', docnos[4]]])
+            self.assertFalse('missing' in lookup)
+            self.assertEqual((3, 3, 4, 3), tuple(lookup.cache_info()['inv']))
+            self.assertEqual((3, 7, 4, 4), tuple(lookup.cache_info()['fwd'])) # the inverse does not go through the forward cache
+
+    def test_heap(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'D{i}' for i in range(1000)] + [str(uuid.UUID(int=i)) for i in range(1000)] + [f'doc-{i}' + 'x' * (i % 50) for i in range(1000)]
+            lookup = Lookup.build(docnos, f'{tdir}/docnos')
+            self.assertGreater(len(lookup.fwd.codecs), 1)
+            idxs = np.random.permutation(3000)
+            heap = lookup.fwd.lookup(idxs, as_heap=True)
+            self.assertIsInstance(heap, StringHeap)
+            self.assertEqual(3000, len(heap))
+            self.assertEqual(docnos[idxs[7]], heap[7])
+            self.assertEqual([len(docnos[i]) for i in idxs], heap.lengths().tolist())
+            self.assertEqual(sum(len(d) for d in docnos), len(heap.data)) # no padding
+            self.assertEqual([docnos[i] for i in idxs], lookup.lookup(idxs.tolist(), as_heap=True).tolist())
+            self.assertEqual(docnos, [d for batch in lookup.iter_batches(64, as_heap=True) for d in batch])
+            # heaps and variable-width string arrays are routed to the inverse
+            self.assertEqual(idxs.tolist(), lookup[heap].tolist())
+            self.assertEqual(idxs.tolist(), lookup[heap.to_numpy()].tolist())
+            self.assertEqual([docnos[i] for i in idxs[:10]], Lookup(f'{tdir}/docnos', cache_size=4).fwd.lookup(idxs[:10], as_heap=True).tolist())
+
+    @unittest.skipUnless(pa, 'pyarrow is not installed')
+    def test_heap_arrow(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'D{i}' for i in range(1000)] + [f'doc-{i}' + 'é' * (i % 50) for i in range(1000)]
+            lookup = Lookup.build(docnos, f'{tdir}/docnos')
+            idxs = np.random.permutation(2000)
+            arrow = lookup.fwd.lookup(idxs, as_heap=True).to_arrow()
+            self.assertEqual(pa.large_string(), arrow.type)
+            self.assertEqual([docnos[i] for i in idxs], arrow.to_pylist())
+            # string and large_string arrays (including slices) are accepted by the inverse
+            self.assertEqual(idxs.tolist(), lookup.inv[arrow].tolist())
+            self.assertEqual(idxs[5:].tolist(), lookup.inv[arrow.slice(5)].tolist())
+            self.assertEqual(idxs[5:9].tolist(), lookup[arrow.slice(5, 4)].tolist())
+            small = pa.array([docnos[i] for i in idxs] + ['missing'])
+            self.assertEqual(pa.string(), small.type)
+            self.assertEqual(idxs.tolist() + [-1], lookup.inv[small].tolist())
+            self.assertEqual(idxs[3:].tolist() + [-1], lookup.inv[small.slice(3)].tolist())
+            self.assertEqual([], lookup.inv[pa.array([], type=pa.string())].tolist())
+            with self.assertRaises(ValueError):
+                lookup.inv[pa.array([docnos[0], None])]
+            with self.assertRaises(ValueError):
+                lookup.inv[pa.array([1, 2])]
+
+    def test_inv_mph(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'doc-{i*7919 % 10007:x}' for i in range(5000)] + ['dup', 'x', 'dup']
+            lookup = Lookup.build(docnos, f'{tdir}/docnos', inv_format='mph')
+            self.assertEqual('mph', lookup.inv.codec.NAME)
+            idxs = np.random.permutation(5000)
+            self.assertEqual(idxs.tolist(), lookup.inv[[docnos[i] for i in idxs]])
+            self.assertIn(lookup.inv['dup'], (5000, 5002))
+            self.assertEqual(5001, lookup.inv['x'])
+            self.assertFalse('doc-zzz' in lookup)
+            with self.assertRaises(ValueError):
+                Lookup.build(docnos, f'{tdir}/docnos2', inv_format='intsequence')
+
+    def test_inv_sorted(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            rng = np.random.default_rng(0)
+            docnos = ['a-' + ''.join(rng.choice(list('ghijkl'), rng.integers(1, 8))) for _ in range(5000)]
+            docnos = list(dict.fromkeys(docnos)) + ['b-ghi', 'a-', 'zz']
+            lookup = Lookup.build(docnos, f'{tdir}/docnos')
+            self.assertEqual('sorted', lookup.inv.codec.NAME)
+            idxs = np.random.permutation(len(docnos))
+            self.assertEqual(idxs.tolist(), lookup.inv[[docnos[i] for i in idxs]])
+            self.assertEqual([-1] * 5, lookup.inv[['', 'a', 'a-ghijklg!', 'b-', 'zzz']])
+            with self.assertRaises(ValueError):
+                Lookup.build(['1', '2', '3'], f'{tdir}/ints', inv_format='sorted')
+
+    def test_inv_hash_options(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'doc-{i*7919 % 10007:x}' for i in range(5000)]
+            for i, options in enumerate([{'fingerprint_bits': 8}, {'fingerprint_bits': 16, 'hash_bits': 4}, {'hash_bits': 16}, {'hash_fn': 'fnv1_32'}]):
+                with self.subTest(options):
+                    lookup = Lookup.build(docnos, f'{tdir}/docnos{i}', inv_format='hash', inv_options=options)
+                    self.assertEqual(options.get('hash_bits', 13), lookup.inv.codec.hash_bits)
+                    idxs = np.random.permutation(5000)
+                    self.assertEqual(idxs.tolist(), lookup.inv[[docnos[i] for i in idxs]])
+                    self.assertFalse('doc-zzz' in lookup)
+
+    def test_inv_workers(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'doc-{i*7919 % 10007:x}' for i in range(5000)]
+            for inv_format, options in [(None, None), ('hash', {'fingerprint_bits': 8}), ('mph', None)]:
+                with self.subTest(inv_format):
+                    serial = f'{tdir}/{inv_format}-serial'
+                    parallel = f'{tdir}/{inv_format}-parallel'
+                    Lookup.build(docnos, serial, inv_format=inv_format, inv_options=options, return_self=False)
+                    lookup = Lookup.build(docnos, parallel, inv_format=inv_format, inv_options=options, workers=2)
+                    with open(serial, 'rb') as f1, open(parallel, 'rb') as f2:
+                        self.assertEqual(f1.read(), f2.read())
+                    self.assertEqual(list(range(5000)), lookup.inv[docnos])
+            # per-worker offsets are computed a chunk of buckets at a time
+            with mock.patch.object(inv_hash, 'BASES_CHUNK', 1000):
+                Lookup.build(docnos, f'{tdir}/chunked', inv_format='hash', inv_options={'fingerprint_bits': 8}, workers=3, return_self=False)
+            with open(f'{tdir}/hash-serial', 'rb') as f1, open(f'{tdir}/chunked', 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_inv_memory_budget(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            docnos = [f'doc-{i*7919 % 10007:x}' for i in range(5000)]
+            for i, options in enumerate([{}, {'fingerprint_bits': 16}, {'hash_bits': 4}]):
+                with self.subTest(options):
+                    Lookup.build(docnos, f'{tdir}/memory{i}', inv_format='hash', inv_options=options, return_self=False)
+                    with open(f'{tdir}/memory{i}', 'rb') as fin:
+                        expected = fin.read()
+                    for workers in [None, 2]:
+                        lookup = Lookup.build(docnos, f'{tdir}/external{i}-{workers}', inv_format='hash', inv_options={**options, 'memory_budget': 2**14}, workers=workers)
+                        with open(f'{tdir}/external{i}-{workers}', 'rb') as fin:
+                            self.assertEqual(expected, fin.read())
+                        self.assertEqual(list(range(5000)), lookup.inv[docnos])
+                        lookup.close()
+
+    def test_inv_hash_bits_default(self):
+        # beyond 2**32 IDs, the default hash_bits stays at 32 (with 8-byte offsets)
+        class Stop(Exception):
+            pass
+        class FakeFwd:
+            path = None
+            def __len__(self):
+                return 5 * 10**9
+            def iter_batches(self, *args, **kwargs):
+                raise Stop() # reached once the build starts reading IDs
+        fwd = FakeFwd()
+        self.assertEqual({'format': 'hash', 'hash_bits': 32, 'hash_fn': 'lane64', 'index_bytes': 8}, inv_hash.build_config(len(fwd)))
+        self.assertEqual(((1 << 32) + 1) * 8 + len(fwd) * 8, inv_hash.InvHash.estimate_size(fwd))
+        with tempfile.TemporaryDirectory() as tdir, self.assertRaises(Stop):
+            inv_hash.InvHash.build(fwd, FileManager(f'{tdir}/inv', 'a'), memory_budget=2**30)
+        self.assertEqual(13, inv_hash.build_config(5000)['hash_bits'])
+        # small lookups (down to empty ones) get at least MIN_HASH_BITS
+        self.assertEqual([8, 8, 8, 9], [inv_hash.build_config(count)['hash_bits'] for count in [0, 1, 256, 257]])
+        with tempfile.TemporaryDirectory() as tdir:
+            for docnos in [[], ['http://example.com/a']]:
+                with self.subTest(len(docnos)):
+                    lookup = Lookup.build(docnos, f'{tdir}/docnos{len(docnos)}', inv_format='hash')
+                    self.assertEqual(8, lookup.inv.codec.hash_bits)
+                    self.assertEqual(docnos, list(lookup))
+                    self.assertEqual(list(range(len(docnos))) + [-1], lookup.inv[docnos + ['http://example.com/b']])
+                    self.assertEqual([-1], lookup.inv[['']])
+                    self.assertFalse('http://example.com/b' in lookup)
+                    lookup.close()
+        with self.assertRaises(AssertionError):
+            inv_hash.build_config(5000, hash_bits=33)
+
+    def test_add_many(self):
+        rng = np.random.default_rng(0)
+        docnos = [f'D{i}' for i in range(3000)] + ['D01'] + [f'D{i:05d}' for i in range(3000)] + [str(uuid.uuid4()) for _ in range(1000)]
+        docnos += [rng.bytes(8).hex() for _ in range(1000)] + ['ab'] + [f'D{i}' for i in rng.integers(0, 10**6, 3000)] + ['ab', 'abc', 'é'] * 300 + ['x' * 40]
+        docnos = [f'cw-{i // 10**6:04d}{"abc"[i % 3]}-{i // 10**4 % 100:02d}-{i % 10**4:05d}' for i in np.sort(rng.choice(10**8, 3000, replace=False))] + [f'p{i}.html' for i in range(3000)] + [f'n{i}' for i in rng.choice(10**7, 3000)] + docnos + ['y' * 300]
+        # codecs with vectorized seeding: gaps, a small set of prefixes, and sorted URLs
+        docnos += [f'G{i:06d}' for i in np.sort(rng.choice(10**4, 3000, replace=False)) * 3] + [f'{["FT", "LA", "AP"][i % 3]}{i}' for i in rng.integers(0, 10**5, 3000)]
+        docnos += sorted({f'http://s.com/{"/".join(rng.choice(["news", "sport", "about"], rng.integers(2, 8)))}' for _ in range(3000)})
+        with tempfile.TemporaryDirectory() as tdir:
+            with Lookup.builder(f'{tdir}/add', build_inv=False) as builder:
+                for docno in docnos:
+                    builder.add(docno)
+            with open(f'{tdir}/add', 'rb') as fin:
+                expected = fin.read()
+            for i, inp in enumerate([docnos, iter(docnos), np.array(docnos), np.char.encode(np.array(docnos), 'utf8')]):
+                with Lookup.builder(f'{tdir}/add_many{i}', build_inv=False) as builder:
+                    builder.add_many(inp)
+                with open(f'{tdir}/add_many{i}', 'rb') as fin:
+                    self.assertEqual(expected, fin.read())
+
+
+if __name__ == '__main__':
+    unittest.main()